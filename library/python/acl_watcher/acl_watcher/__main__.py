@@ -2,19 +2,38 @@ from __future__ import annotations
 
 import asyncio
 import click
-import collections
+import concurrent.futures
 import functools
 import logging
 import pwd
 import stat
-import subprocess
 
 from pathlib import Path as P
-from typing import Awaitable, Callable, NamedTuple, Optional, OrderedDict
+from typing import Any, Awaitable, Callable, Optional
 
-MAX_QUEUE_SIZE = 128
-MAX_RECENT_FILES = 1024
+from . import bser, posix_acl, watchman
+from .events import EventBuffer, RecentFiles, WatchEvent, crawl_into
+from .state import ClockFile
+
+# Past that many pending events, wait MAX_BUFFER_WAIT seconds for the event
+# handler, then spill up to MAX_SPILLED bytes of them to disk:
+MAX_PENDING_EVENTS = 65536
+MAX_BUFFER_WAIT = 1.0
+MAX_SPILLED = 64 * 1024 * 1024
+MAX_BATCH = 1024
+# Files known to have the right mode and ACLs already, see `RecentFiles`:
+MAX_RECENT_FILES = 65536
 MAX_PENDING_SETFACL = 64
+# Threads setting ACLs, so that slow disks see a few requests at once:
+ACL_WORKERS = 4
+# Directories scanned at once when crawling the whole tree on start:
+CRAWL_WORKERS = 8
+SUBSCRIPTION = "acl-watcher"
+# In milliseconds, how long the tree has to be quiet before watchman sends
+# what changed, so that a large copy comes in a few large batches:
+SETTLE_PERIOD = 200
+# In milliseconds, send what changed anyway after that long:
+SETTLE_TIMEOUT = 2000
 
 logger = logging.getLogger("library.python.www_acl_watcher")
 
@@ -28,14 +47,25 @@ copy files over SMB.""")
     show_default=True,
     help="Enable asyncio debugging",
 )
+@click.option(
+    "--state-dir",
+    default=None,
+    envvar="STATE_DIRECTORY",
+    type=click.Path(file_okay=False, path_type=P),  # type: ignore
+    help="""
+Where to remember up to when changes got handled, so that the changes made
+while the watcher was down get handled when it starts. Without it the whole
+directory is crawled on start.
+""",
+)
 @click.pass_context
-def main(ctx: click.Context, debug: bool) -> None:
+def main(ctx: click.Context, debug: bool, state_dir: Optional[P]) -> None:
     logging.basicConfig(
         level=logging.INFO,
         datefmt="%Y-%m-%dT%H:%M:%S%z",
         format="%(asctime)s %(name)s %(levelname)s %(message)s",
     )
-    ctx.obj = {"debug": debug}
+    ctx.obj = {"debug": debug, "state_dir": state_dir}
 
 
 @main.command(
@@ -76,10 +106,12 @@ def www(
         ctx.fail("One of --www-dir or --username must be used")
     if www_dir is None:
         www_dir = P(pwd.getpwnam(username).pw_dir).parent / "www"  # type: ignore # noqa
-    setfacl_handler = functools.partial(www_setfacl_handler, www_data_gid)
-    coro = _watchman_loop(www_dir, setfacl_handler)
-    returncode = asyncio.run(coro, debug=ctx.obj["debug"])
-    ctx.exit(returncode)
+    groups = {posix_acl.gid(www_data_gid): posix_acl.READ}
+    acls = posix_acl.Acls(
+        file=posix_acl.from_mode(0o644, groups),
+        directory=posix_acl.from_mode(0o755, groups),
+    )
+    _run(ctx, www_dir, acls)
 
 
 @main.command(
@@ -102,144 +134,268 @@ family have access to.""",
 )
 @click.pass_context
 def goinfre(ctx: click.Context, family_gid: str, goinfre_dir: P) -> None:
-    setfacl_handler = functools.partial(goinfre_setfacl_handler, family_gid)
-    coro = _watchman_loop(goinfre_dir, setfacl_handler)
-    returncode = asyncio.run(coro, debug=ctx.obj["debug"])
-    ctx.exit(returncode)
-
-
-class WatchEvent(NamedTuple):
-    file: P
-    exists: bool
-    mode: int
+    read_write = posix_acl.READ | posix_acl.WRITE
+    groups = {posix_acl.gid(family_gid): read_write}
+    acls = posix_acl.Acls(
+        file=posix_acl.from_mode(0o644, groups, read_write, read_write),
+        directory=posix_acl.from_mode(0o755, groups, read_write, read_write),
+    )
+    _run(ctx, goinfre_dir, acls)
 
-    @classmethod
-    def from_line(cls, line: str) -> WatchEvent:
-        parts = line.strip().split("\0")
-        return cls(P(parts[0]), parts[1] == "True", int(parts[2]))
 
+async def _subscribe(
+    client: watchman.Client,
+    root: P,
+    since: Optional[Any],
+) -> Any:
+    """Subscribe to the changes made in ``root`` since the clock ``since``,
+    or from now on, and return the clock the subscription starts from.
+    """
 
-WatchEventQueue = asyncio.queues.Queue[Optional[WatchEvent]]
+    watch = await client.command("watch-project", str(root))
+    if "warning" in watch:
+        logger.warning(f"watchman: {watch['warning']}")
+    if since is None:
+        since = (await client.command("clock", watch["watch"]))["clock"]
+    query = {
+        "expression": ["true"],
+        "fields": ["name", "exists", "mode", "ino"],
+        # The first PDU has what changed since then, if anything, or every
+        # file if watchman restarted since:
+        "since": since,
+        # Hold off while a git or hg command runs in there:
+        "defer_vcs": True,
+        "settle_period": SETTLE_PERIOD,
+        "settle_timeout": SETTLE_TIMEOUT,
+    }
+    if "relative_path" in watch:
+        query["relative_root"] = watch["relative_path"]
+    await client.command("subscribe", watch["watch"], SUBSCRIPTION, query)
+    return since
 
 
 async def _watchman_loop(
     root: P,
-    setfacl_handler: Callable[[P, list[WatchEvent]], Awaitable[None]],
+    acls: posix_acl.Acls,
+    setfacl_handler: Callable[[P, list[WatchEvent]], Awaitable[list[WatchEvent]]],
+    clock_file: ClockFile,
 ) -> int:
-    event_queue: WatchEventQueue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+    events = EventBuffer(
+        root,
+        max_pending=MAX_PENDING_EVENTS,
+        max_spilled=MAX_SPILLED,
+        max_wait=MAX_BUFFER_WAIT,
+        max_batch=MAX_BATCH,
+        # Everything watchman sent so far got handled:
+        on_idle=clock_file.save,
+    )
 
-    handler_coro = event_handler(root, setfacl_handler, event_queue)
+    handler_coro = event_handler(root, acls, setfacl_handler, events, clock_file)
     handler_task = asyncio.create_task(handler_coro)
 
-    watchman = await asyncio.create_subprocess_exec(
-        "watchman-wait",
-        "--max-events", "0",
-        "--null",
-        "--relative", str(root),
-        "--fields", "name,exists,mode",
-        str(root),
-        stdout=subprocess.PIPE,
-    )
-    while True:
-        logger.info(f"waiting for watchman input")
-        bytes = await watchman.stdout.readline()  # type: ignore
-        if not bytes:
-            logger.info(f"watchman eof")
-            break
-        line = bytes.decode()
-        try:
-            event_queue.put_nowait(WatchEvent.from_line(line))
-        except asyncio.QueueFull:
-            logger.error("Event queue full, giving up.")
-            break
-    watchman.terminate()
-    await event_queue.put(None)
-    _, _, returncode = await asyncio.gather(
-        handler_task,
-        event_queue.join(),
-        watchman.wait(),
-    )
-    return returncode
+    try:
+        await _watch(root, events, clock_file)
+    except asyncio.IncompleteReadError:
+        logger.info("watchman eof")
+    except (OSError, watchman.WatchmanError, bser.BSERError) as ex:
+        logger.error(f"watchman: {ex}")
+    events.close()
+    await handler_task
+    # We only get there when something went wrong:
+    return 1
+
+
+async def _watch(root: P, events: EventBuffer, clock_file: ClockFile) -> None:
+    client = await watchman.Client.connect()
+    crawl = None
+    try:
+        since = clock_file.load()
+        if since is not None:
+            logger.info(f"catching up on the changes since {since}")
+        events.clock = await _subscribe(client, root, since)
+        if since is None:
+            # Nothing tells what changed while we were not watching, the
+            # clock is only saved once everything got crawled:
+            events.hold()
+            crawl = asyncio.create_task(crawl_into(root, events, CRAWL_WORKERS))
+            crawl.add_done_callback(functools.partial(_crawled, events))
+        while True:
+            logger.info("waiting for watchman input")
+            pdu = await client.subscription()
+            files = pdu.get("files", [])
+            await events.put(
+                (WatchEvent.from_file(file) for file in files),
+                pdu.get("clock"),
+            )
+    finally:
+        if crawl is not None:
+            crawl.cancel()
+        await client.close()
+
+
+def _crawled(events: EventBuffer, crawl: asyncio.Task[None]) -> None:
+    # Unless the crawl completed the clock must not be saved: files it
+    # missed would never get fixed.
+    if crawl.cancelled():
+        return
+    if (ex := crawl.exception()) is not None:
+        logger.error(f"crawl failed, the clock will not be saved: {ex!r}")
+        return
+    events.release()
 
 
 async def event_handler(
     root: P,
-    setfacl_handler: Callable[[P, list[WatchEvent]], Awaitable[None]],
-    event_queue: WatchEventQueue,
+    acls: posix_acl.Acls,
+    setfacl_handler: Callable[[P, list[WatchEvent]], Awaitable[list[WatchEvent]]],
+    events: EventBuffer,
+    clock_file: ClockFile,
 ) -> None:
-    already_known: OrderedDict[P, None] = collections.OrderedDict()
+    recent_files = RecentFiles(MAX_RECENT_FILES)
     pending_setfacl: list[WatchEvent] = []
     while True:
+        batch: Optional[list[WatchEvent]]
         if len(pending_setfacl) > 0:
-            try:
-                event = event_queue.get_nowait()
-            except asyncio.QueueEmpty:
-                await setfacl_handler(root, pending_setfacl)
+            batch = events.get_nowait()
+            if batch is not None and len(batch) == 0:
+                await _set_pending_acls(
+                    root, setfacl_handler, pending_setfacl, recent_files
+                )
                 continue
         else:
-            event = await event_queue.get()
-
-        logger.info(f"got event {event}")
+            batch = await events.get()
 
-        if event is None:
-            event_queue.task_done()
+        if batch is None:
+            if len(pending_setfacl) > 0:
+                await _set_pending_acls(
+                    root, setfacl_handler, pending_setfacl, recent_files
+                )
+            if events.empty():
+                clock_file.save(events.clock)
             return
-        if not event.exists:
-            event_queue.task_done()
-            continue
-#       if event.file in already_known:
-#           already_known.move_to_end(event.file)
-#           event_queue.task_done()
-#           continue
-        if len(already_known) == MAX_RECENT_FILES:
-            already_known.popitem(last=False)
-        already_known[event.file] = None
-
-        pending_setfacl.append(event)
-        if stat.S_ISREG(event.mode):
-            if stat.S_IMODE(event.mode) != 0o644:
-                file = root / event.file
-                file.chmod(0o644)
-                logger.info(f"chmod 644 file {file}")
-        elif stat.S_ISDIR(event.mode) and stat.S_IMODE(event.mode) != 0o755:
-            # NOTE:
-            #
-            # We weren't actually doing this chmod in the old script,
-            # also should we set some ACL on directories?
+
+        logger.info(
+            f"got {len(batch)} events, recent files: "
+            f"{recent_files.hits} hits, {recent_files.misses} misses"
+        )
+
+        for event in batch:
+            if not event.exists:
+                recent_files.discard(event.file)
+                continue
+            # Including the events our own chmod and ACLs cause:
+            if recent_files.known(event):
+                continue
+            try:
+                mode = _chmod(root, acls, event)
+            except FileNotFoundError:
+                # Gone since, events can be old when they got spilled:
+                continue
+            # The file is only known once its ACLs are set too:
+            pending_setfacl.append(event._replace(mode=mode))
+            if len(pending_setfacl) == MAX_PENDING_SETFACL:
+                await _set_pending_acls(
+                    root, setfacl_handler, pending_setfacl, recent_files
+                )
+
+
+async def _set_pending_acls(
+    root: P,
+    setfacl_handler: Callable[[P, list[WatchEvent]], Awaitable[list[WatchEvent]]],
+    pending_setfacl: list[WatchEvent],
+    recent_files: RecentFiles,
+) -> None:
+    for event in await setfacl_handler(root, pending_setfacl):
+        recent_files.add(event.file, event.ino, event.mode)
+
+
+def _chmod(root: P, acls: posix_acl.Acls, event: WatchEvent) -> int:
+    """Fix the mode of the file of ``event``, and return its new mode.
+
+    The mode is the one the ACLs give, so that setting them afterwards does
+    not change it again.
+    """
+
+    if stat.S_ISREG(event.mode):
+        mode = acls.file_mode
+        if stat.S_IMODE(event.mode) != mode:
+            file = root / event.file
+            file.chmod(mode)
+            logger.info(f"chmod {mode:o} file {file}")
+    elif stat.S_ISDIR(event.mode):
+        mode = acls.directory_mode
+        if stat.S_IMODE(event.mode) != mode:
             directory = (root / event.file)
-            directory.chmod(0o755)
-            logger.info(f"chmod 755 directory {directory}")
-        if len(pending_setfacl) == MAX_PENDING_SETFACL:
-            await setfacl_handler(root, pending_setfacl)
-        event_queue.task_done()
+            directory.chmod(mode)
+            logger.info(f"chmod {mode:o} directory {directory}")
+    else:
+        return event.mode
+    return stat.S_IFMT(event.mode) | mode
 
 
-async def www_setfacl_handler(
-    www_data_gid: str,
-    www_dir: P,
+def _set_acls(
+    acls: posix_acl.Acls,
+    root: P,
     events: list[WatchEvent],
-) -> None:
-    setfacl = await asyncio.create_subprocess_exec(
-        "setfacl", "-m", f"group:{www_data_gid}:r", "-", stdin=subprocess.PIPE,
-    )
-    paths = (f"{www_dir / event.file}\n".encode() for event in events)
-    setfacl.stdin.writelines(paths)  # type: ignore
-    await setfacl.stdin.drain()  # type: ignore
-    logger.info(f"cleared {len(events)} pending setfacl")
-    events.clear()
+) -> list[WatchEvent]:
+    applied = []
+    for event in events:
+        path = bytes(root / event.file)
+        try:
+            acls.apply(path, stat.S_ISDIR(event.mode))
+        except FileNotFoundError:
+            # Already moved or deleted, its new name gets its own event:
+            continue
+        except OSError as ex:
+            logger.warning(f"could not set the ACLs of {path!r}: {ex}")
+            continue
+        applied.append(event)
+    return applied
 
 
-async def goinfre_setfacl_handler(
-    family_gid: str,
-    goinfre_dir: P,
+async def setacl_handler(
+    acls: posix_acl.Acls,
+    executor: concurrent.futures.ThreadPoolExecutor,
+    root: P,
     events: list[WatchEvent],
-) -> None:
-    acls = ("group::rw", f"group:{family_gid}:rw", "m::rw")
-    cmd = ("setfacl", "-m", ",".join(acls), "-")
-    setfacl = asyncio.create_subprocess_exec(*cmd, stdin=subprocess.PIPE)
+) -> list[WatchEvent]:
+    """Set the ACLs of the files of ``events``, and clear it.
+
+    Return the events of the files that are done, including the ones that
+    needed nothing.
+    """
+
+    pending = []
+    done = []
     for event in events:
-        path = f"{goinfre_dir / event.file}\n".encode()
-        setfacl.stdin.write(path)  # type: ignore
-    await setfacl.drain()  # type: ignore # noqa
-    logger.info(f"cleared {len(events)} pending setfacl")
+        # Only files and directories get ACLs: Linux has none for symlinks,
+        # so the xattr calls, which do not follow them, would fail, and
+        # sockets, fifos and devices are left alone:
+        if stat.S_ISREG(event.mode) or stat.S_ISDIR(event.mode):
+            pending.append(event)
+        else:
+            done.append(event)
+    loop = asyncio.get_running_loop()
+    applied = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                executor, _set_acls, acls, root, pending[i::ACL_WORKERS]
+            )
+            for i in range(min(ACL_WORKERS, len(pending)))
+        )
+    )
+    for each in applied:
+        done.extend(each)
+    count = sum(len(each) for each in applied)
+    logger.info(f"set the ACLs of {count}/{len(events)} pending files")
     events.clear()
+    return done
+
+
+def _run(ctx: click.Context, root: P, acls: posix_acl.Acls) -> None:
+    with concurrent.futures.ThreadPoolExecutor(ACL_WORKERS) as executor:
+        handler = functools.partial(setacl_handler, acls, executor)
+        clock_file = ClockFile.for_root(ctx.obj["state_dir"], root)
+        coro = _watchman_loop(root, acls, handler, clock_file)
+        returncode = asyncio.run(coro, debug=ctx.obj["debug"])
+    ctx.exit(returncode)
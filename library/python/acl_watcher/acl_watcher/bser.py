@@ -0,0 +1,195 @@
+"""Encode and decode the BSER protocol spoken by the watchman server.
+
+Only what watchman sends and what we send it is supported: version 1 PDUs
+(plus the UTF-8 strings of version 2), with templates. Integers are in the
+byte order of the host, see https://facebook.github.io/watchman/docs/bser.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import struct
+
+from typing import Any
+
+MAGIC = b"\x00\x01"
+
+_ARRAY = 0x00
+_OBJECT = 0x01
+_BYTES = 0x02
+_INT8 = 0x03
+_INT16 = 0x04
+_INT32 = 0x05
+_INT64 = 0x06
+_REAL = 0x07
+_TRUE = 0x08
+_FALSE = 0x09
+_NULL = 0x0A
+_TEMPLATE = 0x0B
+_SKIP = 0x0C
+_UTF8 = 0x0D
+
+# From the smallest to the largest, the first that fits is used:
+_INTS = {
+    _INT8: struct.Struct("=b"),
+    _INT16: struct.Struct("=h"),
+    _INT32: struct.Struct("=i"),
+    _INT64: struct.Struct("=q"),
+}
+_REAL_FORMAT = struct.Struct("=d")
+
+
+class BSERError(ValueError):
+    pass
+
+
+def _encode_int(value: int, out: bytearray) -> None:
+    for tag, fmt in _INTS.items():
+        bits = fmt.size * 8
+        if -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+            out.append(tag)
+            out += fmt.pack(value)
+            return
+    raise BSERError(f"{value} does not fit in 64 bits")
+
+
+def _encode(value: Any, out: bytearray) -> None:
+    if value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif value is None:
+        out.append(_NULL)
+    elif isinstance(value, int):
+        _encode_int(value, out)
+    elif isinstance(value, float):
+        out.append(_REAL)
+        out += _REAL_FORMAT.pack(value)
+    elif isinstance(value, str):
+        _encode(value.encode("utf-8", "surrogateescape"), out)
+    elif isinstance(value, bytes):
+        out.append(_BYTES)
+        _encode_int(len(value), out)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(_ARRAY)
+        _encode_int(len(value), out)
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(_OBJECT)
+        _encode_int(len(value), out)
+        for key, item in value.items():
+            _encode(str(key), out)
+            _encode(item, out)
+    else:
+        raise BSERError(f"Cannot encode {type(value).__name__} in BSER")
+
+
+def dumps(value: Any) -> bytes:
+    """Encode ``value`` into a complete PDU."""
+
+    payload = bytearray()
+    _encode(value, payload)
+    pdu = bytearray(MAGIC)
+    _encode_int(len(payload), pdu)
+    return bytes(pdu + payload)
+
+
+class _Decoder:
+    def __init__(self, data: bytes) -> None:
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def _tag(self) -> int:
+        tag = self.data[self.offset]
+        self.offset += 1
+        return tag
+
+    def _int(self, tag: int) -> int:
+        fmt = _INTS[tag]
+        (value,) = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def int(self) -> int:
+        tag = self._tag()
+        if tag not in _INTS:
+            raise BSERError(f"Expected an integer, got type {tag:#x}")
+        return self._int(tag)
+
+    def value(self) -> Any:
+        tag = self._tag()
+        if tag in _INTS:
+            return self._int(tag)
+        if tag == _ARRAY:
+            return [self.value() for _ in range(self.int())]
+        if tag == _OBJECT:
+            return {self.value(): self.value() for _ in range(self.int())}
+        if tag in (_BYTES, _UTF8):
+            size = self.int()
+            end = self.offset + size
+            if end > len(self.data):
+                raise BSERError("Truncated string")
+            # Names are bytes on the filesystem, keep them round-tripping:
+            text = str(self.data[self.offset:end], "utf-8", "surrogateescape")
+            self.offset = end
+            return text
+        if tag == _REAL:
+            (real,) = _REAL_FORMAT.unpack_from(self.data, self.offset)
+            self.offset += _REAL_FORMAT.size
+            return real
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        if tag == _NULL:
+            return None
+        if tag == _TEMPLATE:
+            return self._template()
+        raise BSERError(f"Unknown BSER type {tag:#x}")
+
+    def _template(self) -> list[dict[str, Any]]:
+        # Watchman sends lists of files as a template: the keys once, then
+        # the values of each object, in the same order, or skip markers:
+        keys = self.value()
+        rows = []
+        for _ in range(self.int()):
+            row = {}
+            for key in keys:
+                if self.data[self.offset] == _SKIP:
+                    self.offset += 1
+                else:
+                    row[key] = self.value()
+            rows.append(row)
+        return rows
+
+
+def loads(payload: bytes) -> Any:
+    """Decode the ``payload`` of a PDU, that is without its header."""
+
+    decoder = _Decoder(payload)
+    try:
+        value = decoder.value()
+    except (IndexError, struct.error) as ex:
+        raise BSERError("Truncated BSER value") from ex
+    if decoder.offset != len(payload):
+        raise BSERError("Trailing data after the BSER value")
+    return value
+
+
+async def read(reader: asyncio.StreamReader) -> Any:
+    """Read and decode the next PDU from ``reader``.
+
+    Raises `asyncio.IncompleteReadError` at the end of the stream.
+    """
+
+    header = await reader.readexactly(len(MAGIC) + 1)
+    if header[: len(MAGIC)] != MAGIC:
+        raise BSERError(f"Unsupported BSER header {header[: len(MAGIC)]!r}")
+    tag = header[len(MAGIC)]
+    if tag not in _INTS:
+        raise BSERError(f"Expected the length of the PDU, got type {tag:#x}")
+    fmt = _INTS[tag]
+    (size,) = fmt.unpack(await reader.readexactly(fmt.size))
+    return loads(await reader.readexactly(size))
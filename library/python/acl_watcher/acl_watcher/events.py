@@ -0,0 +1,349 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import itertools
+import logging
+import os
+import stat
+import struct
+import tempfile
+
+from pathlib import Path as P
+from typing import Any, Callable, Iterable, NamedTuple, Optional, OrderedDict
+
+logger = logging.getLogger("library.python.www_acl_watcher")
+
+# inode, mode, exists, length of the name, then the name:
+_SPILLED = struct.Struct("<QIBI")
+# How much of the spilled events to read back at once, always more than a
+# record since names are at most PATH_MAX long:
+_UNSPILL_SIZE = 1 << 20
+
+
+class WatchEvent(NamedTuple):
+    file: P
+    exists: bool
+    mode: int
+    ino: int = 0
+
+    @classmethod
+    def from_file(cls, file: dict[str, Any]) -> WatchEvent:
+        return cls(
+            P(file["name"]),
+            file["exists"],
+            file.get("mode", 0),
+            file.get("ino", 0),
+        )
+
+
+def _scan(root: P, directory: P) -> tuple[list[WatchEvent], list[P]]:
+    """Stat what is in ``directory`` and list its subdirectories.
+
+    What cannot be read is left out, and logged unless it is gone.
+    """
+
+    events = []
+    subdirectories = []
+    try:
+        with os.scandir(root / directory) as it:
+            for entry in it:
+                file = directory / entry.name
+                try:
+                    info = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                except OSError as ex:
+                    logger.warning(f"could not stat {root / file}: {ex}")
+                    continue
+                events.append(WatchEvent(file, True, info.st_mode, info.st_ino))
+                if stat.S_ISDIR(info.st_mode):
+                    subdirectories.append(file)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    except OSError as ex:
+        logger.warning(f"could not list {root / directory}: {ex}")
+    return events, subdirectories
+
+
+async def crawl_into(
+    root: P,
+    events: EventBuffer,
+    workers: int,
+    subtree: P = P("."),
+) -> None:
+    """Crawl ``subtree`` of ``root`` into ``events`` like watchman would,
+    ``workers`` directories at once.
+
+    Each directory is scanned, and its entries stat'ed, in one go by a
+    thread, and the events it gives are put in the buffer together, see
+    `EventBuffer.put_crawled`.
+    """
+
+    semaphore = asyncio.Semaphore(workers)
+
+    async def scan(directory: P) -> int:
+        async with semaphore:
+            found, subdirectories = await asyncio.to_thread(_scan, root, directory)
+        await events.put_crawled(found)
+        counts = await asyncio.gather(*(scan(each) for each in subdirectories))
+        return len(found) + sum(counts)
+
+    # The root itself is not ours to change:
+    if subtree != P("."):
+        try:
+            info = await asyncio.to_thread(os.lstat, root / subtree)
+        except FileNotFoundError:
+            return
+        except OSError as ex:
+            logger.warning(f"could not stat {root / subtree}: {ex}")
+            return
+        await events.put_crawled([WatchEvent(subtree, True, info.st_mode, info.st_ino)])
+        if not stat.S_ISDIR(info.st_mode):
+            return
+    count = await scan(subtree)
+    logger.info(f"crawled {count} files in {root / subtree}")
+
+
+class RecentFiles:
+    """The files recently given the right mode and ACLs, least recent first.
+
+    A file is known by its path, inode and mode: once replaced (e.g. by a
+    rename over it) or chmod'ed by someone else it is fixed again.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._files: OrderedDict[P, tuple[int, int]] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def known(self, event: WatchEvent) -> bool:
+        """Whether ``event`` is for a file that is already right."""
+
+        if self._files.get(event.file) == (event.ino, event.mode):
+            self._files.move_to_end(event.file)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, file: P, ino: int, mode: int) -> None:
+        """Remember that ``file`` now has the right ``mode`` and ACLs."""
+
+        self._files[file] = (ino, mode)
+        self._files.move_to_end(file)
+        if len(self._files) > self._max_size:
+            self._files.popitem(last=False)
+
+    def discard(self, file: P) -> None:
+        self._files.pop(file, None)
+
+
+class EventBuffer:
+    """The events between watchman and the event handler, with flow control.
+
+    An event for a file that is already pending replaces it. When
+    ``max_pending`` events are pending, `put` waits up to ``max_wait``
+    seconds for the handler to catch up, then spills what does not fit to
+    a temporary file of up to ``max_spilled`` bytes. Past that only the
+    directories of the events are remembered, and crawled back into the
+    buffer once everything else got handled.
+
+    ``on_idle`` gets the watchman clock of the last events put in the buffer
+    when `get` is called and everything before got handled, unless the
+    buffer is held.
+    """
+
+    def __init__(
+        self,
+        root: P,
+        max_pending: int,
+        max_spilled: int,
+        max_wait: float,
+        max_batch: int,
+        max_crawls: int = 1024,
+        on_idle: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        self._root = root
+        self._max_pending = max_pending
+        self._max_spilled = max_spilled
+        self._max_wait = max_wait
+        self._max_batch = max_batch
+        self._max_crawls = max_crawls
+        self._pending: dict[P, WatchEvent] = {}
+        self._spill = tempfile.TemporaryFile(prefix="acl-watcher-")
+        self._spill_read = 0
+        self._spill_write = 0
+        self._crawls: set[P] = set()
+        self._crawler: Optional[asyncio.Task[None]] = None
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._closed = False
+        # The watchman clock of the last events put in the buffer:
+        self.clock: Any = None
+        self._on_idle = on_idle
+        self._holds = 0
+
+    def close(self) -> None:
+        """Let `get` return None once everything got handled."""
+
+        self._closed = True
+        self._not_empty.set()
+
+    def hold(self) -> None:
+        """Keep `empty` False until `release`, e.g. during a crawl."""
+
+        self._holds += 1
+
+    def release(self) -> None:
+        self._holds -= 1
+        self._not_empty.set()
+
+    def empty(self) -> bool:
+        """Whether every event put in the buffer was taken out of it."""
+
+        return (
+            not self._pending
+            and self._spill_write == self._spill_read
+            and not self._crawls
+            and self._crawler is None
+            and self._holds == 0
+        )
+
+    async def put(
+        self,
+        events: Iterable[WatchEvent],
+        clock: Any = None,
+    ) -> None:
+        if len(self._pending) >= self._max_pending:
+            try:
+                await asyncio.wait_for(self._not_full.wait(), self._max_wait)
+            except asyncio.TimeoutError:
+                pass
+        for event in events:
+            if event.file in self._pending or len(self._pending) < self._max_pending:
+                self._pending[event.file] = event
+            else:
+                self._overflow(event)
+        if len(self._pending) >= self._max_pending:
+            self._not_full.clear()
+        if self._pending:
+            self._not_empty.set()
+        if clock is not None:
+            self.clock = clock
+
+    async def put_crawled(self, events: Iterable[WatchEvent]) -> None:
+        """Put ``events`` found by a crawl, waiting for room for as long as
+        it takes instead of spilling them.
+
+        Unlike watchman a crawl can be paused, and what it overflowed would
+        only get crawled again.
+        """
+
+        for event in events:
+            while (
+                event.file not in self._pending
+                and len(self._pending) >= self._max_pending
+            ):
+                self._not_full.clear()
+                await self._not_full.wait()
+            self._pending[event.file] = event
+            self._not_empty.set()
+        if len(self._pending) >= self._max_pending:
+            self._not_full.clear()
+
+    def _overflow(self, event: WatchEvent) -> None:
+        name = os.fsencode(event.file)
+        record = _SPILLED.pack(event.ino, event.mode, event.exists, len(name))
+        record += name
+        if self._spill_write + len(record) <= self._max_spilled:
+            if self._spill_write == 0:
+                logger.warning("Too many pending events, spilling them to disk")
+            os.pwrite(self._spill.fileno(), record, self._spill_write)
+            self._spill_write += len(record)
+            self._not_empty.set()
+            return
+        if not self._crawls:
+            logger.warning("Too many spilled events, will crawl their directories")
+        if len(self._crawls) < self._max_crawls:
+            self._crawls.add(event.file.parent)
+        else:
+            self._crawls = {P(".")}
+        self._not_empty.set()
+
+    def _unspill(self) -> list[WatchEvent]:
+        size = min(self._spill_write - self._spill_read, _UNSPILL_SIZE)
+        data = os.pread(self._spill.fileno(), size, self._spill_read)
+        events: list[WatchEvent] = []
+        offset = 0
+        while offset + _SPILLED.size <= len(data) and len(events) < self._max_batch:
+            ino, mode, exists, length = _SPILLED.unpack_from(data, offset)
+            end = offset + _SPILLED.size + length
+            if end > len(data):
+                break
+            name = os.fsdecode(data[offset + _SPILLED.size:end])
+            events.append(WatchEvent(P(name), bool(exists), mode, ino))
+            offset = end
+        self._spill_read += offset
+        if self._spill_read == self._spill_write:
+            self._spill.truncate(0)
+            self._spill_read = self._spill_write = 0
+        return events
+
+    async def _crawl(self) -> None:
+        # Crawling a directory covers everything under it:
+        subtrees: list[P] = []
+        for subtree in sorted(self._crawls, key=lambda path: len(path.parts)):
+            if not any(parent in subtrees for parent in subtree.parents):
+                subtrees.append(subtree)
+        self._crawls.clear()
+        logger.info(f"catching up on {len(subtrees)} overflowed directories")
+        try:
+            for subtree in subtrees:
+                await crawl_into(self._root, self, workers=1, subtree=subtree)
+        finally:
+            self._crawler = None
+            self._not_empty.set()
+
+    def get_nowait(self) -> Optional[list[WatchEvent]]:
+        """Get the next batch of events, empty if there is none.
+
+        Returns None once closed and everything got handled.
+        """
+
+        if self._pending:
+            count = min(len(self._pending), self._max_batch)
+            files = list(itertools.islice(self._pending, count))
+            batch = [self._pending.pop(file) for file in files]
+            if len(self._pending) < self._max_pending:
+                self._not_full.set()
+            return batch
+        if self._spill_write > self._spill_read:
+            return self._unspill()
+        if self._closed and not self._crawls and self._crawler is None:
+            return None
+        self._not_empty.clear()
+        return []
+
+    async def get(self) -> Optional[list[WatchEvent]]:
+        """Wait for the next batch of events, see `get_nowait`.
+
+        Only call it once the previous batches got handled.
+        """
+
+        while True:
+            batch = self.get_nowait()
+            if batch is None or batch:
+                return batch
+            if self._crawls and self._crawler is None:
+                # Anything pending got handled, including the spilled events,
+                # the crawl puts what it finds back through `put`:
+                self._crawler = asyncio.create_task(self._crawl())
+            if self._on_idle is not None and self.empty():
+                self._on_idle(self.clock)
+            await self._not_empty.wait()
@@ -0,0 +1,164 @@
+"""Set POSIX ACLs in-process, through the xattrs Linux keeps them in.
+
+This is what setfacl(1) does under the hood, minus the fork and exec. The
+xattrs hold a version 2 header followed by one little-endian (tag, perm, id)
+entry per ACL entry, sorted by tag then id, see linux/posix_acl_xattr.h.
+
+Like `setfacl -m` the entries of other users and groups already in an ACL are
+kept, but its mask is always replaced: that way the mode of a file only
+depends on the ACLs we give it, which `RecentFiles` relies on.
+"""
+
+from __future__ import annotations
+
+import errno
+import grp
+import os
+import struct
+
+from typing import Iterable, Mapping, NamedTuple, Optional
+
+ACCESS_XATTR = "system.posix_acl_access"
+DEFAULT_XATTR = "system.posix_acl_default"
+
+READ = 0o4
+WRITE = 0o2
+EXECUTE = 0o1
+
+_VERSION = 2
+_HEADER = struct.Struct("<I")
+_ENTRY = struct.Struct("<HHI")
+_USER_OBJ = 0x01
+_USER = 0x02
+_GROUP_OBJ = 0x04
+_GROUP = 0x08
+_MASK = 0x10
+_OTHER = 0x20
+_UNDEFINED_ID = 0xFFFFFFFF
+
+
+def gid(group: str) -> int:
+    """Resolve a group name, or a numeric gid, to a gid."""
+
+    if group.isdigit():
+        return int(group)
+    return grp.getgrnam(group).gr_gid
+
+
+def encode(entries: Iterable[tuple[int, int, int]]) -> bytes:
+    blob = bytearray(_HEADER.pack(_VERSION))
+    for tag, perm, id in sorted(entries):
+        blob += _ENTRY.pack(tag, perm, id)
+    return bytes(blob)
+
+
+def decode(acl: bytes) -> list[tuple[int, int, int]]:
+    """The (tag, perm, id) entries of ``acl``, raises ValueError if invalid."""
+
+    if len(acl) < _HEADER.size or (len(acl) - _HEADER.size) % _ENTRY.size:
+        raise ValueError(f"Invalid ACL size {len(acl)}")
+    (version,) = _HEADER.unpack_from(acl)
+    if version != _VERSION:
+        raise ValueError(f"Unsupported ACL version {version}")
+    return list(_ENTRY.iter_unpack(acl[_HEADER.size:]))
+
+
+def merge(acl: bytes, existing: bytes) -> bytes:
+    """``acl`` plus the entries of ``existing`` for other users and groups.
+
+    Entries of ``acl`` replace the ones of ``existing`` for the same tag and
+    id, and its mask is kept.
+    """
+
+    entries = decode(acl)
+    replaced = {(tag, id) for tag, _, id in entries}
+    kept = [
+        (tag, perm, id)
+        for tag, perm, id in decode(existing)
+        if tag in (_USER, _GROUP) and (tag, id) not in replaced
+    ]
+    return encode(entries + kept) if kept else acl
+
+
+def from_mode(
+    mode: int,
+    groups: Mapping[int, int],
+    group_obj: Optional[int] = None,
+    mask: Optional[int] = None,
+) -> bytes:
+    """The ACL of a file with ``mode`` plus the perms of named ``groups``.
+
+    Like `setfacl -m`, ``group_obj`` overrides the group bits of ``mode`` and
+    the mask defaults to the union of the perms of the group entries.
+    """
+
+    if group_obj is None:
+        group_obj = (mode >> 3) & 0o7
+    if mask is None:
+        mask = group_obj
+        for perm in groups.values():
+            mask |= perm
+    entries = [
+        (_USER_OBJ, (mode >> 6) & 0o7, _UNDEFINED_ID),
+        (_GROUP_OBJ, group_obj, _UNDEFINED_ID),
+        (_MASK, mask, _UNDEFINED_ID),
+        (_OTHER, mode & 0o7, _UNDEFINED_ID),
+    ]
+    entries.extend((_GROUP, perm, id) for id, perm in groups.items())
+    return encode(entries)
+
+
+def mode(acl: bytes) -> int:
+    """The permission bits stat(2) reports for a file with the ``acl``."""
+
+    perms = {}
+    for tag, perm, _ in _ENTRY.iter_unpack(acl[_HEADER.size:]):
+        perms[tag] = perm
+    group = perms.get(_MASK, perms[_GROUP_OBJ])
+    return perms[_USER_OBJ] << 6 | group << 3 | perms[_OTHER]
+
+
+class Acls(NamedTuple):
+    """The ACLs to give to files and directories, encoded once."""
+
+    file: bytes
+    # The access ACL of directories, which is also their default ACL so that
+    # what gets created in them starts with the right ACL:
+    directory: bytes
+
+    @property
+    def file_mode(self) -> int:
+        return mode(self.file)
+
+    @property
+    def directory_mode(self) -> int:
+        return mode(self.directory)
+
+    def apply(self, path: bytes, is_directory: bool) -> None:
+        """Merge the ACLs into the ones of ``path``, which must not be a
+        symlink, see `merge`.
+        """
+
+        if is_directory:
+            _merge_xattr(path, ACCESS_XATTR, self.directory)
+            _merge_xattr(path, DEFAULT_XATTR, self.directory)
+        else:
+            _merge_xattr(path, ACCESS_XATTR, self.file)
+
+
+def _merge_xattr(path: bytes, name: str, acl: bytes) -> None:
+    try:
+        existing = os.getxattr(path, name, follow_symlinks=False)
+    except OSError as ex:
+        # No ACL beyond the mode yet:
+        if ex.errno != errno.ENODATA:
+            raise
+    else:
+        try:
+            acl = merge(acl, existing)
+        except ValueError:
+            # Replace what the kernel should not have let in:
+            pass
+        if existing == acl:
+            return
+    os.setxattr(path, name, acl, follow_symlinks=False)
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+
+from pathlib import Path as P
+from typing import Any, Optional
+
+logger = logging.getLogger("library.python.www_acl_watcher")
+
+
+class ClockFile:
+    """Where the watchman clock up to which every change got handled is kept.
+
+    On start the watcher subscribes since that clock so that it catches up on
+    what changed while it was down. Without a ``path`` nothing is kept.
+    """
+
+    def __init__(self, path: Optional[P]) -> None:
+        self.path = path
+        self._saved: Any = None
+
+    @classmethod
+    def for_root(cls, state_dir: Optional[P], root: P) -> ClockFile:
+        if state_dir is None:
+            return cls(None)
+        # One file per watched directory, like systemd-escape --path does:
+        name = str(root.resolve()).strip("/").replace("/", "-") or "-"
+        return cls(state_dir / f"{name}.clock")
+
+    def load(self) -> Any:
+        if self.path is None:
+            return None
+        try:
+            self._saved = json.loads(self.path.read_bytes())["clock"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            logger.warning(f"Ignoring invalid clock file {self.path}: {ex}")
+            return None
+        return self._saved
+
+    def save(self, clock: Any) -> None:
+        # Called each time the watcher catches up, which is rare enough:
+        if self.path is None or clock is None or clock == self._saved:
+            return
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps({"clock": clock}))
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            logger.warning(f"Could not save the clock to {self.path}: {ex}")
+            return
+        self._saved = clock
@@ -0,0 +1,97 @@
+"""An asyncio client for the watchman server, over its unix socket in BSER."""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import json
+import os
+
+from typing import Any, Optional
+
+from . import bser
+
+
+class WatchmanError(Exception):
+    pass
+
+
+async def sockname() -> str:
+    """Find the socket of the watchman server, like its own clients do."""
+
+    path = os.environ.get("WATCHMAN_SOCK")
+    if path:
+        return path
+    watchman = await asyncio.create_subprocess_exec(
+        "watchman",
+        "--no-pretty",
+        "get-sockname",
+        stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await watchman.communicate()
+    if watchman.returncode != 0:
+        raise WatchmanError(f"watchman get-sockname exited {watchman.returncode}")
+    try:
+        return json.loads(stdout)["sockname"]
+    except (ValueError, KeyError) as ex:
+        raise WatchmanError(f"Unexpected watchman get-sockname output: {ex}")
+
+
+class Client:
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self._reader = reader
+        self._writer = writer
+        # Subscription PDUs received while waiting for the response to a
+        # command:
+        self._unilateral: collections.deque[dict[str, Any]] = (
+            collections.deque()
+        )
+
+    @classmethod
+    async def connect(cls, path: Optional[str] = None) -> Client:
+        if path is None:
+            path = await sockname()
+        reader, writer = await asyncio.open_unix_connection(path)
+        return cls(reader, writer)
+
+    async def close(self) -> None:
+        self._writer.close()
+        await self._writer.wait_closed()
+
+    async def _read(self) -> dict[str, Any]:
+        pdu = await bser.read(self._reader)
+        if not isinstance(pdu, dict):
+            raise WatchmanError(f"Unexpected PDU from watchman: {pdu!r}")
+        if "error" in pdu:
+            raise WatchmanError(pdu["error"])
+        return pdu
+
+    async def command(self, *args: Any) -> dict[str, Any]:
+        """Send a command (e.g. "watch-project") and return its response."""
+
+        self._writer.write(bser.dumps(list(args)))
+        await self._writer.drain()
+        while True:
+            pdu = await self._read()
+            if pdu.get("unilateral"):
+                self._unilateral.append(pdu)
+                continue
+            return pdu
+
+    async def subscription(self) -> dict[str, Any]:
+        """Wait for the next PDU of a subscription.
+
+        Raises `asyncio.IncompleteReadError` if watchman went away.
+        """
+
+        while True:
+            if self._unilateral:
+                pdu = self._unilateral.popleft()
+            else:
+                pdu = await self._read()
+            if "subscription" in pdu:
+                return pdu
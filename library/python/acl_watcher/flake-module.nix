@@ -8,7 +8,6 @@
           pname = "acl-watcher";
           src = ./.;
           version = "1.0.0-rc.1";
-          doCheck = false;
           pyproject = true;
 
           build-system = [
@@ -18,11 +17,10 @@
 
           dependencies = [
             click
-            pywatchman
           ];
 
-          propagatedBuildInputs = with pkgs; [
-            acl
+          nativeCheckInputs = [
+            pytestCheckHook
           ];
         };
     };
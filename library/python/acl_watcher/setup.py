@@ -14,7 +14,6 @@ setuptools.setup(
     entry_points={
         "console_scripts": [
             "acl-watcher = acl_watcher.__main__:main",
-            "watchman-wait = acl_watcher.watchman_wait:main",
         ],
     },
 )
@@ -0,0 +1,155 @@
+import asyncio
+import pytest
+import struct
+
+from acl_watcher import bser
+
+
+def _pdu(payload: bytes) -> bytes:
+    return bser.MAGIC + b"\x03" + bytes([len(payload)]) + payload
+
+
+@pytest.mark.parametrize(
+    "value, encoded",
+    [
+        (0, b"\x03\x00"),
+        (-128, b"\x03\x80"),
+        (127, b"\x03\x7f"),
+        (128, b"\x04" + struct.pack("=h", 128)),
+        (-129, b"\x04" + struct.pack("=h", -129)),
+        (32768, b"\x05" + struct.pack("=i", 32768)),
+        (-(2**31), b"\x05" + struct.pack("=i", -(2**31))),
+        (2**31, b"\x06" + struct.pack("=q", 2**31)),
+        (2**63 - 1, b"\x06" + struct.pack("=q", 2**63 - 1)),
+    ],
+)
+def test_ints(value: int, encoded: bytes) -> None:
+    pdu = bser.dumps(value)
+    assert pdu == _pdu(encoded)
+    assert bser.loads(pdu[4:]) == value
+
+
+def test_int_too_large() -> None:
+    with pytest.raises(bser.BSERError):
+        _ = bser.dumps(2**63)
+
+
+def test_decode_wider_ints() -> None:
+    # Watchman does not always use the smallest integer that fits:
+    assert bser.loads(b"\x06" + struct.pack("=q", 1)) == 1
+    assert bser.loads(b"\x00\x05" + struct.pack("=i", 1) + b"\x04\x02\x00") == [2]
+
+
+def test_strings() -> None:
+    assert bser.dumps("été") == _pdu(b"\x02\x03\x05" + "été".encode())
+    assert bser.dumps(b"\xff") == _pdu(b"\x02\x03\x01\xff")
+    # Both kinds of strings are decoded, names that are not UTF-8 included:
+    assert bser.loads(b"\x02\x03\x05" + "été".encode()) == "été"
+    assert bser.loads(b"\x0d\x03\x05" + "été".encode()) == "été"
+    name = bser.loads(b"\x02\x03\x01\xff")
+    assert name == "\udcff"
+    assert bser.dumps(name) == _pdu(b"\x02\x03\x01\xff")
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        [],
+        [1, 2, 3],
+        {"version": "2024.01.01.00", "capabilities": {}},
+        ["subscribe", "/stash", "sub", {"expression": ["true"], "since": None}],
+        {"real": 0.5, "yes": True, "no": False, "nested": [[{"a": [-1]}]]},
+    ],
+)
+def test_round_trip(value: object) -> None:
+    pdu = bser.dumps(value)
+    assert pdu[:2] == bser.MAGIC
+    assert bser.loads(pdu[4:]) == value
+
+
+def test_tuples_are_arrays() -> None:
+    assert bser.dumps(("clock", "/stash")) == bser.dumps(["clock", "/stash"])
+
+
+def test_cannot_encode() -> None:
+    with pytest.raises(bser.BSERError, match="set"):
+        _ = bser.dumps({1, 2})
+
+
+def test_template() -> None:
+    # The example from the BSER documentation:
+    payload = (
+        b"\x0b"
+        + b"\x00\x03\x02"  # two keys:
+        + b"\x02\x03\x04name"
+        + b"\x02\x03\x03age"
+        + b"\x03\x03"  # three objects:
+        + b"\x02\x03\x04fred\x03\x14"
+        + b"\x02\x03\x04pete\x03\x1e"
+        + b"\x0c\x03\x19"  # skips the name
+    )
+    assert bser.loads(payload) == [
+        {"name": "fred", "age": 20},
+        {"name": "pete", "age": 30},
+        {"age": 25},
+    ]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        b"",
+        b"\x03",
+        b"\x05\x00\x00",
+        b"\x00\x03\x02\x03\x01",
+        b"\x02\x03\x05abc",
+        b"\x01\x03\x01\x02\x03\x01a",
+        b"\x0b\x00\x03\x01\x02\x03\x01a\x03\x02\x03\x01",
+    ],
+)
+def test_truncated(payload: bytes) -> None:
+    with pytest.raises(bser.BSERError):
+        _ = bser.loads(payload)
+
+
+def test_invalid() -> None:
+    with pytest.raises(bser.BSERError, match="Trailing"):
+        _ = bser.loads(b"\x03\x01\x03\x02")
+    with pytest.raises(bser.BSERError, match="Unknown"):
+        _ = bser.loads(b"\x42")
+    with pytest.raises(bser.BSERError, match="integer"):
+        _ = bser.loads(b"\x00\x0a")
+
+
+def test_read() -> None:
+    async def read(*chunks: bytes) -> list[object]:
+        stream = asyncio.StreamReader()
+        for chunk in chunks:
+            stream.feed_data(chunk)
+        stream.feed_eof()
+        values = []
+        while True:
+            try:
+                values.append(await bser.read(stream))
+            except asyncio.IncompleteReadError:
+                return values
+
+    pdus = bser.dumps({"clock": "c:0:1"}) + bser.dumps([1] * 300)
+    # However the stream gets cut:
+    chunks = [pdus[i : i + 7] for i in range(0, len(pdus), 7)]
+    assert asyncio.run(read(*chunks)) == [{"clock": "c:0:1"}, [1] * 300]
+    # A PDU cut short is an incomplete read, not a decoding error:
+    assert asyncio.run(read(pdus[:-1])) == [{"clock": "c:0:1"}]
+
+
+def test_read_invalid_header() -> None:
+    async def read(data: bytes) -> object:
+        stream = asyncio.StreamReader()
+        stream.feed_data(data)
+        stream.feed_eof()
+        return await bser.read(stream)
+
+    with pytest.raises(bser.BSERError, match="header"):
+        _ = asyncio.run(read(b"\x00\x02\x03\x00"))
+    with pytest.raises(bser.BSERError, match="length"):
+        _ = asyncio.run(read(b"\x00\x01\x02\x00"))
@@ -0,0 +1,344 @@
+import asyncio
+import concurrent.futures
+import os
+import pytest
+import stat
+
+from pathlib import Path as P
+from typing import Any, Optional
+
+from acl_watcher import events as events_module
+from acl_watcher import posix_acl
+from acl_watcher.__main__ import _crawled, setacl_handler
+from acl_watcher.events import EventBuffer, RecentFiles, WatchEvent, crawl_into
+
+FILE = stat.S_IFREG | 0o644
+
+
+def _event(name: str, mode: int = FILE, exists: bool = True) -> WatchEvent:
+    return WatchEvent(P(name), exists, mode, ino=len(name))
+
+
+def _buffer(root: P, **kwargs: Any) -> EventBuffer:
+    limits: dict[str, Any] = {
+        "max_pending": 100,
+        "max_spilled": 1 << 20,
+        "max_wait": 0.0,
+        "max_batch": 10,
+    }
+    return EventBuffer(root, **(limits | kwargs))
+
+
+async def _drain(events: EventBuffer) -> list[WatchEvent]:
+    """Everything in ``events``, once closed."""
+
+    events.close()
+    drained = []
+    while (batch := await events.get()) is not None:
+        drained.extend(batch)
+    return drained
+
+
+def test_coalesce(tmp_path: P) -> None:
+    async def run() -> list[WatchEvent]:
+        events = _buffer(tmp_path)
+        await events.put([_event("a"), _event("b")])
+        await events.put([_event("a", mode=FILE | 0o020), _event("b", exists=False)])
+        return await _drain(events)
+
+    assert asyncio.run(run()) == [
+        _event("a", mode=FILE | 0o020),
+        _event("b", exists=False),
+    ]
+
+
+def test_batches(tmp_path: P) -> None:
+    async def run() -> list[list[WatchEvent]]:
+        events = _buffer(tmp_path, max_batch=3)
+        await events.put(_event(str(i)) for i in range(7))
+        batches = []
+        while batch := events.get_nowait():
+            batches.append(batch)
+        assert events.empty()
+        return batches
+
+    assert [len(batch) for batch in asyncio.run(run())] == [3, 3, 1]
+
+
+def test_wait_for_room(tmp_path: P) -> None:
+    async def run() -> tuple[list[WatchEvent], bool]:
+        events = _buffer(tmp_path, max_pending=2, max_batch=1, max_wait=60.0)
+        await events.put([_event("a"), _event("b")])
+        put = asyncio.create_task(events.put([_event("c")]))
+        await asyncio.sleep(0)
+        waited = not put.done()
+        # Taking one event out makes room:
+        taken = await events.get()
+        assert taken is not None
+        await put
+        return taken + await _drain(events), waited
+
+    handled, waited = asyncio.run(run())
+    assert waited
+    assert handled == [_event("a"), _event("b"), _event("c")]
+
+
+def test_spill(tmp_path: P) -> None:
+    async def run() -> list[WatchEvent]:
+        events = _buffer(tmp_path, max_pending=3, max_batch=2)
+        await events.put(_event(f"file-{i}") for i in range(10))
+        # A name that is not UTF-8 makes it through the spill file too:
+        await events.put([_event("caf\udce9", mode=stat.S_IFDIR | 0o755)])
+        assert not events.empty()
+        return await _drain(events)
+
+    handled = asyncio.run(run())
+    expected = [_event(f"file-{i}") for i in range(10)]
+    expected.append(_event("caf\udce9", mode=stat.S_IFDIR | 0o755))
+    assert handled == expected
+
+
+def test_spill_is_reused(tmp_path: P) -> None:
+    async def run() -> None:
+        events = _buffer(tmp_path, max_pending=1, max_batch=100, max_spilled=200)
+        for round in range(20):
+            await events.put(_event(f"{round}-{i}") for i in range(4))
+            handled = []
+            while batch := events.get_nowait():
+                handled.extend(batch)
+            # Had the spill file not been truncated it would be full by now:
+            assert handled == [_event(f"{round}-{i}") for i in range(4)]
+            assert events.empty()
+
+    asyncio.run(run())
+
+
+def test_crawl_what_does_not_fit(tmp_path: P) -> None:
+    for directory in ("photos/2024", "photos/2025", "music"):
+        (tmp_path / directory).mkdir(parents=True)
+        for i in range(3):
+            (tmp_path / directory / f"{i}.jpg").touch()
+
+    async def run() -> list[WatchEvent]:
+        events = _buffer(tmp_path, max_pending=1, max_spilled=0)
+        await events.put(
+            [
+                _event("music/0.jpg"),
+                _event("photos/2024/0.jpg"),
+                _event("photos/2025/1.jpg"),
+                _event("photos/2025"),
+            ]
+        )
+        return await _drain(events)
+
+    handled = {event.file for event in asyncio.run(run())}
+    # music/0.jpg fit, the others were remembered as their directories:
+    assert P("music/0.jpg") in handled
+    assert P("music/1.jpg") not in handled
+    assert {
+        P(f"photos/{year}/{i}.jpg") for year in (2024, 2025) for i in range(3)
+    } <= handled
+    # photos got crawled, which covered photos/2024 and photos/2025:
+    assert P("photos/2024") in handled
+
+
+def test_crawl_everything_past_max_crawls(tmp_path: P) -> None:
+    for directory in ("a", "b", "c"):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "file").touch()
+
+    async def run() -> list[WatchEvent]:
+        events = _buffer(tmp_path, max_pending=1, max_spilled=0, max_crawls=1)
+        await events.put(
+            [_event("first"), _event("a/file"), _event("b/file"), _event("c/file")]
+        )
+        return await _drain(events)
+
+    handled = {event.file for event in asyncio.run(run())}
+    assert handled == {
+        P("first"),
+        *(P(directory) for directory in ("a", "b", "c")),
+        *(P(directory) / "file" for directory in ("a", "b", "c")),
+    }
+
+
+def test_on_idle(tmp_path: P) -> None:
+    idle: list[Any] = []
+
+    async def run() -> None:
+        events = _buffer(tmp_path, on_idle=idle.append)
+
+        async def get() -> Optional[list[WatchEvent]]:
+            return await asyncio.wait_for(events.get(), 0.1)
+
+        await events.put([_event("a")], "c:1:1")
+        assert await get() == [_event("a")]
+        # Once the batch got handled:
+        get_task = asyncio.create_task(get())
+        await asyncio.sleep(0)
+        assert idle == ["c:1:1"]
+
+        # Not while held, e.g. by a crawl:
+        events.hold()
+        await events.put([_event("b")], "c:1:2")
+        assert await get_task == [_event("b")]
+        get_task = asyncio.create_task(get())
+        await asyncio.sleep(0)
+        assert idle == ["c:1:1"]
+        assert not events.empty()
+        events.release()
+        await asyncio.sleep(0)
+        assert idle == ["c:1:1", "c:1:2"]
+        assert events.empty()
+
+        events.close()
+        assert await get_task is None
+
+    asyncio.run(run())
+
+
+def test_recent_files() -> None:
+    recent_files = RecentFiles(max_size=2)
+    a = _event("a")
+    assert not recent_files.known(a)
+    recent_files.add(a.file, a.ino, a.mode)
+    assert recent_files.known(a)
+    # Replaced by another file, or chmod'ed by someone else:
+    assert not recent_files.known(a._replace(ino=a.ino + 1))
+    assert not recent_files.known(a._replace(mode=FILE | 0o777))
+    assert (recent_files.hits, recent_files.misses) == (1, 3)
+
+    recent_files.discard(a.file)
+    assert not recent_files.known(a)
+    recent_files.discard(a.file)
+    assert len(recent_files) == 0
+
+
+def test_recent_files_evicts_the_least_recent() -> None:
+    recent_files = RecentFiles(max_size=2)
+    a, b, c = _event("a"), _event("b"), _event("c")
+    for event in (a, b):
+        recent_files.add(event.file, event.ino, event.mode)
+    # Known files are used again:
+    assert recent_files.known(a)
+    recent_files.add(c.file, c.ino, c.mode)
+    assert len(recent_files) == 2
+    assert recent_files.known(a)
+    assert recent_files.known(c)
+    assert not recent_files.known(b)
+
+
+def _unreadable(monkeypatch: pytest.MonkeyPatch, unreadable: P) -> None:
+    scandir = os.scandir
+
+    def scandir_or_fail(path: P) -> Any:
+        if P(path) == unreadable:
+            raise PermissionError(13, "Permission denied", str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(events_module.os, "scandir", scandir_or_fail)
+
+
+def test_crawl_into(tmp_path: P, monkeypatch: pytest.MonkeyPatch) -> None:
+    for i in range(5):
+        (tmp_path / f"{i}" / "sub").mkdir(parents=True)
+        (tmp_path / f"{i}" / "sub" / "file").touch()
+    _unreadable(monkeypatch, tmp_path / "3" / "sub")
+
+    async def run() -> list[WatchEvent]:
+        events = _buffer(tmp_path)
+        await crawl_into(tmp_path, events, workers=2)
+        return await _drain(events)
+
+    crawled = {event.file for event in asyncio.run(run())}
+    expected = {P(f"{i}/sub/file") for i in range(5) if i != 3}
+    expected |= {P(f"{i}") for i in range(5)} | {P(f"{i}/sub") for i in range(5)}
+    assert crawled == expected
+
+
+def test_crawl_subtree(tmp_path: P) -> None:
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "b" / "file").touch()
+    (tmp_path / "c").touch()
+
+    async def run(subtree: P) -> set[P]:
+        events = _buffer(tmp_path)
+        await crawl_into(tmp_path, events, workers=1, subtree=subtree)
+        return {event.file for event in await _drain(events)}
+
+    assert asyncio.run(run(P("a/b"))) == {P("a/b"), P("a/b/file")}
+    assert asyncio.run(run(P("c"))) == {P("c")}
+    assert asyncio.run(run(P("missing"))) == set()
+
+
+def test_crawl_waits_for_room(tmp_path: P) -> None:
+    for i in range(20):
+        (tmp_path / f"{i}").touch()
+
+    async def run() -> list[WatchEvent]:
+        events = _buffer(tmp_path, max_pending=3, max_spilled=0, max_batch=2)
+
+        async def crawl() -> None:
+            await crawl_into(tmp_path, events, workers=1)
+            events.close()
+
+        crawl_task = asyncio.create_task(crawl())
+        handled = []
+        while (batch := await asyncio.wait_for(events.get(), 1)) is not None:
+            handled.extend(batch)
+            assert len(events._pending) <= 3
+        await crawl_task
+        return handled
+
+    # Nothing was spilled, or left to crawl again:
+    handled = asyncio.run(run())
+    assert sorted(event.file.name for event in handled) == sorted(
+        f"{i}" for i in range(20)
+    )
+
+
+@pytest.mark.parametrize("outcome", ["completed", "failed", "cancelled"])
+def test_crawled(tmp_path: P, outcome: str) -> None:
+    idle: list[Any] = []
+
+    async def run() -> None:
+        events = _buffer(tmp_path, on_idle=idle.append)
+        events.clock = "c:1:1"
+        events.hold()
+
+        async def crawl() -> None:
+            if outcome == "failed":
+                raise OSError("Input/output error")
+            await asyncio.sleep(0 if outcome == "completed" else 60)
+
+        task = asyncio.create_task(crawl())
+        task.add_done_callback(lambda task: _crawled(events, task))
+        await asyncio.sleep(0)
+        if outcome == "cancelled":
+            _ = task.cancel()
+        await asyncio.wait([task])
+        get = asyncio.create_task(events.get())
+        await asyncio.sleep(0)
+        _ = get.cancel()
+
+    asyncio.run(run())
+    # The clock is only saved once the crawl got everything:
+    assert idle == (["c:1:1"] if outcome == "completed" else [])
+
+
+def test_setacl_handler(tmp_path: P, monkeypatch: pytest.MonkeyPatch) -> None:
+    def merge_xattr(path: bytes, name: str, acl: bytes) -> None:
+        if path.endswith(b"denied"):
+            raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr(posix_acl, "_merge_xattr", merge_xattr)
+    acls = posix_acl.Acls(file=b"", directory=b"")
+    link = _event("link", stat.S_IFLNK | 0o777)
+    pending = [_event("file"), _event("denied"), link]
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        done = asyncio.run(setacl_handler(acls, executor, tmp_path, pending))
+
+    # What failed is not done, so that it is not taken for a recent file:
+    assert sorted(done) == [_event("file"), link]
+    assert pending == []
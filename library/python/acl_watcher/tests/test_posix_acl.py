@@ -0,0 +1,119 @@
+import errno
+import os
+import pytest
+import stat
+
+from pathlib import Path
+
+from acl_watcher import posix_acl
+
+WWW_DATA = 33
+FAMILY = 1000
+
+# What `getfattr -e hex -n system.posix_acl_access` prints once `setfacl -m
+# group:33:r` ran on a file with mode 0644:
+WWW_FILE = bytes.fromhex(
+    "02000000"
+    "01000600ffffffff"  # user::rw-
+    "04000400ffffffff"  # group::r--
+    "0800040021000000"  # group:33:r--
+    "10000400ffffffff"  # mask::r--
+    "20000400ffffffff"  # other::r--
+)
+# And once `setfacl -m group::rw,group:1000:rw,mask::rw` ran on a directory
+# with mode 0755:
+GOINFRE_DIRECTORY = bytes.fromhex(
+    "02000000"
+    "01000700ffffffff"  # user::rwx
+    "04000600ffffffff"  # group::rw-
+    "08000600e8030000"  # group:1000:rw-
+    "10000600ffffffff"  # mask::rw-
+    "20000500ffffffff"  # other::r-x
+)
+# user:1001:rwx, group:33:rw-, then the base entries of a 0640 file:
+OTHERS = bytes.fromhex(
+    "02000000"
+    "01000600ffffffff"  # user::rw-
+    "02000700e9030000"  # user:1001:rwx
+    "04000400ffffffff"  # group::r--
+    "0800060021000000"  # group:33:rw-
+    "10000700ffffffff"  # mask::rwx
+    "20000000ffffffff"  # other::---
+)
+
+
+def test_from_mode() -> None:
+    www = posix_acl.from_mode(0o644, {WWW_DATA: posix_acl.READ})
+    assert www == WWW_FILE
+    assert posix_acl.mode(www) == 0o644
+
+    read_write = posix_acl.READ | posix_acl.WRITE
+    goinfre = posix_acl.from_mode(0o755, {FAMILY: read_write}, read_write, read_write)
+    assert goinfre == GOINFRE_DIRECTORY
+    assert posix_acl.mode(goinfre) == 0o765
+
+
+def test_decode() -> None:
+    assert posix_acl.decode(WWW_FILE)[2] == (0x08, posix_acl.READ, WWW_DATA)
+    assert posix_acl.encode(posix_acl.decode(OTHERS)) == OTHERS
+    for invalid in (b"", WWW_FILE[:-1], b"\x01" + WWW_FILE[1:]):
+        with pytest.raises(ValueError):
+            _ = posix_acl.decode(invalid)
+
+
+def test_merge() -> None:
+    merged = posix_acl.merge(WWW_FILE, OTHERS)
+    # The entry for 33 and the base entries are replaced, the mask too:
+    assert merged == bytes.fromhex(
+        "02000000"
+        "01000600ffffffff"  # user::rw-
+        "02000700e9030000"  # user:1001:rwx
+        "04000400ffffffff"  # group::r--
+        "0800040021000000"  # group:33:r--
+        "10000400ffffffff"  # mask::r--
+        "20000400ffffffff"  # other::r--
+    )
+    assert posix_acl.mode(merged) == posix_acl.mode(WWW_FILE)
+    assert posix_acl.merge(WWW_FILE, WWW_FILE) == WWW_FILE
+    assert posix_acl.merge(WWW_FILE, GOINFRE_DIRECTORY) == posix_acl.encode(
+        posix_acl.decode(WWW_FILE) + [(0x08, 0o6, FAMILY)]
+    )
+
+
+def _acl(path: Path, name: str) -> bytes | None:
+    try:
+        return os.getxattr(path, name, follow_symlinks=False)
+    except OSError as ex:
+        if ex.errno == errno.ENODATA:
+            return None
+        raise
+
+
+def test_apply(tmp_path: Path) -> None:
+    acls = posix_acl.Acls(
+        file=WWW_FILE,
+        directory=posix_acl.from_mode(0o755, {WWW_DATA: posix_acl.READ}),
+    )
+    file = tmp_path / "file"
+    file.touch(mode=0o644)
+    directory = tmp_path / "directory"
+    directory.mkdir()
+    try:
+        acls.apply(bytes(file), is_directory=False)
+    except OSError as ex:
+        if ex.errno == errno.EOPNOTSUPP:
+            pytest.skip(f"{tmp_path} does not support ACLs")
+        raise
+    acls.apply(bytes(directory), is_directory=True)
+    assert _acl(file, posix_acl.ACCESS_XATTR) == WWW_FILE
+    assert _acl(file, posix_acl.DEFAULT_XATTR) is None
+    assert _acl(directory, posix_acl.ACCESS_XATTR) == acls.directory
+    assert _acl(directory, posix_acl.DEFAULT_XATTR) == acls.directory
+    assert stat.S_IMODE(file.stat().st_mode) == acls.file_mode
+    assert stat.S_IMODE(directory.stat().st_mode) == acls.directory_mode
+
+    # Someone gave access to someone else:
+    os.setxattr(file, posix_acl.ACCESS_XATTR, OTHERS)
+    acls.apply(bytes(file), is_directory=False)
+    assert _acl(file, posix_acl.ACCESS_XATTR) == posix_acl.merge(WWW_FILE, OTHERS)
+    assert stat.S_IMODE(file.stat().st_mode) == acls.file_mode
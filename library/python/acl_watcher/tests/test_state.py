@@ -0,0 +1,66 @@
+import logging
+import pytest
+
+from pathlib import Path as P
+
+from acl_watcher.state import ClockFile
+
+
+def test_for_root(tmp_path: P) -> None:
+    assert ClockFile.for_root(None, tmp_path).path is None
+    root = tmp_path / "stash" / "goinfre"
+    root.mkdir(parents=True)
+    clock_file = ClockFile.for_root(tmp_path / "state", root)
+    name = str(root).strip("/").replace("/", "-")
+    assert clock_file.path == tmp_path / "state" / f"{name}.clock"
+
+
+def test_round_trip(tmp_path: P) -> None:
+    path = tmp_path / "state" / "stash-goinfre.clock"
+    clock_file = ClockFile(path)
+    assert clock_file.load() is None
+    clock_file.save("c:1700000000:1234:1:42")
+    assert ClockFile(path).load() == "c:1700000000:1234:1:42"
+    # Nothing is left behind:
+    assert [each.name for each in path.parent.iterdir()] == [path.name]
+
+
+def test_save_only_when_changed(tmp_path: P) -> None:
+    path = tmp_path / "stash-goinfre.clock"
+    clock_file = ClockFile(path)
+    clock_file.save("c:1:1")
+    path.unlink()
+    # Already saved:
+    clock_file.save("c:1:1")
+    assert not path.exists()
+    clock_file.save(None)
+    assert not path.exists()
+    clock_file.save("c:1:2")
+    assert ClockFile(path).load() == "c:1:2"
+
+
+def test_without_path() -> None:
+    clock_file = ClockFile(None)
+    clock_file.save("c:1:1")
+    assert clock_file.load() is None
+
+
+@pytest.mark.parametrize("contents", [b"", b"{", b"[]", b'{"since": "c:1:1"}'])
+def test_invalid(
+    tmp_path: P, caplog: pytest.LogCaptureFixture, contents: bytes
+) -> None:
+    path = tmp_path / "stash-goinfre.clock"
+    _ = path.write_bytes(contents)
+    with caplog.at_level(logging.WARNING):
+        assert ClockFile(path).load() is None
+    assert "Ignoring invalid clock file" in caplog.text
+
+
+def test_cannot_save(tmp_path: P, caplog: pytest.LogCaptureFixture) -> None:
+    # Where a directory cannot be created:
+    _ = (tmp_path / "state").write_text("")
+    clock_file = ClockFile(tmp_path / "state" / "stash-goinfre.clock")
+    with caplog.at_level(logging.WARNING):
+        clock_file.save("c:1:1")
+    assert "Could not save the clock" in caplog.text
+    assert clock_file.load() is None
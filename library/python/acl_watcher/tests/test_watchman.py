@@ -0,0 +1,125 @@
+import asyncio
+import pytest
+
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+from acl_watcher import bser, watchman
+
+Server = Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]
+
+
+def _run_with_server(
+    tmp_path: Path,
+    server: Server,
+    client: Callable[[watchman.Client], Awaitable[Any]],
+) -> Any:
+    path = str(tmp_path / "sock")
+
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await server(reader, writer)
+        finally:
+            # The server only stops once its connections are closed:
+            writer.close()
+
+    async def run() -> Any:
+        async with await asyncio.start_unix_server(serve, path):
+            connection = await watchman.Client.connect(path)
+            try:
+                return await client(connection)
+            finally:
+                await connection.close()
+
+    return asyncio.run(run())
+
+
+def test_command(tmp_path: Path) -> None:
+    received = []
+
+    async def server(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        while True:
+            try:
+                command = await bser.read(reader)
+            except asyncio.IncompleteReadError:
+                return
+            received.append(command)
+            writer.write(bser.dumps({"version": "2024.01.01.00", "clock": "c:1:2"}))
+
+    async def client(connection: watchman.Client) -> Any:
+        return await connection.command("clock", "/stash")
+
+    response = _run_with_server(tmp_path, server, client)
+    assert response == {"version": "2024.01.01.00", "clock": "c:1:2"}
+    assert received == [["clock", "/stash"]]
+
+
+def test_command_error(tmp_path: Path) -> None:
+    async def server(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        _ = await bser.read(reader)
+        writer.write(bser.dumps({"error": "unable to resolve root /nope"}))
+
+    async def client(connection: watchman.Client) -> Any:
+        return await connection.command("watch-project", "/nope")
+
+    with pytest.raises(watchman.WatchmanError, match="unable to resolve root"):
+        _run_with_server(tmp_path, server, client)
+
+
+def test_subscription(tmp_path: Path) -> None:
+    def files(name: str) -> dict[str, Any]:
+        return {
+            "unilateral": True,
+            "subscription": "acl-watcher",
+            "clock": f"c:1:{name}",
+            "files": [{"name": name, "exists": True, "mode": 0o100644, "ino": 1}],
+        }
+
+    async def server(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        _ = await bser.read(reader)
+        # Watchman may send what changed before it responds to a command:
+        writer.write(bser.dumps(files("a")))
+        writer.write(bser.dumps({"unilateral": True, "log": "ignored"}))
+        writer.write(bser.dumps({"subscribe": "acl-watcher", "clock": "c:1:0"}))
+        writer.write(bser.dumps(files("b")))
+
+    async def client(connection: watchman.Client) -> Any:
+        subscribe = await connection.command("subscribe", "/stash", "acl-watcher", {})
+        pdus = [subscribe]
+        while True:
+            try:
+                pdus.append(await connection.subscription())
+            except asyncio.IncompleteReadError:
+                return pdus
+
+    pdus = _run_with_server(tmp_path, server, client)
+    assert pdus == [
+        {"subscribe": "acl-watcher", "clock": "c:1:0"},
+        files("a"),
+        files("b"),
+    ]
+
+
+def test_unexpected_pdu(tmp_path: Path) -> None:
+    async def server(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        _ = await bser.read(reader)
+        writer.write(bser.dumps(["not", "an", "object"]))
+
+    async def client(connection: watchman.Client) -> Any:
+        return await connection.command("clock", "/stash")
+
+    with pytest.raises(watchman.WatchmanError, match="Unexpected PDU"):
+        _run_with_server(tmp_path, server, client)
+
+
+def test_sockname_from_the_environment(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("WATCHMAN_SOCK", "/run/watchman/sock")
+    assert asyncio.run(watchman.sockname()) == "/run/watchman/sock"
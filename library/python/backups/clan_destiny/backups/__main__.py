@@ -1,20 +1,29 @@
 import click
 import collections
 import logging
-import pydantic
-import socket
 
 from pathlib import Path
 
-from clan_destiny.backups import (
-    config,
-    dump,
-    restore,
-    sshd_agent,
-)
+from clan_destiny.backups.cli import CONFIG_CACHE_DIR, LazyGroup, config_loader
+
+
+def _fqdn() -> str:
+    from clan_destiny.backups import utils
+
+    return utils.fqdn()
 
 
-@click.group(help="Dump and restore backups using rsync or restic.")
+@click.group(
+    cls=LazyGroup,
+    help="Dump and restore backups using rsync or restic.",
+    # The subcommands are only imported when they run:
+    lazy_subcommands={
+        "dump": "clan_destiny.backups.dump.cli:dump",
+        "restore": "clan_destiny.backups.restore:restore",
+        "sshd-agent": "clan_destiny.backups.sshd_agent.command:sshd_agent",
+        "status": "clan_destiny.backups.status:status",
+    },
+)
 @click.option(
     "--config-path",
     "-c",
@@ -24,21 +33,30 @@ from clan_destiny.backups import (
     show_default=True,
     required=True,
 )
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    envvar="CLAN_DESTINY_BACKUPS_CACHE_DIR",
+    help="Where to cache the validated configuration.",
+    default=CONFIG_CACHE_DIR,
+    show_default=True,
+)
 @click.pass_context
-def main(ctx: click.Context, config_path: Path) -> None:
+def main(ctx: click.Context, config_path: Path, cache_dir: Path) -> None:
     logging.basicConfig(level=logging.INFO)
     if ctx.invoked_subcommand == "validate-config":
         ctx.obj = config_path
         return
-    ctx.obj = config.load(config_path)
+    # Only load the config if the subcommand needs it:
+    ctx.obj = config_loader(config_path, cache_dir)
 
 
 @main.command(help="Validate the config for the given host.")
 @click.option(
     "--fqdn", "-f",
     help="FQDN for the \"local host\"",
-    default=socket.getfqdn(),
-    show_default=True,
+    default=_fqdn,
+    show_default="this host",
 )
 @click.option(
     # Useful to validate the config in `checkPhase` when generating the
@@ -54,6 +72,10 @@ def validate_config(
     fqdn: str,
     ignore_missing_paths: bool,
 ) -> None:
+    import pydantic
+
+    from clan_destiny.backups import config
+
     try:
         _ = config.load(ctx.obj, fqdn)
     except pydantic.ValidationError as exc:
@@ -76,10 +98,5 @@ def validate_config(
         ctx.exit(1)
 
 
-main.add_command(dump.dump)
-main.add_command(restore.restore)
-main.add_command(sshd_agent.sshd_agent)
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,75 @@
+"""Helpers for the click commands, kept cheap to import.
+
+sshd runs ``clan-destiny-backups sshd-agent`` for every incoming backup
+connection, so the CLI only imports the modules of the command that runs.
+"""
+
+import click
+import functools
+import importlib
+
+from collections.abc import Callable, Mapping
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, cast, override
+
+if TYPE_CHECKING:
+    from clan_destiny.backups import config
+
+# Where the CLI has `config.load` keep the validated config:
+CONFIG_CACHE_DIR = Path("/var/cache/clan-destiny-backups")
+
+
+class LazyGroup(click.Group):
+    """A group whose subcommands are imported when they are used.
+
+    ``lazy_subcommands`` maps the name of each subcommand to where it is
+    defined, as ``"module:attribute"``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        lazy_subcommands: Mapping[str, str] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands: dict[str, str] = dict(lazy_subcommands or {})
+
+    @override
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted(super().list_commands(ctx) + list(self.lazy_subcommands))
+
+    @override
+    def get_command(self, ctx: click.Context, cmd_name: str) -> click.Command | None:
+        if cmd_name in self.lazy_subcommands:
+            return self._load(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def _load(self, cmd_name: str) -> click.Command:
+        module_name, attribute = self.lazy_subcommands[cmd_name].split(":")
+        command = getattr(importlib.import_module(module_name), attribute)
+        if not isinstance(command, click.Command):
+            msg = f"{module_name}:{attribute} is not a click command"
+            raise TypeError(msg)
+        return command
+
+
+def config_loader(
+    config_path: Path,
+    cache_dir: Path,
+) -> Callable[[], "config.Config"]:
+    """Return a function that loads the config the first time it is called."""
+
+    @functools.cache
+    def load() -> "config.Config":
+        from clan_destiny.backups import config
+
+        return config.load(config_path, cache_dir=cache_dir)
+
+    return load
+
+
+def get_config(ctx: click.Context) -> "config.Config":
+    """Get the config, for commands of the `__main__.main` group."""
+
+    return cast(Callable[[], "config.Config"], ctx.obj)()
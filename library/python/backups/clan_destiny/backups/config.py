@@ -1,10 +1,18 @@
 import enum
+import functools
+import hashlib
+import logging
+import os
+import pickle
 import pydantic
-import socket
 import urllib.parse
 
 from pathlib import Path
-from typing import Annotated, Any, NamedTuple, override, Self
+from typing import Annotated, NamedTuple, Self
+
+from clan_destiny.backups import utils
+
+logger = logging.getLogger("backups.config")
 
 
 class BaseModel(pydantic.BaseModel):
@@ -36,16 +44,15 @@ class B2(BaseModel):
     key_id_path: pydantic.FilePath
     application_key_path: pydantic.FilePath
 
-    # Pre-computed values (set in model_post_init)
-    key_id: str = pydantic.Field(default="", exclude=True)
-    application_key: str = pydantic.Field(default="", exclude=True)
+    # The secrets are only read when needed, and never end up in the cache
+    # of `load` since it stores the config before they are accessed:
+    @functools.cached_property
+    def key_id(self) -> str:
+        return self.key_id_path.read_text().strip()
 
-    @override
-    def model_post_init(self, __context: Any) -> None:
-        key_id = self.key_id_path.read_text().strip()
-        object.__setattr__(self, "key_id", key_id)
-        app_key = self.application_key_path.read_text().strip()
-        object.__setattr__(self, "application_key", app_key)
+    @functools.cached_property
+    def application_key(self) -> str:
+        return self.application_key_path.read_text().strip()
 
 
 class OpenBao(BaseModel):
@@ -79,6 +86,17 @@ class SSH(BaseModel):
     ca: OpenBao
     public_key_path: pydantic.FilePath
     private_key_path: pydantic.FilePath
+    # Keep signed certificates there and re-use them as long as they are valid
+    # for at least `certificate_min_validity` seconds:
+    certificate_cache_dir: Path | None = None
+    certificate_min_validity: pydantic.PositiveInt = 3600
+    # In seconds, how long signed certificates are valid for:
+    certificate_ttl: pydantic.PositiveInt = 24 * 3600
+    # When set, the certificates force this command (the sshd agent) on the
+    # remote host for all jobs instead of the rsync server command of each
+    # job, the agent then runs the rsync server for the job requested by the
+    # client. A single certificate is then used for all the jobs:
+    server_command: tuple[str, ...] | None = None
 
     @property
     def public_key(self) -> Path:
@@ -92,6 +110,20 @@ class SSH(BaseModel):
 class Restic(BaseModel):
     cache_dir: pydantic.DirectoryPath
     b2: B2
+    # `forget` runs after every backup but only prunes the repository that
+    # often, since prune is slow and rewrites packs on B2:
+    prune_interval_days: pydantic.PositiveInt = 7
+    # `check` reads one of this many subsets of the repository data on each
+    # run, so that all of it gets read back once every `check_subsets` runs:
+    check_subsets: pydantic.PositiveInt = 30
+    # How many restic jobs can run at the same time, they share `upload_limit`:
+    max_concurrent_jobs: pydantic.PositiveInt = 2
+    # Host-wide upload bandwidth for restic, in KiB/s, split evenly between
+    # the jobs that run concurrently:
+    upload_limit: pydantic.PositiveInt | None = None
+    # Least recently used files are deleted from the caches of the
+    # repositories after the jobs ran to keep them within that size, in MiB:
+    cache_max_size: pydantic.PositiveInt | None = None
 
 
 def _validate_absolute(path: str) -> str:
@@ -113,6 +145,14 @@ class BackupJob(BaseModel):
     one_file_system: bool = True
     password_path: pydantic.FilePath | None = None
     retention: str | None = None
+    # In seconds, defaults to `Runner.job_timeout`:
+    timeout: pydantic.PositiveInt | None = None
+    # Skip push rsync jobs when nothing changed in `local_path` since the last
+    # successful run, see `Runner.full_run_interval_days`:
+    skip_unchanged: bool = False
+    # Keep partially transferred files of rsync jobs across runs, and resume
+    # interrupted jobs first on the next run:
+    resumable: bool = False
 
     @pydantic.model_validator(mode="after")
     def validate_job_requirements(self) -> Self:
@@ -124,7 +164,13 @@ class BackupJob(BaseModel):
                 raise ValueError("remote_host is required for rsync jobs")
             if not self.remote_path:
                 raise ValueError("remote_path is required for rsync jobs")
+            if self.skip_unchanged and self.direction != BackupDirection.PUSH:
+                raise ValueError("skip_unchanged is only supported by push jobs")
         elif self.type == BackupType.RESTIC_B2:
+            if self.skip_unchanged:
+                raise ValueError("skip_unchanged is only supported by rsync jobs")
+            if self.resumable:
+                raise ValueError("resumable is only supported by rsync jobs")
             if not self.retention:
                 raise ValueError("retention is required for restic-b2 jobs")
             if self.direction != BackupDirection.PUSH:
@@ -135,6 +181,63 @@ class BackupJob(BaseModel):
         return self
 
 
+class CaptureCodec(enum.Enum):
+    # zstd if the zstandard module is available, gzip otherwise:
+    AUTO = "auto"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+
+class Capture(BaseModel):
+    """How the output of the commands run by backup jobs is kept."""
+
+    codec: CaptureCodec = CaptureCodec.AUTO
+    # Defaults to a fast level for the codec:
+    level: int | None = None
+    # How much of the end of stdout and stderr is kept for reports, in KiB:
+    tail_size: pydantic.PositiveInt = 64
+
+
+class Runner(BaseModel):
+    """Limits applied by the scheduler when it runs backup jobs concurrently."""
+
+    max_jobs: pydantic.PositiveInt = 4
+    max_jobs_per_remote_host: pydantic.PositiveInt = 1
+    max_jobs_per_filesystem: pydantic.PositiveInt = 2
+    # Default time limit for a job, in seconds, after which its processes get
+    # SIGTERM, and SIGKILL if they are still alive `kill_grace_period` later:
+    job_timeout: pydantic.PositiveInt | None = None
+    kill_grace_period: pydantic.PositiveInt = 30
+    # Jobs with `skip_unchanged` still run at least that often:
+    full_run_interval_days: pydantic.PositiveInt = 7
+    capture: Capture = pydantic.Field(default_factory=Capture)
+    # Where to write per-job metrics in the Prometheus text format, e.g. in
+    # the directory of the textfile collector of the node exporter:
+    metrics_path: Path | None = None
+    # How long runs are kept in the ledger (see `ledger`):
+    ledger_retention_days: pydantic.PositiveInt = 365
+
+
+class Report(BaseModel):
+    """Where the status report of each run is sent."""
+
+    smtp_host: str = "localhost"
+    from_addr: str = "root"
+    to_addr: str = "root"
+    # In KiB, the output of a job is attached when it compresses to at most
+    # that, otherwise only its tail is:
+    max_attachment_size: pydantic.PositiveInt = 1024
+
+
+class Host(BaseModel):
+    """How the sshd agent recognizes a host connecting for a backup job."""
+
+    # Contents of its `.pub` file, this is the key certificates are signed for:
+    ssh_public_key: str
+    # Where it connects from, any address is accepted when empty:
+    addresses: tuple[str, ...] = ()
+
+
 class ValidationContext(NamedTuple):
     fqdn: str
 
@@ -143,6 +246,12 @@ class Config(BaseModel):
     jobs_by_name: dict[str, BackupJob] = pydantic.Field(default_factory=dict)
     restic: Restic | None = None
     ssh: SSH | None = None
+    runner: Runner = pydantic.Field(default_factory=Runner)
+    report: Report = pydantic.Field(default_factory=Report)
+    hosts_by_fqdn: dict[str, Host] = pydantic.Field(default_factory=dict)
+    # Where the state kept between runs (e.g. of restic repositories, or
+    # undelivered reports) lives:
+    state_dir: Path = Path("/var/lib/clan-destiny-backups")
 
     @pydantic.model_validator(mode="after")
     def validate_config_requirements(
@@ -154,10 +263,10 @@ class Config(BaseModel):
         else:
             # You can't really pass a validation context when you directly
             # instantiate the model (which is useful in tests), so default
-            # to `socket.getfqdn()` in that case.
+            # to `utils.fqdn()` in that case.
             reason = f"Expected ValidationContext got: {type(info.context)}"
             assert info.context is None, reason
-            local_host = socket.getfqdn()
+            local_host = utils.fqdn()
         counts: dict[BackupType, int] = {t: 0 for t in BackupType}
         for job in self.jobs_by_name.values():
             counts[job.type] += 1 if job.local_host == local_host else 0
@@ -181,6 +290,63 @@ class Config(BaseModel):
         return self
 
 
-def load(filename: Path, fqdn: str | None = None) -> Config:
-    context = ValidationContext(fqdn if fqdn is not None else socket.getfqdn())
-    return Config.model_validate_json(filename.read_text(), context=context)
+def load(
+    filename: Path,
+    fqdn: str | None = None,
+    cache_dir: Path | None = None,
+) -> Config:
+    """Load the config, keeping only the jobs that involve ``fqdn``.
+
+    With ``cache_dir`` the validated config is kept there and re-used until
+    the config file, ``fqdn`` or this module change.
+    """
+
+    fqdn = fqdn if fqdn is not None else utils.fqdn()
+    contents = filename.read_bytes()
+    if cache_dir is None:
+        return _validate(contents, fqdn)
+
+    key = hashlib.sha256()
+    for part in (Path(__file__).read_bytes(), contents, fqdn.encode()):
+        key.update(len(part).to_bytes(8) + part)
+    cache_path = cache_dir / f"config-{key.hexdigest()}.pickle"
+    if (cfg := _load_cached(cache_path)) is not None:
+        return cfg
+
+    cfg = _validate(contents, fqdn)
+    try:
+        if utils.private_dir(cache_dir):
+            for stale in cache_dir.glob("config-*.pickle"):
+                stale.unlink()
+            utils.replace_file(cache_path, pickle.dumps(cfg), mode=0o600)
+    except OSError as ex:
+        logger.debug(f"Could not cache the config in {cache_dir}: {ex}")
+    return cfg
+
+
+def _validate(contents: bytes, fqdn: str) -> Config:
+    context = ValidationContext(fqdn)
+    cfg = Config.model_validate_json(contents, context=context)
+    jobs = {
+        name: job
+        for name, job in cfg.jobs_by_name.items()
+        if fqdn in (job.local_host, job.remote_host)
+    }
+    return cfg.model_copy(update={"jobs_by_name": jobs})
+
+
+def _load_cached(path: Path) -> Config | None:
+    try:
+        with path.open("rb") as fp:
+            # Unpickling runs arbitrary code, make sure only we wrote it:
+            info = os.fstat(fp.fileno())
+            if info.st_uid != os.geteuid() or info.st_mode & 0o022:
+                logger.warning(f"Ignoring {path}, others could have written it")
+                return None
+            cfg = pickle.load(fp)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.warning(f"Ignoring invalid cached config {path}: {ex}")
+        return None
+    return cfg if isinstance(cfg, Config) else None
@@ -0,0 +1,91 @@
+import asyncio
+import zlib
+
+from pathlib import Path
+from typing import IO, Protocol
+
+from clan_destiny.backups import config
+
+try:
+    import zstandard
+
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+__all__ = ("StreamCapture",)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes, /) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+class StreamCapture:
+    """Compress the output of a job to a file and keep its end in memory.
+
+    The compression happens in-process as the output gets read, and the end
+    of the output is kept in a bounded buffer so that it can be reported
+    without reading the whole file back.
+    """
+
+    def __init__(self, path: Path, settings: config.Capture) -> None:
+        codec = settings.codec
+        if codec == config.CaptureCodec.AUTO:
+            if HAVE_ZSTD:
+                codec = config.CaptureCodec.ZSTD
+            else:
+                codec = config.CaptureCodec.GZIP
+
+        self._compressor: Compressor
+        if codec == config.CaptureCodec.ZSTD:
+            if not HAVE_ZSTD:
+                raise ValueError("zstd requires the zstandard module")
+            level = settings.level if settings.level is not None else 3
+            compressor = zstandard.ZstdCompressor(level=level)
+            self._compressor = compressor.compressobj()
+            self.mime_subtype: str = "zstd"
+            self.path: Path = path.with_name(f"{path.name}.zst")
+        else:
+            level = settings.level if settings.level is not None else 6
+            # wbits=31 gives us the gzip container rather than zlib:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self.mime_subtype = "gzip"
+            self.path = path.with_name(f"{path.name}.gz")
+
+        self._fp: IO[bytes] = self.path.open("wb")
+        self._tail: bytearray = bytearray()
+        self._tail_size: int = settings.tail_size * 1024
+        self.size: int = 0
+
+    @property
+    def tail(self) -> bytes:
+        """The end of the output, at most ``tail_size`` KiB of it."""
+
+        return bytes(self._tail)
+
+    @property
+    def truncated(self) -> bool:
+        return self.size > len(self._tail)
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if compressed := self._compressor.compress(data):
+            _ = self._fp.write(compressed)
+        self._tail += data
+        if (excess := len(self._tail) - self._tail_size) > 0:
+            # Deleting from the front of a bytearray only moves its start:
+            del self._tail[:excess]
+
+    async def pump(self, stream: asyncio.StreamReader) -> None:
+        while chunk := await stream.read(CHUNK_SIZE):
+            self.write(chunk)
+
+    def close(self) -> None:
+        if self._fp.closed:
+            return
+        _ = self._fp.write(self._compressor.flush())
+        self._fp.close()
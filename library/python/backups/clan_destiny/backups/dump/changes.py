@@ -0,0 +1,76 @@
+import os
+import stat
+import time
+
+from typing import Self
+
+from clan_destiny.backups import config
+
+from .state import State
+
+
+class TreeSummary(config.BaseModel):
+    """A cheap fingerprint of a directory tree, from the metadata of its files.
+
+    Any change to a file (content, metadata, rename) updates its ctime, and
+    removing a file changes the ctime of its directory and the number of
+    entries. So two identical summaries mean rsync would have nothing to do.
+    """
+
+    entries: int
+    size: int
+    max_ctime_ns: int
+
+    @classmethod
+    def scan(cls, path: str) -> Self | None:
+        """Summarize the tree at ``path``, or None if it cannot be read.
+
+        Files removed while the tree is scanned, and what is in directories
+        that cannot be read, are left out: rsync would not see them either.
+        """
+
+        try:
+            root = os.lstat(path)
+        except OSError:
+            return None
+        entries = 1
+        size = root.st_size
+        max_ctime_ns = root.st_ctime_ns
+        directories = [path]
+        while directories:
+            try:
+                with os.scandir(directories.pop()) as it:
+                    for entry in it:
+                        try:
+                            info = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        entries += 1
+                        size += info.st_size
+                        max_ctime_ns = max(max_ctime_ns, info.st_ctime_ns)
+                        if stat.S_ISDIR(info.st_mode):
+                            directories.append(entry.path)
+            except OSError:
+                continue
+        return cls(entries=entries, size=size, max_ctime_ns=max_ctime_ns)
+
+
+class SourceState(State):
+    """What we remember about the source of an rsync job between runs."""
+
+    # The source as it was when the last successful run started:
+    summary: TreeSummary | None = None
+    # When the last successful run started, in seconds since the epoch:
+    last_run: float | None = None
+    # When the run that got interrupted before rsync completed started:
+    interrupted_at: float | None = None
+
+    def unchanged(self, summary: TreeSummary, full_run_interval_days: int) -> bool:
+        """Whether a run with ``summary`` can be skipped."""
+
+        if self.summary is None or self.last_run is None:
+            return False
+        elapsed = time.time() - self.last_run
+        if elapsed >= full_run_interval_days * 24 * 3600:
+            return False
+        return summary == self.summary
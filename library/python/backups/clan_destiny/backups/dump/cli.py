@@ -0,0 +1,48 @@
+import click
+
+from pathlib import Path
+
+from clan_destiny.backups.cli import get_config
+
+
+@click.group(help="Toolbelt to perform backups.")
+def dump() -> None:
+    pass
+
+
+@dump.command(name="is-mounted", help="Make sure the given path is mounted")
+@click.argument("path", type=click.Path(path_type=Path))
+@click.pass_context
+def is_mounted_command(ctx: click.Context, path: Path) -> None:
+    from clan_destiny.backups import utils
+
+    ctx.exit(0 if utils.MountTable.read().is_mounted(path) else 1)
+
+
+@dump.command(
+    name="setup-debug-script",
+    help=(
+        "Given the name of a backup job setup a script "
+        "to manually debug or run a backup for it."
+    ),
+)
+@click.argument("job_name")
+@click.pass_context
+def setup_debug_script_command(ctx: click.Context, job_name: str) -> None:
+    from clan_destiny.backups import utils
+
+    from .runner import setup_debug_script
+
+    path = setup_debug_script(get_config(ctx), job_name, utils.fqdn())
+    click.echo(f"A manual backup script has been written to {path}.\n")
+    click.echo("Do not forget to delete this directory once you are done.")
+
+
+@dump.command(name="run", help="Dump all backups defined for this host.")
+@click.pass_context
+def run_command(ctx: click.Context) -> None:
+    from clan_destiny.backups import utils
+
+    from .runner import run
+
+    run(get_config(ctx), utils.fqdn())
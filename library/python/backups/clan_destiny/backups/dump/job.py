@@ -1,55 +1,71 @@
+import asyncio
 import contextlib
+import enum
 import logging
 import os
 import shlex
 import shutil
 import socket
 import subprocess
+import time
 
+from collections.abc import Iterator, Mapping, Sequence
 from pathlib import Path
-from typing import BinaryIO, IO, override, Self
+from typing import override, Self
 
 from clan_destiny.backups import config, ssh_ca
+from clan_destiny.backups.process import ChildProcess, terminate_process_group
+from clan_destiny.backups.restic_cache import RepositoryCache
+from clan_destiny.backups.sshd_agent import dispatch
 
+from .capture import StreamCapture
+from .changes import SourceState, TreeSummary
+from .metrics import ResticSummary, RsyncStats
+from .restic import RepositoryState
 from .rsync import RsyncCommands
 
 logger = logging.getLogger("backups.dump.job")
 
+# The rsync exit codes of a transfer that was cut short and can be resumed:
+# 12 (protocol data stream error), 20 (signal), 30 (I/O timeout), 35 (daemon
+# connection timeout) and 255 (ssh connection lost):
+RSYNC_INTERRUPTED = frozenset({12, 20, 30, 35, 255})
+
+
+class JobStatus(enum.Enum):
+    SUCCEEDED = "succeeded"
+    FAILED = "FAILED"
+    TIMED_OUT = "TIMED OUT"
+    SKIPPED = "skipped: unchanged"
+    # The runner got a signal while the job ran:
+    INTERRUPTED = "INTERRUPTED"
+
 
 class BackupResult:
-    def __init__(self, tmp_dir: Path) -> None:
+    def __init__(self, tmp_dir: Path, capture: config.Capture) -> None:
         self.tmp_dir: Path = tmp_dir
-        self.stdout_fname: Path = tmp_dir / "stdout"
-        self.stderr_fname: Path = tmp_dir / "stderr"
+        self.capture: config.Capture = capture
+        self.status: None | JobStatus = None
         self.return_code: None | int = None
-        self.stdout: None | IO[bytes] = None
-        self.stderr: None | IO[bytes] = None
+        self.stdout: None | StreamCapture = None
+        self.stderr: None | StreamCapture = None
         self.log: list[str] = []
-
-    @classmethod
-    def _call_gzip(cls, stdout: BinaryIO) -> subprocess.Popen[bytes]:
-        gzip_cmd = ("gzip", "--best", "-c")
-        return subprocess.Popen(gzip_cmd, stdin=subprocess.PIPE, stdout=stdout)
+        # Wall-clock start (epoch) and duration of the job, in seconds:
+        self.started_at: float = time.time()
+        self.duration: float = 0.0
+        # CPU time used by the commands the job ran, and their children:
+        self.cpu_time: float = 0.0
+        self.stats: None | RsyncStats | ResticSummary = None
 
     @contextlib.contextmanager
-    def tmp_capture_files(self):
-        with (
-            self.stdout_fname.open("wb") as ofp,
-            self.stderr_fname.open("wb") as efp,
-        ):
-            gzip_stdout: subprocess.Popen[bytes] = self._call_gzip(ofp)
-            gzip_stderr: subprocess.Popen[bytes] = self._call_gzip(efp)
-            self.stdout = gzip_stdout.stdin
-            self.stderr = gzip_stderr.stdin
+    def tmp_capture_files(self) -> Iterator[None]:
+        self.stdout = StreamCapture(self.tmp_dir / "stdout", self.capture)
+        self.stderr = StreamCapture(self.tmp_dir / "stderr", self.capture)
+        try:
             yield
-            assert self.stdout is not None
-            assert self.stderr is not None
+        finally:
             self.stdout.close()
             self.stderr.close()
-            if (rc := gzip_stdout.wait()) > 0:
-                logger.warning(f"gzip for stdout exit abnormally (status={rc})")
-            if (rc := gzip_stderr.wait()) > 0:
-                logger.warning(f"gzip for stderr exit abnormally (status={rc})")
 
 
 class BackupJob:
@@ -58,10 +74,16 @@ class BackupJob:
         tmp_dir: Path,
         name: str,
         type: config.BackupType,
+        timeout: int | None = None,
+        kill_grace_period: int = 30,
+        capture: config.Capture = config.Capture(),
     ) -> None:
         self.tmp_dir: Path = tmp_dir
         self.name: str = name
         self.type: config.BackupType = type
+        self.timeout: int | None = timeout
+        self.kill_grace_period: int = kill_grace_period
+        self.capture: config.Capture = capture
 
     @classmethod
     def from_name_and_config(
@@ -69,8 +91,20 @@ class BackupJob:
         name: str,
         cfg: config.Config,
         tmp_dir: Path,
+        certificate: Path | None = None,
+        upload_limit: int | None = None,
+        control_path: str | None = None,
     ) -> Self:
+        """Instantiate the job ``name`` from the config.
+
+        ``certificate`` and ``control_path`` only apply to rsync jobs, and
+        ``upload_limit`` to restic jobs.
+        """
+
         job = cfg.jobs_by_name[name]
+        timeout = job.timeout or cfg.runner.job_timeout
+        kill_grace_period = cfg.runner.kill_grace_period
+        capture = cfg.runner.capture
         if job.type == config.BackupType.RSYNC:
             assert job.remote_path is not None
             assert job.remote_host is not None
@@ -83,6 +117,15 @@ class BackupJob:
                 remote_host=job.remote_host,
                 direction=job.direction,
                 ssh_config=cfg.ssh,
+                state_dir=cfg.state_dir,
+                skip_unchanged=job.skip_unchanged,
+                resumable=job.resumable,
+                full_run_interval_days=cfg.runner.full_run_interval_days,
+                timeout=timeout,
+                kill_grace_period=kill_grace_period,
+                capture=capture,
+                certificate=certificate,
+                control_path=control_path,
             )
         elif job.type == config.BackupType.RESTIC_B2:
             assert job.password_path is not None
@@ -96,12 +139,43 @@ class BackupJob:
                 one_file_system=job.one_file_system,
                 retention=job.retention,
                 restic_details=cfg.restic,
+                state_dir=cfg.state_dir,
+                upload_limit=upload_limit,
+                timeout=timeout,
+                kill_grace_period=kill_grace_period,
+                capture=capture,
             )
         else:
             msg = f"{name} has unknonwn job type {job.type.value}"
             raise ValueError(msg)
 
-    def run(self) -> BackupResult:
+    async def run(self) -> BackupResult:
+        """Run the job, stopping it if it takes longer than its timeout."""
+
+        result = BackupResult(self.tmp_dir, self.capture)
+        start = time.monotonic()
+        try:
+            async with asyncio.timeout(self.timeout):
+                await self._run(result)
+        except TimeoutError:
+            result.log.append(
+                f"ERROR: the job did not complete within {self.timeout}s, "
+                f"its processes have been terminated."
+            )
+            result.status = JobStatus.TIMED_OUT
+        else:
+            # Unless the job already knows, e.g. that it could be skipped:
+            if result.status is not None:
+                pass
+            elif result.return_code == 0:
+                result.status = JobStatus.SUCCEEDED
+            else:
+                result.status = JobStatus.FAILED
+        finally:
+            result.duration = time.monotonic() - start
+        return result
+
+    async def _run(self, result: BackupResult) -> None:
         raise NotImplementedError
 
     def subject(self, status: str) -> str:
@@ -110,6 +184,36 @@ class BackupJob:
     def setup_debug_script(self) -> None:
         raise NotImplementedError
 
+    async def _check_call(
+        self,
+        cmd: Sequence[str],
+        result: BackupResult,
+        env: Mapping[str, str] | None = None,
+    ) -> None:
+        """Like `subprocess.check_call` but does not block the event loop."""
+
+        assert result.stdout is not None and result.stderr is not None
+        # Run each command in its own process group so that everything it
+        # spawns (e.g. ssh under rsync) can be stopped with it:
+        process = await ChildProcess.spawn(cmd, env)
+        pumps = (
+            asyncio.create_task(result.stdout.pump(process.stdout)),
+            asyncio.create_task(result.stderr.pump(process.stderr)),
+        )
+        try:
+            returncode = await process.wait()
+            _ = await asyncio.gather(*pumps)
+        except asyncio.CancelledError:
+            grace_period = self.kill_grace_period
+            _ = await terminate_process_group(process, grace_period)
+            for pump in pumps:
+                _ = pump.cancel()
+            raise
+        finally:
+            result.cpu_time += process.cpu_time
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
 
 class RsyncBackupJob(BackupJob):
     def __init__(
@@ -122,52 +226,177 @@ class RsyncBackupJob(BackupJob):
         remote_path: str,
         direction: config.BackupDirection,
         ssh_config: config.SSH,
+        state_dir: Path,
+        skip_unchanged: bool = False,
+        resumable: bool = False,
+        full_run_interval_days: int = 7,
+        timeout: int | None = None,
+        kill_grace_period: int = 30,
+        capture: config.Capture = config.Capture(),
+        certificate: Path | None = None,
+        control_path: str | None = None,
     ) -> None:
-        BackupJob.__init__(self, tmp_dir, name, type)
+        BackupJob.__init__(
+            self,
+            tmp_dir,
+            name,
+            type,
+            timeout,
+            kill_grace_period,
+            capture,
+        )
         if type != config.BackupType.RSYNC:
             raise ValueError(f"Expected an rsync backup job but got {type}")
         self.local_path: str = local_path
         self.remote_host: str = remote_host
         self.remote_path: str = remote_path
-        self.ssh_ca: ssh_ca.Client = ssh_ca.Client(ssh_config)
+        self.ssh_ca: ssh_ca.Client = ssh_ca.shared_client(ssh_config)
+        # Used instead of issuing a new certificate when set:
+        self.certificate: Path | None = certificate
+        # Of the master connection to the remote host, see `ssh_master`:
+        self.control_path: str | None = control_path
         assert ssh_config.private_key is not None
         self.private_key: Path = ssh_config.private_key
+        self.server_command: tuple[str, ...] | None = ssh_config.server_command
         self.direction: config.BackupDirection = direction
         if direction == config.BackupDirection.PULL:
             os.makedirs(local_path, exist_ok=True)
+        self.state_path: Path = self.state_path_for(state_dir, name)
+        self.skip_unchanged: bool = skip_unchanged
+        self.resumable: bool = resumable
+        self.full_run_interval_days: int = full_run_interval_days
+
+    @staticmethod
+    def state_path_for(state_dir: Path, name: str) -> Path:
+        return state_dir / "rsync" / f"{name}.json"
+
+    @classmethod
+    def certificate_request(
+        cls,
+        name: str,
+        rsync_commander: RsyncCommands,
+        direction: config.BackupDirection,
+        server_command: tuple[str, ...] | None = None,
+        purpose: str = "dump",
+        resumable: bool = False,
+    ) -> ssh_ca.CertificateRequest:
+        """The certificate to sign for the rsync job ``name``.
+
+        With a ``server_command`` all the jobs share the same certificate.
+        """
+
+        if server_command is not None:
+            return ssh_ca.CertificateRequest(
+                id=f"{socket.gethostname()}-{purpose}",
+                command=server_command,
+            )
+        return ssh_ca.CertificateRequest(
+            id=f"{socket.gethostname()}-{purpose}-{name}",
+            command=rsync_commander.server_mirror_copy(direction, resumable),
+        )
+
+    def _rsync_path(self) -> str | None:
+        """Tell the sshd agent on the remote host which job to run."""
+
+        if self.server_command is None:
+            return None
+        return dispatch.Request(self.name, self.direction.value).encode()
 
     @override
-    def run(self) -> BackupResult:
-        result = BackupResult(self.tmp_dir)
+    async def _run(self, result: BackupResult) -> None:
+        started_at = time.time()
+        summary = None
+        state = SourceState.load(self.state_path)
+        if state.interrupted_at is not None:
+            interrupted_at = time.strftime(
+                "%F %T", time.localtime(state.interrupted_at)
+            )
+            result.log.append(
+                f"INFO: resuming the transfer interrupted on {interrupted_at}"
+            )
+        if self.skip_unchanged:
+            summary = await asyncio.to_thread(TreeSummary.scan, self.local_path)
+            if summary is None:
+                result.log.append(
+                    f"WARNING: could not scan {self.local_path}, running rsync"
+                )
+            # An interrupted transfer is never skipped, whatever the summary:
+            elif state.interrupted_at is None and state.unchanged(
+                summary, self.full_run_interval_days
+            ):
+                assert state.last_run is not None
+                last_run = time.strftime("%F %T", time.localtime(state.last_run))
+                result.log.append(
+                    f"INFO: skipped: {self.local_path} is unchanged since the "
+                    f"run of {last_run}"
+                )
+                result.status = JobStatus.SKIPPED
+                result.return_code = 0
+                return
+
         rsync_commander = RsyncCommands(
             self.remote_host,
             self.local_path,
             self.remote_path,
         )
-        server_cmd = rsync_commander.server_mirror_copy(self.direction)
-        certificate_id = f"{socket.gethostname()}-dump-{self.name}"
-        with (
-            self.ssh_ca.issue_cert(certificate_id, server_cmd) as certificate,
-            result.tmp_capture_files(),
-        ):
+        with contextlib.ExitStack() as stack:
+            certificate = self.certificate
+            if certificate is None:
+                request = self.certificate_request(
+                    self.name,
+                    rsync_commander,
+                    self.direction,
+                    server_command=self.server_command,
+                    resumable=self.resumable,
+                )
+                # Signing is a blocking HTTP round-trip to OpenBao:
+                certificate = await asyncio.to_thread(
+                    stack.enter_context,
+                    self.ssh_ca.issue_cert(*request),
+                )
+            _ = stack.enter_context(result.tmp_capture_files())
             cmd = rsync_commander.mirror_copy(
                 self.direction,
                 self.private_key,
                 certificate,
+                rsync_path=self._rsync_path(),
+                resumable=self.resumable,
+                control_path=self.control_path,
             )
             result.log.append("INFO: rsync command: {}".format(" ".join(cmd)))
             try:
-                _ = subprocess.check_call(
-                    cmd,
-                    stdout=result.stdout,
-                    stderr=result.stderr,
-                )
+                await self._check_call(cmd, result)
             except subprocess.CalledProcessError as ex:
                 result.log.append("ERROR: rsync failed:\n\n{}".format(ex))
                 result.return_code = ex.returncode
+                if ex.returncode in RSYNC_INTERRUPTED:
+                    self._checkpoint(state, started_at)
+            except asyncio.CancelledError:
+                # Timed out or the runner got interrupted:
+                self._checkpoint(state, started_at)
+                raise
             else:
                 result.return_code = 0
-        return result
+            # rsync prints its stats last, they are in the tail of stdout:
+            assert result.stdout is not None
+            output = result.stdout.tail.decode("utf-8", errors="replace")
+            result.stats = RsyncStats.parse(output)
+        if result.return_code == 0 and (
+            summary is not None or state.interrupted_at is not None
+        ):
+            # Changes made while rsync ran will show up in the next summary:
+            state = SourceState(summary=summary, last_run=started_at)
+            state.save(self.state_path)
+
+    def _checkpoint(self, state: SourceState, started_at: float) -> None:
+        """Remember that the transfer was cut short, so that the next run
+        starts with it and does not skip it as unchanged.
+        """
+
+        if not self.resumable:
+            return
+        checkpoint = state.model_copy(update={"interrupted_at": started_at})
+        checkpoint.save(self.state_path)
 
     @override
     def subject(self, status: str) -> str:
@@ -186,10 +415,16 @@ class RsyncBackupJob(BackupJob):
             self.local_path,
             self.remote_path,
         )
-        server_cmd = rsync_commander.server_mirror_copy(self.direction)
-        certificate_id = f"{socket.gethostname()}-debug-dump-{self.name}"
+        request = self.certificate_request(
+            self.name,
+            rsync_commander,
+            self.direction,
+            server_command=self.server_command,
+            purpose="debug-dump",
+            resumable=self.resumable,
+        )
         with (
-            self.ssh_ca.issue_cert(certificate_id, server_cmd) as certificate,
+            self.ssh_ca.issue_cert(*request) as certificate,
             (self.tmp_dir / "script.sh").open("wb") as fp,
         ):
             certificate_copy = self.tmp_dir / "ssh-cert.pub"
@@ -198,6 +433,8 @@ class RsyncBackupJob(BackupJob):
                 self.direction,
                 self.private_key,
                 certificate_copy,
+                rsync_path=self._rsync_path(),
+                resumable=self.resumable,
             )
             fp.write(shlex.join(cmd).encode())
             fp.write("\n".encode())
@@ -220,72 +457,120 @@ class ResticB2BackupJob(BackupJob):
         one_file_system: bool,
         retention: str,
         restic_details: config.Restic,
+        state_dir: Path,
+        upload_limit: int | None = None,
+        timeout: int | None = None,
+        kill_grace_period: int = 30,
+        capture: config.Capture = config.Capture(),
     ) -> None:
-        BackupJob.__init__(self, tmp_dir, name, type)
+        BackupJob.__init__(
+            self,
+            tmp_dir,
+            name,
+            type,
+            timeout,
+            kill_grace_period,
+            capture,
+        )
         bucket = restic_details.b2.bucket
         self.repository: str = f"b2:{bucket}:{name}"
         self.local_path: str = local_path
         self.password_path: Path = password_path
         self.one_file_system: bool = one_file_system
         self.retention: str = retention
-        self.b2_key_id: str = restic_details.b2.key_id
-        self.b2_application_key: str = restic_details.b2.application_key
-        self.cache_dir: Path = restic_details.cache_dir
-
-    def _write_script(self) -> Path:
-        local_path = shlex.quote(str(self.local_path))
-        cache_dir = shlex.quote(str(self.cache_dir))
-        tag_options = " ".join(f"--tag {tag}" for tag in self.TAGS)
+        self.b2: config.B2 = restic_details.b2
+        self.cache: RepositoryCache = RepositoryCache(restic_details.cache_dir, name)
+        # In KiB/s, this job's share of `config.Restic.upload_limit`:
+        self.upload_limit: int | None = upload_limit
+        self.prune_interval_days: int = restic_details.prune_interval_days
+        self.check_subsets: int = restic_details.check_subsets
+        self.state_path: Path = state_dir / "restic" / f"{name}.json"
+
+    def _env(self) -> dict[str, str]:
+        # Credentials go through the environment so that they never end up in
+        # a file or in the command line of a process:
+        return os.environ | {
+            "B2_ACCOUNT_ID": self.b2.key_id,
+            "B2_ACCOUNT_KEY": self.b2.application_key,
+            "RESTIC_REPOSITORY": self.repository,
+            "RESTIC_PASSWORD_FILE": str(self.password_path),
+            "RESTIC_CACHE_DIR": str(self.cache.path),
+        }
+
+    def _backup_args(self) -> list[str]:
+        args = ["backup"]
+        for tag in sorted(self.TAGS):
+            args.extend(("--tag", tag))
         if self.one_file_system is True:
-            one_file_system_option = "--one-file-system"
-        else:
-            one_file_system_option = ""
-        script_path = self.tmp_dir / "script.sh"
-        with script_path.open("wb") as fp:
-            os.fchmod(fp.fileno(), 0o750)
-            written = fp.write(
-                f"""#!/bin/sh
-export B2_ACCOUNT_ID={self.b2_key_id}
-export B2_ACCOUNT_KEY={self.b2_application_key}
-set -x
-restic() {{
-    command restic                              \\
-        --repo {self.repository}                \\
-        --password-file {self.password_path}    \\
-        --cache-dir {cache_dir}                 \\
-        "$@"
-}}
-restic snapshots 2>&- || {{
-    restic --quiet init || exit 1;
-}}
-restic --quiet backup {tag_options} {one_file_system_option} {local_path}
-restic --quiet forget {tag_options} --prune --keep-within {self.retention}
-restic --quiet check
-""".encode()
-            )
-            assert written > 0
-        return script_path
+            args.append("--one-file-system")
+        args.append(self.local_path)
+        return args
+
+    def _forget_args(self, prune: bool) -> list[str]:
+        args = ["forget"]
+        for tag in sorted(self.TAGS):
+            args.extend(("--tag", tag))
+        if prune:
+            args.append("--prune")
+        args.extend(("--keep-within", self.retention))
+        return args
+
+    async def _restic(self, result: BackupResult, *args: str) -> None:
+        cmd = ["restic", "--quiet"]
+        if self.upload_limit is not None:
+            cmd.extend(("--limit-upload", str(self.upload_limit)))
+        cmd.extend(args)
+        result.log.append(f"INFO: {shlex.join(cmd)}")
+        await self._check_call(cmd, result, self._env())
+
+    async def _init_repository(self, result: BackupResult) -> None:
+        try:
+            await self._restic(result, "cat", "config")
+        except subprocess.CalledProcessError:
+            result.log.append("INFO: repository not found, initializing it")
+            await self._restic(result, "init")
 
     @override
-    def run(self) -> BackupResult:
-        result = BackupResult(self.tmp_dir)
-        with result.tmp_capture_files():
-            script_path = self._write_script()
-            result.log.append(
-                f"INFO: Executing {script_path}, see details in attached files."
-            )
+    async def _run(self, result: BackupResult) -> None:
+        state = RepositoryState.load(self.state_path)
+        with contextlib.ExitStack() as stack:
+            # Wait for a restore or a debug run using the same cache to finish:
+            _ = await asyncio.to_thread(stack.enter_context, self.cache.lock())
+            _ = stack.enter_context(result.tmp_capture_files())
             try:
-                _ = subprocess.check_call(
-                    [str(script_path)],
-                    stdout=result.stdout,
-                    stderr=result.stderr,
+                if not state.initialized:
+                    await self._init_repository(result)
+                    state = state.model_copy(update={"initialized": True})
+                    state.save(self.state_path)
+
+                # The summary is the only output of `--quiet --json`:
+                await self._restic(result, "--json", *self._backup_args())
+                assert result.stdout is not None
+                output = result.stdout.tail.decode("utf-8", errors="replace")
+                result.stats = ResticSummary.parse(output)
+
+                prune = state.prune_due(self.prune_interval_days)
+                pruned_at = time.time()
+                await self._restic(result, *self._forget_args(prune))
+                if prune:
+                    state = state.model_copy(update={"last_prune": pruned_at})
+                    state.save(self.state_path)
+
+                subsets = self.check_subsets
+                subset = state.check_subset(subsets)
+                await self._restic(
+                    result,
+                    "check",
+                    f"--read-data-subset={subset}/{subsets}",
                 )
+                update = {"next_check_subset": subset % subsets + 1}
+                state = state.model_copy(update=update)
+                state.save(self.state_path)
             except subprocess.CalledProcessError as ex:
-                result.log.append(f'ERROR: "{script_path}" failed:\n\n{ex}')
+                result.log.append(f"ERROR: restic failed:\n\n{ex}")
                 result.return_code = ex.returncode
             else:
                 result.return_code = 0
-        return result
 
     @override
     def subject(self, status: str) -> str:
@@ -298,4 +583,29 @@ restic --quiet check
 
     @override
     def setup_debug_script(self) -> None:
-        _ = self._write_script()
+        def restic(args: Sequence[str]) -> str:
+            return shlex.join(("restic", *args))
+
+        key_id_path = shlex.quote(str(self.b2.key_id_path))
+        application_key_path = shlex.quote(str(self.b2.application_key_path))
+        script_path = self.tmp_dir / "script.sh"
+        with script_path.open("wb") as fp:
+            os.fchmod(fp.fileno(), 0o750)
+            # The credentials are read when the script runs, not copied in it:
+            written = fp.write(
+                f"""#!/bin/sh
+B2_ACCOUNT_ID="$(cat {key_id_path})" || exit 1
+B2_ACCOUNT_KEY="$(cat {application_key_path})" || exit 1
+export B2_ACCOUNT_ID B2_ACCOUNT_KEY
+export RESTIC_REPOSITORY={shlex.quote(self.repository)}
+export RESTIC_PASSWORD_FILE={shlex.quote(str(self.password_path))}
+export RESTIC_CACHE_DIR={shlex.quote(str(self.cache.path))}
+# Run any restic command in the environment of the job, e.g. `snapshots`:
+[ $# -gt 0 ] && exec restic "$@"
+set -ex
+{restic(self._backup_args())}
+{restic(self._forget_args(prune=True))}
+restic check
+""".encode()
+            )
+            assert written > 0
@@ -0,0 +1,270 @@
+"""Metrics about backup jobs, exported in the Prometheus text format.
+
+The file written by `write_textfile` is meant to be picked up by the textfile
+collector of the node exporter.
+"""
+
+import json
+import re
+
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import NamedTuple, Self
+
+from clan_destiny.backups import utils
+
+PREFIX = "clan_destiny_backups"
+
+
+class Sample(NamedTuple):
+    name: str
+    help: str
+    value: float
+    labels: dict[str, str] = {}
+
+
+# rsync runs with --no-human-readable, so that the numbers are neither
+# scaled nor grouped with the separator of the locale:
+_RSYNC_STATS_PATTERN = re.compile(
+    r"^(?P<name>[A-Za-z ]+): (?P<value>\d+)(?: |$)",
+    re.MULTILINE,
+)
+# The lines of `rsync --stats` we keep, and the field of `RsyncStats` of each:
+_RSYNC_STATS_FIELDS = {
+    "Number of regular files transferred": "files_transferred",
+    "Number of created files": "files_created",
+    "Number of deleted files": "files_deleted",
+    "Total file size": "total_file_size",
+    "Total transferred file size": "transferred_file_size",
+    "Literal data": "literal_data",
+    "Matched data": "matched_data",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+
+
+class RsyncStats(NamedTuple):
+    """What gets reported by `rsync --stats` at the end of a transfer."""
+
+    files_transferred: int
+    files_created: int
+    files_deleted: int
+    total_file_size: int
+    transferred_file_size: int
+    literal_data: int
+    matched_data: int
+    bytes_sent: int
+    bytes_received: int
+
+    @classmethod
+    def parse(cls, output: str) -> Self | None:
+        """Parse the stats block from the output of rsync, if there is one."""
+
+        values = {}
+        for match in _RSYNC_STATS_PATTERN.finditer(output):
+            if (field := _RSYNC_STATS_FIELDS.get(match["name"])) is None:
+                continue
+            values[field] = int(match["value"])
+        if len(values) != len(_RSYNC_STATS_FIELDS):
+            return None
+        return cls(**values)
+
+    @property
+    def bytes_moved(self) -> int:
+        return self.bytes_sent + self.bytes_received
+
+    def samples(self) -> Iterator[Sample]:
+        yield Sample(
+            "rsync_files_transferred",
+            "Regular files transferred by rsync.",
+            self.files_transferred,
+        )
+        yield Sample(
+            "rsync_files_created",
+            "Files created by rsync.",
+            self.files_created,
+        )
+        yield Sample(
+            "rsync_files_deleted",
+            "Files deleted by rsync.",
+            self.files_deleted,
+        )
+        yield Sample(
+            "rsync_total_file_size_bytes",
+            "Size of all the files in the transfer.",
+            self.total_file_size,
+        )
+        yield Sample(
+            "rsync_transferred_file_size_bytes",
+            "Size of the files that were updated.",
+            self.transferred_file_size,
+        )
+        yield Sample(
+            "rsync_literal_data_bytes",
+            "Data that had to be sent because it wasn't on the receiver.",
+            self.literal_data,
+        )
+        yield Sample(
+            "rsync_matched_data_bytes",
+            "Data that the receiver already had.",
+            self.matched_data,
+        )
+        yield Sample(
+            "rsync_sent_bytes",
+            "Bytes sent over the network by the local rsync.",
+            self.bytes_sent,
+        )
+        yield Sample(
+            "rsync_received_bytes",
+            "Bytes received over the network by the local rsync.",
+            self.bytes_received,
+        )
+
+
+class ResticSummary(NamedTuple):
+    """The summary of `restic backup --json`."""
+
+    files_new: int
+    files_changed: int
+    files_unmodified: int
+    data_added: int
+    total_bytes_processed: int
+    snapshot_id: str | None
+
+    @classmethod
+    def parse(cls, output: str) -> Self | None:
+        """Return the last summary found in the output of restic."""
+
+        for line in reversed(output.splitlines()):
+            if not line.startswith("{"):
+                continue
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if message.get("message_type") != "summary":
+                continue
+            return cls(
+                files_new=message.get("files_new", 0),
+                files_changed=message.get("files_changed", 0),
+                files_unmodified=message.get("files_unmodified", 0),
+                data_added=message.get("data_added", 0),
+                total_bytes_processed=message.get("total_bytes_processed", 0),
+                snapshot_id=message.get("snapshot_id"),
+            )
+        return None
+
+    @property
+    def bytes_moved(self) -> int:
+        return self.data_added
+
+    def samples(self) -> Iterator[Sample]:
+        yield Sample(
+            "restic_files_new",
+            "New files backed up by restic.",
+            self.files_new,
+        )
+        yield Sample(
+            "restic_files_changed",
+            "Changed files backed up by restic.",
+            self.files_changed,
+        )
+        yield Sample(
+            "restic_files_unmodified",
+            "Files restic found unmodified.",
+            self.files_unmodified,
+        )
+        yield Sample(
+            "restic_data_added_bytes",
+            "Data added to the repository by restic.",
+            self.data_added,
+        )
+        yield Sample(
+            "restic_processed_bytes",
+            "Data read by restic.",
+            self.total_bytes_processed,
+        )
+        if self.snapshot_id is not None:
+            yield Sample(
+                "restic_snapshot_info",
+                "The snapshot created by restic.",
+                1,
+                {"snapshot_id": self.snapshot_id},
+            )
+
+
+class JobMetrics(NamedTuple):
+    name: str
+    type: str
+    # One of the `JobStatus` names in lower case:
+    status: str
+    started_at: float
+    duration: float
+    cpu_time: float
+    stats: RsyncStats | ResticSummary | None = None
+    # Not exported, kept in the ledger:
+    stderr_tail: str = ""
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status in ("succeeded", "skipped")
+
+    def samples(self) -> Iterator[Sample]:
+        yield Sample(
+            "job_success",
+            "Whether the last run of the job succeeded or was skipped.",
+            1 if self.succeeded else 0,
+        )
+        yield Sample(
+            "job_status",
+            "Status of the last run of the job.",
+            1,
+            {"status": self.status},
+        )
+        yield Sample(
+            "job_last_run_timestamp_seconds",
+            "When the last run of the job started.",
+            self.started_at,
+        )
+        yield Sample(
+            "job_duration_seconds",
+            "Wall-clock time taken by the last run of the job.",
+            self.duration,
+        )
+        yield Sample(
+            "job_cpu_seconds",
+            "CPU time (user and system) used by the last run of the job.",
+            self.cpu_time,
+        )
+        if self.stats is not None:
+            yield from self.stats.samples()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_textfile(jobs: Iterable[JobMetrics]) -> str:
+    samples_by_name: dict[str, list[tuple[Sample, dict[str, str]]]] = {}
+    for job in jobs:
+        for sample in job.samples():
+            labels = {"job": job.name, "type": job.type} | sample.labels
+            samples_by_name.setdefault(sample.name, []).append((sample, labels))
+
+    lines = []
+    for name, samples in samples_by_name.items():
+        metric = f"{PREFIX}_{name}"
+        lines.append(f"# HELP {metric} {samples[0][0].help}")
+        lines.append(f"# TYPE {metric} gauge")
+        for sample, labels in samples:
+            formatted_labels = ",".join(
+                f'{key}="{_escape(value)}"' for key, value in labels.items()
+            )
+            lines.append(f"{metric}{{{formatted_labels}}} {sample.value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: Path, jobs: Iterable[JobMetrics]) -> None:
+    """Atomically replace ``path`` with the metrics for ``jobs``."""
+
+    utils.replace_file(path, format_textfile(jobs).encode("utf-8"))
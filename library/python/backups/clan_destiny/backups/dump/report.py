@@ -0,0 +1,186 @@
+"""Status reports: one email per run covering all of its jobs.
+
+Reports that cannot be delivered are spooled and sent again, before the
+report of the run, the next time a run delivers its report.
+"""
+
+import email.mime.application
+import email.mime.multipart
+import email.mime.text
+import logging
+import os
+import smtplib
+import socket
+import time
+
+from collections.abc import Sequence
+from pathlib import Path
+from typing import NamedTuple, Self
+
+from clan_destiny.backups import config, utils
+
+from .capture import StreamCapture
+
+logger = logging.getLogger("backups.dump.report")
+
+# How many lines of stderr are quoted in the report for jobs that failed:
+QUOTED_LINES = 20
+# How many undelivered reports are kept, the oldest ones are dropped:
+MAX_SPOOLED = 50
+
+
+class Attachment(NamedTuple):
+    filename: str
+    data: bytes
+    # The `application/*` subtype:
+    subtype: str
+
+
+class JobReport(NamedTuple):
+    subject: str
+    succeeded: bool
+    exec_log: tuple[str, ...]
+    # The end of stderr, for jobs that failed:
+    quoted: str
+    attachments: tuple[Attachment, ...]
+
+    @classmethod
+    def from_job(
+        cls,
+        job_name: str,
+        subject: str,
+        succeeded: bool,
+        exec_log: Sequence[str],
+        stdout: StreamCapture | None = None,
+        stderr: StreamCapture | None = None,
+        max_attachment_size: int = 1024 * 1024,
+    ) -> Self:
+        """Build the report of a job before its captures are deleted.
+
+        The compressed output is attached when it fits in
+        ``max_attachment_size`` bytes, only its tail otherwise.
+        """
+
+        attachments = []
+        for name, capture in (("stdout", stdout), ("stderr", stderr)):
+            if capture is None or capture.size == 0:
+                continue
+            if capture.path.stat().st_size <= max_attachment_size:
+                data = capture.path.read_bytes()
+                filename = f"{job_name}-{capture.path.name}"
+                attachments.append(Attachment(filename, data, capture.mime_subtype))
+            else:
+                filename = f"{job_name}-{name}-tail.txt"
+                attachments.append(Attachment(filename, capture.tail, "octet-stream"))
+        quoted = ""
+        if not succeeded and stderr is not None:
+            lines = stderr.tail.decode("utf-8", errors="replace").splitlines()
+            quoted = "\n".join(lines[-QUOTED_LINES:])
+        return cls(subject, succeeded, tuple(exec_log), quoted, tuple(attachments))
+
+
+class Digest:
+    """Collect the reports of the jobs of a run."""
+
+    def __init__(self, cfg: config.Report) -> None:
+        self.cfg: config.Report = cfg
+        self.jobs: list[JobReport] = []
+
+    def add(self, report: JobReport) -> None:
+        self.jobs.append(report)
+
+    def subject(self) -> str:
+        host = socket.gethostname()
+        failed = sum(not job.succeeded for job in self.jobs)
+        if failed:
+            return f"{failed}/{len(self.jobs)} backup jobs FAILED on {host}"
+        return f"{len(self.jobs)} backup jobs succeeded on {host}"
+
+    def message(self, notes: Sequence[str] = ()) -> bytes:
+        message = email.mime.multipart.MIMEMultipart()
+        message["From"] = self.cfg.from_addr
+        message["To"] = self.cfg.to_addr
+        message["Subject"] = self.subject()
+
+        # Failed jobs first:
+        jobs = sorted(self.jobs, key=lambda job: job.succeeded)
+        body_parts = list(notes)
+        body_parts.extend(f"- {job.subject}" for job in jobs)
+        for job in jobs:
+            body_parts.append(f"\n{job.subject}\n\nExecution log:\n")
+            body_parts.extend(job.exec_log)
+            if job.quoted:
+                body_parts.append(f"\nLast lines of stderr:\n\n{job.quoted}")
+            for attachment in job.attachments:
+                MIMEApp = email.mime.application.MIMEApplication
+                mime_logfile = MIMEApp(attachment.data, attachment.subtype)
+                mime_logfile.add_header(
+                    "Content-Disposition",
+                    "attachment",
+                    filename=attachment.filename,
+                )
+                message.attach(mime_logfile)
+        body_parts.append("\n-- \n{}\n".format(__file__))
+        message.attach(
+            email.mime.text.MIMEText(
+                "\n".join(body_parts),
+                "plain",
+                "utf-8",
+            )
+        )
+        return message.as_bytes()
+
+
+def _spool(spool_dir: Path, message: bytes) -> None:
+    try:
+        if not utils.private_dir(spool_dir):
+            logger.error(f"Not spooling the report, {spool_dir} is not private")
+            return
+        path = spool_dir / f"{time.time_ns()}-{os.getpid()}.eml"
+        utils.replace_file(path, message, mode=0o600)
+        spooled = sorted(spool_dir.glob("*.eml"))
+        for stale in spooled[:-MAX_SPOOLED]:
+            logger.warning(f"Dropping undelivered report {stale.name}")
+            stale.unlink(missing_ok=True)
+    except OSError as ex:
+        logger.error(f"Could not spool the report in {spool_dir}: {ex}")
+
+
+def deliver(cfg: config.Report, spool_dir: Path, message: bytes | None) -> None:
+    """Send ``message`` and the spooled reports over a single connection.
+
+    Whatever cannot be sent gets spooled.
+    """
+
+    try:
+        spooled = sorted(spool_dir.glob("*.eml")) if spool_dir.is_dir() else []
+    except OSError as ex:
+        logger.warning(f"Could not list the spooled reports in {spool_dir}: {ex}")
+        spooled = []
+    if message is None and not spooled:
+        return
+    try:
+        smtp = smtplib.SMTP(cfg.smtp_host)
+    except (OSError, smtplib.SMTPException) as ex:
+        logger.warning(f"Could not connect to {cfg.smtp_host}: {ex}")
+        if message is not None:
+            _spool(spool_dir, message)
+        return
+
+    try:
+        with smtp:
+            for path in spooled:
+                try:
+                    _ = smtp.sendmail(cfg.from_addr, cfg.to_addr, path.read_bytes())
+                    path.unlink()
+                except (OSError, smtplib.SMTPException) as ex:
+                    logger.warning(f"Could not send spooled report {path.name}: {ex}")
+                    break
+                logger.info(f"Sent spooled report {path.name}")
+            if message is not None:
+                _ = smtp.sendmail(cfg.from_addr, cfg.to_addr, message)
+                message = None
+    except (OSError, smtplib.SMTPException) as ex:
+        logger.warning(f"Could not send the report to {cfg.to_addr}: {ex}")
+    if message is not None:
+        _spool(spool_dir, message)
@@ -0,0 +1,26 @@
+import pydantic
+import time
+
+from .state import State
+
+
+class RepositoryState(State):
+    """What we remember about a restic repository between runs."""
+
+    # Once set we stop probing the repository before backing up to it:
+    initialized: bool = False
+    # When `forget --prune` last succeeded, in seconds since the epoch:
+    last_prune: float | None = None
+    # The subset of the data `check --read-data-subset` reads next:
+    next_check_subset: pydantic.PositiveInt = 1
+
+    def prune_due(self, interval_days: int) -> bool:
+        if self.last_prune is None:
+            return True
+        return time.time() - self.last_prune >= interval_days * 24 * 3600
+
+    def check_subset(self, subsets: int) -> int:
+        """The subset of the data, out of ``subsets``, to read back next."""
+
+        # The number of subsets might have changed in the configuration:
+        return (self.next_check_subset - 1) % subsets + 1
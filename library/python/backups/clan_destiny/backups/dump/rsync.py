@@ -1,11 +1,16 @@
 import shlex
 
-from collections.abc import Iterable
+from collections.abc import Iterable, Sequence
 from pathlib import Path
 
 from clan_destiny.backups import config
 
 
+# Where the receiver keeps partially transferred files of resumable jobs, in
+# each directory, `--delete` leaves it alone:
+PARTIAL_DIR = ".rsync-partial"
+
+
 class RsyncCommands(object):
     def __init__(
         self,
@@ -20,7 +25,11 @@ class RsyncCommands(object):
         self.remote_path: str = remote_path
         self.remote_port: int | None = remote_port
 
-    def _make_base(self, identity_files: Iterable[Path]) -> tuple[str, ...]:
+    def _make_base(
+        self,
+        identity_files: Iterable[Path],
+        control_path: str | None = None,
+    ) -> tuple[str, ...]:
         ssh_cmd = [
             "ssh",
             "-v",
@@ -29,6 +38,9 @@ class RsyncCommands(object):
             "-o ControlMaster=no",
             "-o VisualHostKey=no",
         ]
+        if control_path is not None:
+            # Use the master connection there if any, see `ssh_master`:
+            ssh_cmd.append(f"-o ControlPath={shlex.quote(control_path)}")
         for each in identity_files:
             ssh_cmd.append(f"-i {shlex.quote(str(each))}")
         if self.remote_port:
@@ -36,10 +48,10 @@ class RsyncCommands(object):
         return (
             "rsync",
             "--archive",
-            "--human-readable",
             "--numeric-ids",
             "--rsh={}".format(" ".join(ssh_cmd)),
             "--stats",
+            "--no-human-readable",  # see `metrics.RsyncStats`
         )
 
     def _make_src_dst(self, direction: config.BackupDirection) -> tuple[str, str]:
@@ -54,20 +66,42 @@ class RsyncCommands(object):
         direction: config.BackupDirection,
         identity_file: Path,
         certificate_file: Path,
+        rsync_path: str | None = None,
+        delete: bool = True,
+        extra_options: Sequence[str] = (),
+        resumable: bool = False,
+        control_path: str | None = None,
     ) -> tuple[str, ...]:
-        """Get the rsync command executed on the client side."""
+        """Get the rsync command executed on the client side.
+
+        ``rsync_path`` replaces the command rsync asks sshd to run. With
+        ``resumable`` interrupted transfers resume where they stopped.
+        ``control_path`` is where to find a master connection to the remote
+        host, ssh connects on its own when there is none.
+        """
 
-        mirror_options = (
+        mirror_options: tuple[str, ...] = (
             "--new-compress",
             "--hard-links",  # preserve hard links
             "--acls",  # preserve ACLs
             "--xattrs",  # preserve extended attributes
-            # NOTE: We probaby wanna make --delete an option (e.g: for incoming
-            #       directories):
-            "--delete",
         )
+        # NOTE: We probaby wanna make --delete an option (e.g: for incoming
+        #       directories):
+        if resumable:
+            mirror_options += (f"--partial-dir={PARTIAL_DIR}",)
+        if delete:
+            # Only delete once everything got transferred, so that an
+            # interrupted run does not leave a half-deleted destination:
+            mirror_options += ("--delete-delay",) if resumable else ("--delete",)
+        if rsync_path is not None:
+            mirror_options += (f"--rsync-path={rsync_path}",)
+        mirror_options += tuple(extra_options)
         return (
-            self._make_base(identity_files=(identity_file, certificate_file))
+            self._make_base(
+                identity_files=(identity_file, certificate_file),
+                control_path=control_path,
+            )
             + mirror_options
             + self._make_src_dst(direction)
         )
@@ -91,7 +125,11 @@ class RsyncCommands(object):
             return (".", str(self.remote_path))
         raise NotImplementedError("FIXME")
 
-    def server_mirror_copy(self, direction: config.BackupDirection) -> tuple[str, ...]:
+    def server_mirror_copy(
+        self,
+        direction: config.BackupDirection,
+        resumable: bool = False,
+    ) -> tuple[str, ...]:
         """Get the rsync command executed on the server (sshd) side."""
 
         copy_cmd = ["rsync", "--server"]
@@ -102,6 +140,8 @@ class RsyncCommands(object):
         # do not exists at the source anymore.
         if direction == config.BackupDirection.PULL:
             copy_cmd.append("--sender")
+        elif resumable:
+            copy_cmd.extend(("--delete-delay", f"--partial-dir={PARTIAL_DIR}"))
         else:
             copy_cmd.append("--delete")
         copy_cmd.extend(
@@ -116,3 +156,18 @@ class RsyncCommands(object):
             ]
         )
         return tuple(copy_cmd)
+
+
+def filter_options(include: Sequence[str], exclude: Sequence[str]) -> tuple[str, ...]:
+    """Only transfer what matches ``include``, if any, minus ``exclude``.
+
+    Patterns are rsync filter patterns, relative to the transfer root.
+    """
+
+    options = [f"--exclude={pattern}" for pattern in exclude]
+    if include:
+        options.extend(f"--include={pattern}" for pattern in include)
+        # Walk every directory to find what matches, but do not create the
+        # ones that end up empty:
+        options.extend(("--include=*/", "--exclude=*", "--prune-empty-dirs"))
+    return tuple(options)
@@ -0,0 +1,446 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import logging
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from clan_destiny.backups import config, ledger, restic_cache, ssh_ca, utils
+
+from .capture import StreamCapture
+from .changes import SourceState
+from .job import BackupJob, JobStatus, RsyncBackupJob
+from .metrics import JobMetrics, write_textfile
+from .report import Digest, JobReport, deliver
+from .rsync import RsyncCommands
+from .scheduler import Scheduler
+from .ssh_master import open_masters
+
+logger = logging.getLogger("backups.dump")
+
+# How much of the end of stderr is kept in the ledger, in bytes:
+LEDGER_TAIL_SIZE = 4096
+
+
+def run(cfg: config.Config, host_fqdn: str) -> None:
+    jobs = {
+        job_name: job
+        for job_name, job in cfg.jobs_by_name.items()
+        if job.local_host == host_fqdn
+    }
+    if len(jobs) == 0:
+        logger.info("No backups configured")
+        return
+
+    digest = Digest(cfg.report)
+    # The jobs that completed, or got stopped, so far:
+    job_metrics: list[JobMetrics] = []
+    try:
+        asyncio.run(_run_jobs(cfg, jobs, digest, job_metrics))
+    except Interrupted as ex:
+        msg = f"Interrupted by {ex.signal.name}, running jobs have been stopped"
+        logger.error(msg)
+        _save_metrics(cfg, job_metrics)
+        _deliver_report(cfg, digest, notes=(f"{msg}.\n",))
+        sys.exit(128 + ex.signal.value)
+    _save_metrics(cfg, job_metrics)
+    _deliver_report(cfg, digest)
+    job_count = sum(metrics.succeeded for metrics in job_metrics)
+    logger.info(f"{job_count}/{len(jobs)} backup jobs ran successfully")
+    if cfg.restic is not None and cfg.restic.cache_max_size is not None:
+        max_size = cfg.restic.cache_max_size * 1024 * 1024
+        freed = restic_cache.prune(cfg.restic.cache_dir, max_size)
+        logger.info(f"Pruned {freed} bytes from the restic caches")
+
+
+def _deliver_report(
+    cfg: config.Config,
+    digest: Digest,
+    notes: tuple[str, ...] = (),
+) -> None:
+    message = digest.message(notes) if digest.jobs else None
+    deliver(cfg.report, cfg.state_dir / "spool", message)
+
+
+def _save_metrics(cfg: config.Config, job_metrics: list[JobMetrics]) -> None:
+    """Record the runs in the ledger and export their metrics."""
+
+    try:
+        _record_runs(cfg, job_metrics)
+    except sqlite3.Error as ex:
+        logger.warning(f"Could not record the runs in the ledger: {ex}")
+    if cfg.runner.metrics_path is not None:
+        try:
+            write_textfile(cfg.runner.metrics_path, job_metrics)
+        except OSError as ex:
+            logger.warning(f"Could not write metrics: {ex}")
+
+
+def _record_runs(cfg: config.Config, job_metrics: list[JobMetrics]) -> None:
+    runs = (
+        ledger.Run(
+            job=metrics.name,
+            type=metrics.type,
+            status=metrics.status,
+            started_at=metrics.started_at,
+            duration=metrics.duration,
+            bytes_moved=metrics.stats.bytes_moved if metrics.stats else None,
+            stderr_tail=metrics.stderr_tail,
+        )
+        for metrics in job_metrics
+    )
+    with ledger.Ledger.open(cfg.state_dir / ledger.FILENAME) as runs_ledger:
+        runs_ledger.record(runs, cfg.runner.ledger_retention_days)
+
+
+class Interrupted(Exception):
+    def __init__(self, signum: signal.Signals) -> None:
+        super().__init__(f"Interrupted by {signum.name}")
+        self.signal: signal.Signals = signum
+
+
+async def _run_jobs(
+    cfg: config.Config,
+    jobs: dict[str, config.BackupJob],
+    digest: Digest,
+    job_metrics: list[JobMetrics],
+) -> None:
+    # Cancelling this task cancels every job: their process groups get
+    # terminated and their temporary directories cleaned up on the way out.
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    assert task is not None
+    received: list[signal.Signals] = []
+
+    def on_signal(signum: signal.Signals) -> None:
+        if not received:
+            logger.warning(f"Got {signum.name}, stopping backup jobs")
+            _ = task.cancel()
+        received.append(signum)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, on_signal, signum)
+    try:
+        await _schedule_jobs(cfg, jobs, digest, job_metrics)
+    except asyncio.CancelledError:
+        if received:
+            raise Interrupted(received[0]) from None
+        raise
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            _ = loop.remove_signal_handler(signum)
+
+
+def _resumed_first(
+    cfg: config.Config,
+    jobs: dict[str, config.BackupJob],
+) -> dict[str, config.BackupJob]:
+    """Order ``jobs`` so that the interrupted transfers get their slots first.
+
+    The scheduler hands out slots in the order the jobs are started.
+    """
+
+    def interrupted(job_name: str) -> bool:
+        if not jobs[job_name].resumable:
+            return False
+        state_path = RsyncBackupJob.state_path_for(cfg.state_dir, job_name)
+        return SourceState.load(state_path).interrupted_at is not None
+
+    # sorted is stable, the other jobs keep their order from the config:
+    order = sorted(jobs, key=lambda job_name: not interrupted(job_name))
+    return {job_name: jobs[job_name] for job_name in order}
+
+
+async def _schedule_jobs(
+    cfg: config.Config,
+    jobs: dict[str, config.BackupJob],
+    digest: Digest,
+    job_metrics: list[JobMetrics],
+) -> None:
+    """Run ``jobs``, add the metrics of each to ``job_metrics`` once it ends.
+
+    Jobs that get interrupted are added too, as they get stopped.
+    """
+
+    jobs = _resumed_first(cfg, jobs)
+    remote_host_limits = {}
+    upload_limit = None
+    restic_jobs = sum(
+        job.type == config.BackupType.RESTIC_B2 for job in jobs.values()
+    )
+    if restic_jobs > 0:
+        assert cfg.restic is not None
+        concurrency = min(cfg.restic.max_concurrent_jobs, restic_jobs)
+        remote_host_limits[_restic_remote(cfg)] = concurrency
+        # restic cannot change its limit once started, so every job gets an
+        # even share even if it ends up running alone:
+        if cfg.restic.upload_limit is not None:
+            upload_limit = max(1, cfg.restic.upload_limit // concurrency)
+    scheduler = Scheduler(cfg.runner, remote_host_limits)
+    mounts = utils.MountTable.read()
+    async with contextlib.AsyncExitStack() as stack:
+        certificates = await _issue_certificates(stack, cfg, jobs)
+        control_path = await _open_masters(stack, cfg, jobs, certificates)
+        runs = (
+            scheduler.run(
+                job.local_path,
+                _remote(cfg, job),
+                functools.partial(
+                    _run_job,
+                    cfg,
+                    digest,
+                    job_metrics,
+                    mounts,
+                    job_name,
+                    job,
+                    certificates.get(job_name),
+                    upload_limit,
+                    control_path,
+                ),
+            )
+            for job_name, job in jobs.items()
+        )
+        started_at = time.time()
+        results = await asyncio.gather(*runs, return_exceptions=True)
+    recorded = {metrics.name for metrics in job_metrics}
+    for (job_name, job), result in zip(jobs.items(), results):
+        if isinstance(result, BaseException):
+            msg = f'Backup job "{job_name}" crashed'
+            logger.error(msg, exc_info=result)
+            subject = f"{job.type.value} backup job #{job_name} crashed"
+            digest.add(
+                JobReport.from_job(
+                    job_name,
+                    subject,
+                    succeeded=False,
+                    exec_log=(f"{msg}: {result!r}",),
+                )
+            )
+            if job_name in recorded:
+                continue
+            job_metrics.append(
+                JobMetrics(
+                    name=job_name,
+                    type=job.type.value,
+                    status="failed",
+                    started_at=started_at,
+                    duration=0.0,
+                    cpu_time=0.0,
+                    stderr_tail=f"{msg}: {result!r}",
+                )
+            )
+
+
+def _restic_remote(cfg: config.Config) -> str:
+    assert cfg.restic is not None
+    return f"b2:{cfg.restic.b2.bucket}"
+
+
+def _remote(cfg: config.Config, job: config.BackupJob) -> str | None:
+    """What the scheduler considers the remote host of ``job``."""
+
+    if job.type == config.BackupType.RESTIC_B2:
+        return _restic_remote(cfg)
+    return job.remote_host
+
+
+async def _issue_certificates(
+    stack: contextlib.AsyncExitStack,
+    cfg: config.Config,
+    jobs: dict[str, config.BackupJob],
+) -> dict[str, Path]:
+    """Sign the certificates of all the rsync jobs at once.
+
+    This way we only login into OpenBao once and sign them concurrently. If
+    that fails the jobs will try to get their own certificate.
+    """
+
+    requests = {}
+    for job_name, job in jobs.items():
+        if job.type != config.BackupType.RSYNC:
+            continue
+        assert job.remote_host is not None
+        assert job.remote_path is not None
+        assert cfg.ssh is not None
+        rsync_commander = RsyncCommands(
+            job.remote_host,
+            job.local_path,
+            job.remote_path,
+        )
+        requests[job_name] = RsyncBackupJob.certificate_request(
+            job_name,
+            rsync_commander,
+            job.direction,
+            server_command=cfg.ssh.server_command,
+            resumable=job.resumable,
+        )
+    if len(requests) == 0:
+        return {}
+
+    assert cfg.ssh is not None
+    client = ssh_ca.shared_client(cfg.ssh)
+    try:
+        certificates = await asyncio.to_thread(
+            stack.enter_context,
+            client.issue_certs(requests.values()),
+        )
+    except Exception as ex:
+        logger.warning(f"Could not issue certificates ahead of time: {ex}")
+        return {}
+    return {
+        job_name: certificates[request.id]
+        for job_name, request in requests.items()
+    }
+
+
+async def _open_masters(
+    stack: contextlib.AsyncExitStack,
+    cfg: config.Config,
+    jobs: dict[str, config.BackupJob],
+    certificates: dict[str, Path],
+) -> str | None:
+    """Open one SSH connection to each remote host with several rsync jobs.
+
+    Returns the ``ControlPath`` of the connections, None when the jobs do not
+    share a certificate (see `ssh_master`) or no host has several jobs.
+    """
+
+    if cfg.ssh is None or cfg.ssh.server_command is None:
+        return None
+    jobs_by_host = collections.Counter(
+        job.remote_host
+        for job_name, job in jobs.items()
+        if job.remote_host is not None and job_name in certificates
+    )
+    remote_hosts = [host for host, count in jobs_by_host.items() if count > 1]
+    if len(remote_hosts) == 0:
+        return None
+    # They are all the same with a `server_command`:
+    certificate = next(iter(certificates.values()))
+    return await stack.enter_async_context(
+        open_masters(
+            remote_hosts,
+            cfg.ssh.private_key,
+            certificate,
+            cfg.runner.kill_grace_period,
+        )
+    )
+
+
+def _tail(capture: StreamCapture | None) -> str:
+    if capture is None:
+        return ""
+    tail = capture.tail[-LEDGER_TAIL_SIZE:]
+    return tail.decode("utf-8", errors="replace")
+
+
+async def _run_job(
+    cfg: config.Config,
+    digest: Digest,
+    job_metrics: list[JobMetrics],
+    mounts: utils.MountTable,
+    job_name: str,
+    job: config.BackupJob,
+    certificate: Path | None,
+    upload_limit: int | None,
+    control_path: str | None = None,
+) -> None:
+    started_at = time.time()
+    if not mounts.is_mounted(Path(job.local_path)):
+        msg = f'The filesystem associated with job "{job_name}" is not mounted'
+        logger.error(msg)
+        subject = "{type} backup job #{name} FAILED on {host}".format(
+            type=job.type.value,
+            name=job_name,
+            host=socket.gethostname(),
+        )
+        digest.add(
+            JobReport.from_job(
+                job_name,
+                subject,
+                succeeded=False,
+                exec_log=(msg, "The backup job could not run."),
+            )
+        )
+        job_metrics.append(
+            JobMetrics(
+                name=job_name,
+                type=job.type.value,
+                status="failed",
+                started_at=started_at,
+                duration=time.time() - started_at,
+                cpu_time=0.0,
+                stderr_tail=msg,
+            )
+        )
+        return
+
+    with utils.make_tmp_dir(suffix="backups") as tmp_dir:
+        backup_job = BackupJob.from_name_and_config(
+            job_name,
+            cfg,
+            tmp_dir,
+            certificate,
+            upload_limit,
+            control_path,
+        )
+        try:
+            job_result = await backup_job.run()
+        except asyncio.CancelledError:
+            job_metrics.append(
+                JobMetrics(
+                    name=job_name,
+                    type=job.type.value,
+                    status=JobStatus.INTERRUPTED.name.lower(),
+                    started_at=started_at,
+                    duration=time.time() - started_at,
+                    cpu_time=0.0,
+                    stderr_tail="The job got interrupted by the runner.",
+                )
+            )
+            raise
+        assert job_result.status is not None
+        metrics = JobMetrics(
+            name=job_name,
+            type=job.type.value,
+            status=job_result.status.name.lower(),
+            started_at=job_result.started_at,
+            duration=job_result.duration,
+            cpu_time=job_result.cpu_time,
+            stats=job_result.stats,
+            stderr_tail=_tail(job_result.stderr),
+        )
+        job_metrics.append(metrics)
+        # The captures are deleted with the temporary directory:
+        report = await asyncio.to_thread(
+            JobReport.from_job,
+            job_name,
+            backup_job.subject(status=job_result.status.value),
+            succeeded=metrics.succeeded,
+            exec_log=job_result.log,
+            stdout=job_result.stdout,
+            stderr=job_result.stderr,
+            max_attachment_size=cfg.report.max_attachment_size * 1024,
+        )
+        digest.add(report)
+
+
+def setup_debug_script(
+    cfg: config.Config,
+    job_name: str,
+    host_fqdn: str,
+) -> Path:
+    job = cfg.jobs_by_name.get(job_name)
+    if job is None or job.local_host != host_fqdn:
+        raise ValueError(f"Job {job_name} not found on this host")
+
+    tmp_dir = Path(tempfile.mkdtemp(suffix=job_name, prefix="backups"))
+    BackupJob.from_name_and_config(job_name, cfg, tmp_dir).setup_debug_script()
+    return tmp_dir
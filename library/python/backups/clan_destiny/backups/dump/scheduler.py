@@ -0,0 +1,71 @@
+import asyncio
+import collections
+import contextlib
+import os
+
+from collections.abc import Awaitable, Callable, Mapping
+from pathlib import Path
+
+from clan_destiny.backups import config
+
+
+class Scheduler:
+    """Run backup jobs concurrently within the limits of `config.Runner`.
+
+    A job first takes a slot on its local filesystem, then one on its remote
+    host (if any) and finally a global slot. Slots are always taken in that
+    order so that jobs cannot deadlock each other, and a job waiting on a busy
+    host or disk does not hold a global slot that another job could use.
+
+    ``remote_host_limits`` overrides `config.Runner.max_jobs_per_remote_host`
+    for specific remote hosts.
+    """
+
+    def __init__(
+        self,
+        limits: config.Runner,
+        remote_host_limits: Mapping[str, int] | None = None,
+    ) -> None:
+        self._global: asyncio.Semaphore = asyncio.Semaphore(limits.max_jobs)
+        self._by_remote_host: dict[str, asyncio.Semaphore] = {
+            remote_host: asyncio.Semaphore(limit)
+            for remote_host, limit in (remote_host_limits or {}).items()
+        }
+        self._max_jobs_per_remote_host: int = limits.max_jobs_per_remote_host
+        self._by_filesystem: collections.defaultdict[int, asyncio.Semaphore]
+        self._by_filesystem = collections.defaultdict(
+            lambda: asyncio.Semaphore(limits.max_jobs_per_filesystem)
+        )
+
+    async def run[T](
+        self,
+        local_path: str,
+        remote_host: str | None,
+        job: Callable[[], Awaitable[T]],
+    ) -> T:
+        async with contextlib.AsyncExitStack() as slots:
+            filesystem = filesystem_id(local_path)
+            await slots.enter_async_context(self._by_filesystem[filesystem])
+            if remote_host is not None:
+                if remote_host not in self._by_remote_host:
+                    limit = self._max_jobs_per_remote_host
+                    self._by_remote_host[remote_host] = asyncio.Semaphore(limit)
+                slot = self._by_remote_host[remote_host]
+                await slots.enter_async_context(slot)
+            await slots.enter_async_context(self._global)
+            return await job()
+
+
+def filesystem_id(path: str) -> int:
+    """Return the device number of the filesystem ``path`` resides on.
+
+    The path does not have to exist (e.g. the destination of a pull that never
+    ran), in which case the closest existing parent directory is used.
+    """
+    filepath = Path(path)
+    for candidate in (filepath, *filepath.parents):
+        try:
+            return os.stat(candidate).st_dev
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(f"None of the parents of {path} exist")
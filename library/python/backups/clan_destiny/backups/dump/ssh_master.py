@@ -0,0 +1,124 @@
+"""One authenticated SSH connection per remote host, shared by its rsync jobs.
+
+The ssh commands of the jobs go through the master connection of their host
+when they are given its ``ControlPath``, and connect on their own when there
+is none. This only works when the jobs share a certificate, that is with
+`config.SSH.server_command`: whatever runs over a master connection is what
+the certificate it authenticated with forces.
+"""
+
+import asyncio
+import contextlib
+import logging
+
+from collections.abc import AsyncIterator, Iterable
+from pathlib import Path
+
+from clan_destiny.backups import utils
+from clan_destiny.backups.process import ChildProcess, terminate_process_group
+
+logger = logging.getLogger("backups.dump.ssh_master")
+
+# In seconds, how long a master connection has to authenticate:
+CONNECT_TIMEOUT = 30
+# In seconds, how often to check if a master connection is up:
+POLL_INTERVAL = 0.1
+
+
+def _ssh_options(control_path: str) -> list[str]:
+    return [
+        "-o",
+        "BatchMode=yes",
+        # Compression is a property of the master connection, and rsync
+        # already does it:
+        "-o",
+        "Compression=no",
+        "-o",
+        f"ControlPath={control_path}",
+        "-o",
+        "VisualHostKey=no",
+    ]
+
+
+async def _is_up(remote_host: str, control_path: str) -> bool:
+    cmd = ["ssh", *_ssh_options(control_path), "-O", "check", remote_host]
+    process = await ChildProcess.spawn(cmd)
+    return await process.wait() == 0
+
+
+async def _connect(
+    remote_host: str,
+    control_path: str,
+    identity_file: Path,
+    certificate_file: Path,
+) -> ChildProcess | None:
+    cmd = [
+        "ssh",
+        "-N",  # the jobs open their own sessions
+        *_ssh_options(control_path),
+        "-o",
+        "ControlMaster=yes",
+        "-i",
+        str(identity_file),
+        "-i",
+        str(certificate_file),
+        remote_host,
+    ]
+    process = await ChildProcess.spawn(cmd)
+    wait = asyncio.create_task(process.wait())
+    try:
+        async with asyncio.timeout(CONNECT_TIMEOUT):
+            while not wait.done():
+                if await _is_up(remote_host, control_path):
+                    return process
+                _ = await asyncio.wait((wait,), timeout=POLL_INTERVAL)
+    except TimeoutError:
+        pass
+    finally:
+        _ = wait.cancel()
+    error = b""
+    if wait.done() and not wait.cancelled():
+        error = await process.stderr.read()
+    else:
+        _ = await terminate_process_group(process, grace_period=1)
+    logger.warning(
+        f"Could not open a master connection to {remote_host}, its jobs will "
+        f"connect on their own: {error.decode('utf-8', errors='replace').strip()}"
+    )
+    return None
+
+
+@contextlib.asynccontextmanager
+async def open_masters(
+    remote_hosts: Iterable[str],
+    identity_file: Path,
+    certificate_file: Path,
+    kill_grace_period: int = 30,
+) -> AsyncIterator[str]:
+    """Connect to each of ``remote_hosts`` and yield the ``ControlPath`` the
+    ssh commands to those hosts should use, see `RsyncCommands.mirror_copy`.
+
+    The connections are closed on the way out.
+    """
+
+    with utils.make_tmp_dir(prefix="backups-ssh-") as control_dir:
+        # ssh expands %C to a hash of the host, port and user, one socket
+        # per host that stays short enough for a unix socket:
+        control_path = str(control_dir / "%C")
+        connections = await asyncio.gather(
+            *(
+                _connect(host, control_path, identity_file, certificate_file)
+                for host in remote_hosts
+            )
+        )
+        masters = [process for process in connections if process is not None]
+        logger.info(f"Opened {len(masters)} master SSH connection(s)")
+        try:
+            yield control_path
+        finally:
+            _ = await asyncio.gather(
+                *(
+                    terminate_process_group(process, kill_grace_period)
+                    for process in masters
+                )
+            )
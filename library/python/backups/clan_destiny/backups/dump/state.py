@@ -0,0 +1,32 @@
+import logging
+import pydantic
+
+from pathlib import Path
+from typing import Self
+
+from clan_destiny.backups import config, utils
+
+logger = logging.getLogger("backups.dump.state")
+
+
+class State(config.BaseModel):
+    """What a job remembers between runs, kept as JSON under `state_dir`.
+
+    A missing or invalid file gives the default state, which must always be
+    safe to start from.
+    """
+
+    @classmethod
+    def load(cls, path: Path) -> Self:
+        try:
+            return cls.model_validate_json(path.read_bytes())
+        except FileNotFoundError:
+            return cls()
+        except (OSError, pydantic.ValidationError) as ex:
+            logger.warning(f"Ignoring invalid state in {path}: {ex}")
+            return cls()
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        contents = self.model_dump_json(by_alias=True).encode("utf-8")
+        utils.replace_file(path, contents, mode=0o600)
@@ -0,0 +1,186 @@
+"""A record of the outcome of every backup job run, in SQLite.
+
+The dump runner appends to it at the end of each run and ``backups status``
+queries it. The database is in WAL mode so that queries do not block the
+runner and the other way around.
+"""
+
+import contextlib
+import sqlite3
+import time
+
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import NamedTuple, Self
+
+# The name of the ledger in `config.Config.state_dir`:
+FILENAME = "ledger.sqlite3"
+
+_SCHEMA_VERSION = 1
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    ended_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    bytes_moved INTEGER,
+    stderr_tail TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS runs_by_job ON runs (job, started_at);
+CREATE INDEX IF NOT EXISTS runs_by_started_at ON runs (started_at);
+-- The runs that count as successful, `last_successes` must spell out the same
+-- condition for SQLite to use this index:
+CREATE INDEX IF NOT EXISTS successes_by_job ON runs (job, started_at)
+    WHERE status IN ('succeeded', 'skipped');
+CREATE INDEX IF NOT EXISTS durations_by_job ON runs (job, duration)
+    WHERE status = 'succeeded';
+PRAGMA user_version = {_SCHEMA_VERSION};
+"""
+
+
+class Run(NamedTuple):
+    job: str
+    type: str
+    status: str
+    # In seconds since the epoch:
+    started_at: float
+    duration: float
+    # Over the network, if the job reported it:
+    bytes_moved: int | None = None
+    stderr_tail: str = ""
+
+
+class SlowRun(NamedTuple):
+    job: str
+    started_at: float
+    duration: float
+    # Of the successful runs of the job:
+    p90: float
+
+
+class Ledger:
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self._db: sqlite3.Connection = db
+
+    @classmethod
+    @contextlib.contextmanager
+    def open(cls, path: Path, readonly: bool = False) -> Iterator[Self]:
+        """Open the ledger at ``path``, creating it unless ``readonly``.
+
+        Raises `FileNotFoundError` if ``readonly`` and there is no ledger.
+        """
+
+        if readonly:
+            if not path.exists():
+                raise FileNotFoundError(f"No ledger at {path}")
+            uri = f"{path.absolute().as_uri()}?mode=ro"
+            db = sqlite3.connect(uri, uri=True, timeout=30)
+        else:
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            db = sqlite3.connect(path, timeout=30)
+        try:
+            if not readonly:
+                _ = db.execute("PRAGMA journal_mode = WAL")
+                _ = db.execute("PRAGMA synchronous = NORMAL")
+                (version,) = db.execute("PRAGMA user_version").fetchone()
+                if version < _SCHEMA_VERSION:
+                    _ = db.executescript(_SCHEMA)
+            yield cls(db)
+        finally:
+            db.close()
+
+    def record(self, runs: Iterable[Run], retention_days: int | None = None) -> None:
+        """Append ``runs``, and forget runs older than ``retention_days``."""
+
+        with self._db:
+            _ = self._db.executemany(
+                "INSERT INTO runs ("
+                "  job, type, status, started_at, ended_at, duration,"
+                "  bytes_moved, stderr_tail"
+                ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        run.job,
+                        run.type,
+                        run.status,
+                        run.started_at,
+                        run.started_at + run.duration,
+                        run.duration,
+                        run.bytes_moved,
+                        run.stderr_tail,
+                    )
+                    for run in runs
+                ),
+            )
+            if retention_days is not None:
+                cutoff = time.time() - retention_days * 24 * 3600
+                _ = self._db.execute(
+                    "DELETE FROM runs WHERE started_at < ?",
+                    (cutoff,),
+                )
+
+    def last_successes(self) -> dict[str, float | None]:
+        """When each job last succeeded, None if it never did."""
+
+        rows = self._db.execute(
+            """
+            WITH jobs AS (
+                SELECT DISTINCT job FROM runs
+            ), successes AS (
+                SELECT job, MAX(started_at) AS started_at FROM runs
+                WHERE status IN ('succeeded', 'skipped') GROUP BY job
+            )
+            SELECT jobs.job, successes.started_at
+            FROM jobs LEFT JOIN successes USING (job)
+            ORDER BY jobs.job
+            """
+        )
+        return dict(rows.fetchall())
+
+    def not_successful_since(self, cutoff: float) -> dict[str, float | None]:
+        """The jobs that did not succeed since ``cutoff``, and their last
+        success, None if they never succeeded.
+        """
+
+        return {
+            job: last_success
+            for job, last_success in self.last_successes().items()
+            if last_success is None or last_success < cutoff
+        }
+
+    def slower_than_p90(self, min_runs: int = 5) -> list[SlowRun]:
+        """The jobs whose last run took longer than 90% of their previous
+        successful runs, if they had at least ``min_runs`` of them.
+        """
+
+        rows = self._db.execute(
+            """
+            WITH last AS (
+                SELECT job, MAX(started_at) AS started_at FROM runs GROUP BY job
+            ), ranked AS (
+                SELECT job, duration,
+                    PERCENT_RANK() OVER job_runs AS rank,
+                    COUNT(*) OVER job_runs AS count
+                FROM runs JOIN last USING (job)
+                WHERE status = 'succeeded' AND runs.started_at < last.started_at
+                WINDOW job_runs AS (
+                    PARTITION BY job ORDER BY duration
+                    RANGE BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                )
+            ), p90 AS (
+                SELECT job, MIN(duration) AS duration
+                FROM ranked WHERE rank >= 0.9 AND count >= ? GROUP BY job
+            )
+            SELECT runs.job, runs.started_at, runs.duration, p90.duration
+            FROM last
+            JOIN runs USING (job, started_at)
+            JOIN p90 USING (job)
+            WHERE runs.duration > p90.duration
+            ORDER BY runs.job
+            """,
+            (min_runs,),
+        )
+        return [SlowRun(*row) for row in rows.fetchall()]
@@ -0,0 +1,111 @@
+"""Child processes driven from asyncio, see `ChildProcess`."""
+
+import asyncio
+import contextlib
+import os
+import resource
+import signal
+import subprocess
+
+from collections.abc import Mapping, Sequence
+from typing import Self
+
+
+class ChildProcess:
+    """A child process in its own process group, driven from asyncio.
+
+    Unlike `asyncio.subprocess.Process` the exit status is collected with
+    wait4(2) so that the CPU time used by the process, and by the children it
+    waited for, is available in `rusage` once it exited.
+    """
+
+    def __init__(
+        self,
+        popen: subprocess.Popen[bytes],
+        stdout: asyncio.StreamReader,
+        stderr: asyncio.StreamReader,
+    ) -> None:
+        self._popen: subprocess.Popen[bytes] = popen
+        self.pid: int = popen.pid
+        self.stdout: asyncio.StreamReader = stdout
+        self.stderr: asyncio.StreamReader = stderr
+        self.returncode: int | None = None
+        self.rusage: resource.struct_rusage | None = None
+
+    @classmethod
+    async def spawn(
+        cls,
+        cmd: Sequence[str],
+        env: Mapping[str, str] | None = None,
+    ) -> Self:
+        loop = asyncio.get_running_loop()
+        popen = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+        readers = []
+        for pipe in (popen.stdout, popen.stderr):
+            reader = asyncio.StreamReader()
+            protocol = asyncio.StreamReaderProtocol(reader)
+            _ = await loop.connect_read_pipe(lambda: protocol, pipe)
+            readers.append(reader)
+        return cls(popen, *readers)
+
+    @property
+    def cpu_time(self) -> float:
+        if self.rusage is None:
+            return 0.0
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
+    async def wait(self) -> int:
+        if self.returncode is not None:
+            return self.returncode
+
+        loop = asyncio.get_running_loop()
+        pidfd = os.pidfd_open(self.pid)
+        try:
+            exited = loop.create_future()
+
+            def on_exit() -> None:
+                if not exited.done():
+                    exited.set_result(None)
+
+            loop.add_reader(pidfd, on_exit)
+            try:
+                await exited
+            finally:
+                _ = loop.remove_reader(pidfd)
+        finally:
+            os.close(pidfd)
+
+        _, status, self.rusage = os.wait4(self.pid, 0)
+        self.returncode = os.waitstatus_to_exitcode(status)
+        # Keep Popen from trying to reap the process again:
+        self._popen.returncode = self.returncode
+        return self.returncode
+
+
+async def terminate_process_group(
+    process: ChildProcess,
+    grace_period: float,
+) -> int:
+    """Stop ``process`` and every process in its group.
+
+    The group gets SIGTERM, then SIGKILL if the leader did not exit within
+    ``grace_period`` seconds. Leftover processes in the group are always killed
+    once the leader is gone. Returns the exit status of the leader.
+    """
+    pgid = process.pid
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(pgid, signal.SIGTERM)
+    try:
+        async with asyncio.timeout(grace_period):
+            returncode = await process.wait()
+    except TimeoutError:
+        returncode = None
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(pgid, signal.SIGKILL)
+    return returncode if returncode is not None else await process.wait()
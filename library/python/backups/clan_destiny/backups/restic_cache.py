@@ -0,0 +1,103 @@
+"""Per-repository restic caches sharing `config.Restic.cache_dir`.
+
+Each repository gets its own cache directory under ``<cache_dir>/repos`` and
+a lock file next to it, so that concurrent jobs, restores and the pruning of
+the caches do not step on each other.
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+
+from collections.abc import Iterator
+from pathlib import Path
+from typing import NamedTuple
+
+logger = logging.getLogger("backups.restic_cache")
+
+
+class RepositoryCache:
+    def __init__(self, cache_dir: Path, name: str) -> None:
+        self.path: Path = cache_dir / "repos" / name
+        self.lock_path: Path = self.path.with_name(f"{name}.lock")
+
+    @contextlib.contextmanager
+    def lock(self, blocking: bool = True) -> Iterator[bool]:
+        """Lock the cache, yield whether it could be locked.
+
+        Locking the cache also marks it as used, for `prune`.
+        """
+
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            operation = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(fd, operation)
+            except BlockingIOError:
+                yield False
+                return
+            os.utime(fd)
+            yield True
+        finally:
+            os.close(fd)
+
+
+class _CachedFile(NamedTuple):
+    last_used: float
+    size: int
+    path: str
+
+
+def _cached_files(cache: RepositoryCache) -> Iterator[_CachedFile]:
+    for parent, _, filenames in os.walk(cache.path):
+        for filename in filenames:
+            path = os.path.join(parent, filename)
+            try:
+                info = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            # atime might only be updated daily (relatime), which is good
+            # enough to tell what was used in the last runs:
+            last_used = max(info.st_atime, info.st_mtime)
+            yield _CachedFile(last_used, info.st_size, path)
+
+
+def prune(cache_dir: Path, max_size: int) -> int:
+    """Delete the least recently used files until the caches fit in ``max_size``.
+
+    ``max_size`` is in bytes. Caches in use are left alone, but still count
+    towards the total. Restic fetches whatever is missing from its cache from
+    the repository. Returns the number of bytes freed.
+    """
+
+    repos = cache_dir / "repos"
+    if not repos.is_dir():
+        return 0
+
+    with contextlib.ExitStack() as stack:
+        total = 0
+        candidates: list[_CachedFile] = []
+        for entry in repos.iterdir():
+            if not entry.is_dir():
+                continue
+            cache = RepositoryCache(cache_dir, entry.name)
+            files = list(_cached_files(cache))
+            total += sum(file.size for file in files)
+            if stack.enter_context(cache.lock(blocking=False)):
+                candidates.extend(files)
+            else:
+                logger.info(f"Not pruning the cache of {entry.name}, it is in use")
+
+        freed = 0
+        candidates.sort()
+        for file in candidates:
+            if total - freed <= max_size:
+                break
+            try:
+                os.unlink(file.path)
+            except FileNotFoundError:
+                continue
+            freed += file.size
+    return freed
@@ -1,81 +1,419 @@
 import asyncio
 import click
+import contextlib
+import datetime
+import json
 import os
-import subprocess
+import re
+import shlex
 import sys
+import time
 
+from collections.abc import AsyncIterator, Callable, Mapping, Sequence
 from pathlib import Path
-from typing import cast
+from typing import NamedTuple
 
-from clan_destiny.backups import config, utils
+from clan_destiny.backups import config, ssh_ca, utils
+from clan_destiny.backups.cli import get_config
+from clan_destiny.backups.process import ChildProcess, terminate_process_group
+from clan_destiny.backups.restic_cache import RepositoryCache
 
+# How often the progress of each restore is printed, in seconds:
+PROGRESS_INTERVAL = 5
+# How many lines of stderr are shown when a restore fails:
+ERROR_LINES = 20
 
-def _get_config(ctx: click.Context) -> config.Config:
-    return cast(config.Config, ctx.obj)
+# What `rsync --info=progress2` prints, e.g: "  1,234,567  45%  10.00MB/s":
+_RSYNC_PROGRESS = re.compile(r"^\s*[\d,.]+[KMGT]?\s+\d+%")
 
 
-@click.command(help="Restore the given backup on this host.")
+class RestoreError(Exception):
+    pass
+
+
+class Selection(NamedTuple):
+    """What to restore from the backup of a job."""
+
+    # A restic snapshot ID, the latest snapshot by default:
+    snapshot: str | None = None
+    # Use the latest restic snapshot taken at or before that:
+    at: datetime.datetime | None = None
+    include: tuple[str, ...] = ()
+    exclude: tuple[str, ...] = ()
+
+
+class Progress:
+    """Print what a restore is doing, prefixed by the job name."""
+
+    def __init__(self, job_name: str, verbose: bool) -> None:
+        self.job_name: str = job_name
+        self.verbose: bool = verbose
+        self._last_report: float = 0.0
+
+    def echo(self, message: str) -> None:
+        click.echo(f"[{self.job_name}] {message}")
+
+    def file(self, path: str) -> None:
+        if self.verbose:
+            self.echo(path)
+
+    def report(self, message: str, final: bool = False) -> None:
+        now = time.monotonic()
+        if final or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.echo(message)
+
+
+async def _lines(stream: asyncio.StreamReader) -> AsyncIterator[str]:
+    # rsync ends its progress lines with \r:
+    pending = b""
+    while chunk := await stream.read(64 * 1024):
+        *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+        for line in lines:
+            if line:
+                yield line.decode("utf-8", errors="replace")
+    if pending:
+        yield pending.decode("utf-8", errors="replace")
+
+
+async def _run(
+    cmd: Sequence[str],
+    env: Mapping[str, str] | None,
+    on_line: Callable[[str], None],
+) -> None:
+    """Run ``cmd``, pass each line of its stdout to ``on_line``."""
+
+    process = await ChildProcess.spawn(cmd, env)
+    stderr = asyncio.create_task(process.stderr.read())
+    try:
+        async for line in _lines(process.stdout):
+            on_line(line)
+        returncode = await process.wait()
+        errors = await stderr
+    except asyncio.CancelledError:
+        _ = await terminate_process_group(process, grace_period=10)
+        _ = stderr.cancel()
+        raise
+    if returncode != 0:
+        lines = errors.decode("utf-8", errors="replace").splitlines()
+        details = "\n".join(lines[-ERROR_LINES:])
+        raise RestoreError(f"{cmd[0]} exited with {returncode}:\n{details}")
+
+
+def _restic_env(
+    cfg: config.Config,
+    job_name: str,
+    job_cfg: config.BackupJob,
+    cache: RepositoryCache,
+) -> dict[str, str]:
+    assert cfg.restic is not None, "restic-b2 jobs require restic configuration"
+    return os.environ | {
+        "B2_ACCOUNT_ID": cfg.restic.b2.key_id,
+        "B2_ACCOUNT_KEY": cfg.restic.b2.application_key,
+        "RESTIC_REPOSITORY": f"b2:{cfg.restic.b2.bucket}:{job_name}",
+        "RESTIC_PASSWORD_FILE": str(job_cfg.password_path),
+        "RESTIC_CACHE_DIR": str(cache.path),
+    }
+
+
+async def _restic_snapshot_at(env: Mapping[str, str], at: datetime.datetime) -> str:
+    output: list[str] = []
+    await _run(("restic", "--quiet", "snapshots", "--json"), env, output.append)
+    try:
+        snapshots = [
+            (datetime.datetime.fromisoformat(snapshot["time"]), snapshot["id"])
+            for snapshot in json.loads("".join(output))
+        ]
+    except (ValueError, KeyError, TypeError) as ex:
+        raise RestoreError(f"Could not list the snapshots: {ex}") from ex
+    candidates = [snapshot for snapshot in snapshots if snapshot[0] <= at]
+    if not candidates:
+        raise RestoreError(f"No snapshot taken before {at}")
+    _, snapshot_id = max(candidates)
+    return snapshot_id
+
+
+def _restic_progress(progress: Progress, line: str) -> None:
+    try:
+        message = json.loads(line)
+    except json.JSONDecodeError:
+        progress.echo(line)
+        return
+    match message.get("message_type"):
+        case "verbose_status":
+            progress.file(message.get("item", ""))
+        case "status":
+            progress.report(
+                "{:.0%} done, {}/{} files restored".format(
+                    message.get("percent_done", 0),
+                    message.get("files_restored", 0),
+                    message.get("total_files", 0),
+                )
+            )
+        case "summary":
+            progress.report(
+                "{}/{} files restored".format(
+                    message.get("files_restored", 0),
+                    message.get("total_files", 0),
+                ),
+                final=True,
+            )
+
+
+async def _restore_restic(
+    cfg: config.Config,
+    job_name: str,
+    job_cfg: config.BackupJob,
+    dest_path: str,
+    selection: Selection,
+    progress: Progress,
+) -> None:
+    assert cfg.restic is not None, "restic-b2 jobs require restic configuration"
+    cache = RepositoryCache(cfg.restic.cache_dir, job_name)
+    env = _restic_env(cfg, job_name, job_cfg, cache)
+    with contextlib.ExitStack() as stack:
+        # Wait for a backup of the same repository to finish:
+        _ = await asyncio.to_thread(stack.enter_context, cache.lock())
+        snapshot = selection.snapshot or "latest"
+        if selection.at is not None:
+            snapshot = await _restic_snapshot_at(env, selection.at)
+        cmd = ["restic", "--json", "restore"]
+        if progress.verbose:
+            cmd.append("--verbose")
+        for pattern in selection.include:
+            cmd.extend(("--include", pattern))
+        for pattern in selection.exclude:
+            cmd.extend(("--exclude", pattern))
+        # You shouldn't actually set target: Restic backups include the full
+        # realpath so that you restore does not need any path to be
+        # specified. If you desire to restore a backup to a different path,
+        # then you don't only need to know that new different path but also
+        # the original path so that you can dereference it throught the
+        # snapshotID:subfolder notation.
+        cmd.extend(("--target", dest_path, snapshot))
+        progress.echo(f"Restoring restic snapshot {snapshot} to {dest_path}")
+        await _run(cmd, env, lambda line: _restic_progress(progress, line))
+
+
+async def _restore_rsync(
+    cfg: config.Config,
+    job_name: str,
+    job_cfg: config.BackupJob,
+    dest_path: str,
+    selection: Selection,
+    progress: Progress,
+) -> None:
+    from clan_destiny.backups.dump.job import RsyncBackupJob
+    from clan_destiny.backups.dump.rsync import RsyncCommands, filter_options
+
+    assert cfg.ssh is not None, "rsync jobs require ssh configuration"
+    assert cfg.ssh.private_key is not None
+    assert job_cfg.remote_host is not None and job_cfg.remote_path is not None
+    if selection.snapshot is not None or selection.at is not None:
+        raise RestoreError("rsync backups only have the latest version")
+
+    # Run the dump the other way around:
+    if job_cfg.direction == config.BackupDirection.PUSH:
+        direction = config.BackupDirection.PULL
+        local_path, remote_path = dest_path, job_cfg.remote_path
+        target = dest_path
+    else:
+        direction = config.BackupDirection.PUSH
+        local_path, remote_path = job_cfg.local_path, dest_path
+        target = f"{job_cfg.remote_host}:{dest_path}"
+    rsync_commander = RsyncCommands(job_cfg.remote_host, local_path, remote_path)
+    request = RsyncBackupJob.certificate_request(
+        job_name,
+        rsync_commander,
+        direction,
+        purpose="restore",
+    )
+    client = ssh_ca.shared_client(cfg.ssh)
+    with contextlib.ExitStack() as stack:
+        certificate = await asyncio.to_thread(
+            stack.enter_context,
+            client.issue_cert(*request),
+        )
+        info = "--info=progress2,name1" if progress.verbose else "--info=progress2"
+        cmd = rsync_commander.mirror_copy(
+            direction,
+            cfg.ssh.private_key,
+            certificate,
+            # Only applies to jobs that push. Jobs that pull are restored by
+            # pushing, and their certificate forces `--delete` on the remote
+            # side, which is why restoring them requires --mirror:
+            delete=False,
+            extra_options=(
+                info,
+                *filter_options(selection.include, selection.exclude),
+            ),
+        )
+        progress.echo(f"Restoring to {target}: {shlex.join(cmd)}")
+
+        def on_line(line: str) -> None:
+            if _RSYNC_PROGRESS.match(line):
+                progress.report(line.strip())
+            else:
+                progress.file(line)
+
+        await _run(cmd, None, on_line)
+        progress.report("Done", final=True)
+
+
+async def _restore(
+    cfg: config.Config,
+    job_name: str,
+    dest_path: str,
+    selection: Selection,
+    verbose: bool,
+    limit: asyncio.Semaphore,
+) -> bool:
+    job_cfg = cfg.jobs_by_name[job_name]
+    progress = Progress(job_name, verbose)
+    async with limit:
+        try:
+            if job_cfg.type == config.BackupType.RESTIC_B2:
+                restore_job = _restore_restic
+            else:
+                restore_job = _restore_rsync
+            await restore_job(cfg, job_name, job_cfg, dest_path, selection, progress)
+        except (RestoreError, ssh_ca.Error, OSError) as ex:
+            progress.echo(f"Restore failed: {ex}")
+            return False
+        except Exception as ex:
+            # e.g. an error from OpenBao, do not let it stop the other restores:
+            progress.echo(f"Restore failed: {type(ex).__name__}: {ex}")
+            return False
+    return True
+
+
+def _dest_path(job_cfg: config.BackupJob, dest_path: str | None) -> str:
+    if dest_path is not None:
+        return dest_path
+    if job_cfg.direction == config.BackupDirection.PUSH:
+        return job_cfg.local_path
+    assert job_cfg.remote_path is not None
+    return job_cfg.remote_path
+
+
+def _is_local(job_cfg: config.BackupJob) -> bool:
+    """Whether the data of ``job_cfg`` is restored on this host."""
+
+    return (
+        job_cfg.type == config.BackupType.RESTIC_B2
+        or job_cfg.direction == config.BackupDirection.PUSH
+    )
+
+
+@click.command(
+    help=(
+        "Restore the given backups on this host, or from this host for rsync "
+        "jobs that pull. Restores never delete files at the destination, "
+        "except when restoring rsync jobs that pull, which requires --mirror."
+    )
+)
 @click.option(
     "--dest-path",
     type=click.Path(file_okay=False, path_type=str),
     help=(
         "Restore the backup at this directory, defaults to the source path "
-        "of the backup."
+        "of the backup. Only for a single job."
     ),
 )
-@click.argument("job_name")
+@click.option("--snapshot", help="The restic snapshot to restore.")
+@click.option(
+    "--at",
+    type=click.DateTime(["%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]),
+    help="Restore the latest restic snapshot taken at or before that time.",
+)
+@click.option(
+    "--include",
+    multiple=True,
+    help="Only restore what matches this pattern, can be repeated.",
+)
+@click.option(
+    "--exclude",
+    multiple=True,
+    help="Do not restore what matches this pattern, can be repeated.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    "concurrency",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="How many backups to restore at the same time.",
+)
+@click.option(
+    "--mirror",
+    is_flag=True,
+    help=(
+        "Allow restoring rsync jobs that pull, which makes their remote path "
+        "a mirror of the backup: what is not in the backup gets deleted."
+    ),
+)
+@click.option("--verbose", "-v", is_flag=True, help="Print every restored file.")
+@click.argument("job_names", nargs=-1, required=True)
 @click.pass_context
-def restore(ctx: click.Context, dest_path: str | None, job_name: str) -> None:
-    cfg = _get_config(ctx)
+def restore(
+    ctx: click.Context,
+    dest_path: str | None,
+    snapshot: str | None,
+    at: datetime.datetime | None,
+    include: tuple[str, ...],
+    exclude: tuple[str, ...],
+    concurrency: int,
+    mirror: bool,
+    verbose: bool,
+    job_names: tuple[str, ...],
+) -> None:
+    cfg = get_config(ctx)
 
-    job_cfg = cfg.jobs_by_name.get(job_name)
-    if job_cfg is None:
-        msg = f"Could not find any backups named {job_name}"
-        click.echo(msg, err=True)
+    if dest_path is not None and len(job_names) > 1:
+        click.echo("--dest-path can only be used with a single job", err=True)
         sys.exit(1)
-
-    if job_cfg.type != config.BackupType.RESTIC_B2:
-        msg = "Only restic-b2 backups can be restored at the moment"
-        click.echo(msg, err=True)
+    if snapshot is not None and at is not None:
+        click.echo("--snapshot and --at are mutually exclusive", err=True)
         sys.exit(1)
 
-    assert cfg.restic is not None, "restic-b2 jobs require restic configuration"
+    mounts = utils.MountTable.read()
+    dest_paths = {}
+    for job_name in dict.fromkeys(job_names):
+        job_cfg = cfg.jobs_by_name.get(job_name)
+        if job_cfg is None:
+            msg = f"Could not find any backups named {job_name}"
+            click.echo(msg, err=True)
+            sys.exit(1)
+        if not _is_local(job_cfg) and not mirror:
+            msg = (
+                f"Restoring {job_name} deletes what is not in the backup at "
+                f"{job_cfg.remote_host}:{_dest_path(job_cfg, dest_path)}, "
+                "pass --mirror to do it anyway"
+            )
+            click.echo(msg, err=True)
+            sys.exit(1)
+        dest_paths[job_name] = _dest_path(job_cfg, dest_path)
+        local_dest = Path(dest_paths[job_name])
+        if _is_local(job_cfg) and not mounts.is_mounted(local_dest):
+            msg = f"The filesystem for {local_dest} must be mounted before restore"
+            click.echo(msg, err=True)
+            sys.exit(1)
 
-    if dest_path is None:
-        if job_cfg.direction == config.BackupDirection.PUSH:
-            dest_path = job_cfg.local_path
-        else:
-            dest_path = job_cfg.remote_path
-    assert dest_path is not None
-    if not asyncio.run(utils.is_mounted(Path(dest_path))):
-        msg = f"The filesystem for {dest_path} must be mounted before restore"
-        click.echo(msg, err=True)
-        sys.exit(1)
+    # Naive times are local times, like the ones restic prints:
+    at = at.astimezone() if at is not None else None
+    selection = Selection(snapshot, at, include, exclude)
 
-    click.echo(f"Restoring latest restic snapshot to {dest_path}")
-    subprocess.check_call(
-        (
-            "restic",
-            "--repo",
-            f"b2:{cfg.restic.b2.bucket}:{job_name}",
-            "--password-file",
-            str(job_cfg.password_path),
-            "--cache-dir",
-            str(cfg.restic.cache_dir),
-            "restore",
-            # You shouldn't actually set target: Restic backups include the
-            # full realpath so that you restore does not need any path to be
-            # specified. If you desire to restore a backup to a different path,
-            # then you don't only need to know that new different path but also
-            # the original path so that you can dereference it throught the
-            # snapshotID:subfolder notation.
-            "--target",
-            str(dest_path),
-            "latest",
-        ),
-        env=os.environ
-        | {
-            "B2_ACCOUNT_ID": cfg.restic.b2.key_id,
-            "B2_ACCOUNT_KEY": cfg.restic.b2.application_key,
-        },
-    )
+    async def restore_all() -> list[bool]:
+        limit = asyncio.Semaphore(concurrency)
+        restores = (
+            _restore(cfg, job_name, job_dest, selection, verbose, limit)
+            for job_name, job_dest in dest_paths.items()
+        )
+        return await asyncio.gather(*restores)
+
+    results = asyncio.run(restore_all())
+    if not all(results):
+        failed = len(results) - sum(results)
+        click.echo(f"{failed}/{len(results)} restores failed", err=True)
+        sys.exit(1)
@@ -1,22 +1,47 @@
+import base64
+import concurrent.futures
 import contextlib
+import functools
+import hashlib
 import hvac
+import logging
+import math
+import os
 import requests
 import shlex
+import struct
 import tempfile
+import threading
+import time
 
 from collections.abc import Iterable, Iterator, Sequence
 from pathlib import Path
-from typing import override
+from typing import Any, NamedTuple, override
 
-from clan_destiny.backups import config
+from clan_destiny.backups import config, utils
+from clan_destiny.backups.sshd_agent import auth_info
 
 __all__ = (
+    "CertificateCache",
+    "CertificateRequest",
     "Client",
     "Error",
+    "shared_client",
 )
 
+logger = logging.getLogger("backups.ssh_ca")
+
+
+class CertificateRequest(NamedTuple):
+    id: str
+    command: Sequence[str]
+    valid_principals: Iterable[str] = ("root",)
+
 
 class Client:
+    # Renew the token once it has less than that many seconds left:
+    TOKEN_RENEWAL_MARGIN: float = 60.0
+
     def __init__(self, cfg: config.SSH):
         session = requests.Session()
 
@@ -26,43 +51,98 @@ class Client:
             session.mount("https://", adapter)
 
         self._vault: hvac.Client = hvac.Client(url=cfg.ca.addr, session=session)
-        self._vault.auth.approle.login(
-            cfg.ca.role_id_path.read_text(),
-            cfg.ca.secret_id_path.read_text(),
-            mount_point=cfg.ca.auth_approle_path,
-        )
+        self._ca: config.OpenBao = cfg.ca
+        # The token is acquired on first use and renewed as needed:
+        self._token_lock: threading.Lock = threading.Lock()
+        self._token_expires_at: float | None = None
+        self._token_renewable: bool = False
 
         assert cfg.public_key is not None
         self._public_key: Path = cfg.public_key
         self._signer_role: str = cfg.ca.signer_role
         self._mount_point: str = cfg.ca.engine_path
+        self._certificate_ttl: int = cfg.certificate_ttl
+        self._cache: CertificateCache | None = None
+        if cfg.certificate_cache_dir is not None:
+            self._cache = CertificateCache(
+                cfg.certificate_cache_dir,
+                cfg.certificate_min_validity,
+            )
 
-    @contextlib.contextmanager
-    def issue_cert(
+    def _set_token_lease(self, auth: dict[str, Any]) -> None:
+        ttl = auth["lease_duration"]
+        # A lease duration of 0 means the token never expires:
+        self._token_expires_at = time.monotonic() + ttl if ttl > 0 else math.inf
+        self._token_renewable = auth["renewable"]
+
+    def _login(self) -> None:
+        response = self._vault.auth.approle.login(
+            self._ca.role_id_path.read_text(),
+            self._ca.secret_id_path.read_text(),
+            mount_point=self._ca.auth_approle_path,
+        )
+        self._set_token_lease(response["auth"])
+
+    def _authenticate(self) -> None:
+        with self._token_lock:
+            if self._token_expires_at is None:
+                self._login()
+                return
+            ttl = self._token_expires_at - time.monotonic()
+            if ttl > self.TOKEN_RENEWAL_MARGIN:
+                return
+            if self._token_renewable:
+                try:
+                    response = self._vault.auth.token.renew_self()
+                    self._set_token_lease(response["auth"])
+                except hvac.exceptions.VaultError:
+                    pass
+                else:
+                    # Renewals are capped by the max TTL of the token:
+                    ttl = self._token_expires_at - time.monotonic()
+                    if ttl > self.TOKEN_RENEWAL_MARGIN:
+                        return
+            self._login()
+
+    def sign(
         self,
         id: str,
         command: Sequence[str],
         valid_principals: Iterable[str] = ("root",),
-    ) -> Iterator[Path]:
+    ) -> str:
+        """Sign our public key and return the certificate in OpenSSH format.
+
+        If the certificate cache is enabled and has a certificate for the same
+        key, principals and command, then that certificate is returned instead
+        (its id might be different).
+        """
+
+        public_key = self._public_key.read_text()
+        valid_principals = ",".join(valid_principals)
+        cache_key = None
+        if self._cache is not None:
+            cache_key = self._cache.key(
+                public_key,
+                self._signer_role,
+                valid_principals,
+                command,
+            )
+            if (signed_key := self._cache.get(cache_key)) is not None:
+                return signed_key
+
+        self._authenticate()
         response = self._vault.secrets.ssh.sign_ssh_key(
             self._signer_role,
-            self._public_key.read_text(),
-            ttl="1d",
-            valid_principals=",".join(valid_principals),
+            public_key,
+            ttl=f"{self._certificate_ttl}s",
+            valid_principals=valid_principals,
             cert_type="user",
             key_id=id,
-            # In a future iteration of this we can implement some kind of
-            # well-known command to be executed server (sshd) side so that
-            # we can truly force a (static) command here. The command would
-            # then receive a "rpc call" on stdin with the job name, then
-            # generate and execute the appropriate commands based on that. This
-            # would increase security since the signer_role we use here
-            # wouldn't be able to generate arbitrary commands anymore. The
-            # server could also use the `SSH_CLIENT` and `SSH_CONNECTION` to
-            # authenticate the client based on its source IP. If we set
-            # `ExposeAuthInfo` in `sshd_config` we could also authenticate the
-            # client based on its identity, and we could juste use the host
-            # keys as the *client-side* authentication.
+            # With `config.SSH.server_command` the command is the sshd agent,
+            # the same for every job: it gets the job name from the client,
+            # authenticates it from `SSH_USER_AUTH` and `SSH_CONNECTION` and
+            # runs the rsync server for the job (see `sshd_agent.dispatch`).
+            # Otherwise this is the rsync server command of the job.
             critical_options={
                 # I wonder if the way the command gets
                 # shell-escaped matters to sshd:
@@ -78,14 +158,135 @@ class Client:
             raise Error(msg)
 
         signed_key = response["data"]["signed_key"]
-        with tempfile.NamedTemporaryFile(
-            "w",
-            encoding="utf-8",
-            prefix="clan-destiny-backups",
-        ) as certificate:
-            assert certificate.write(signed_key) == len(signed_key)
-            certificate.flush()
-            yield Path(certificate.name)
+        if self._cache is not None and cache_key is not None:
+            self._cache.put(cache_key, signed_key)
+        return signed_key
+
+    @contextlib.contextmanager
+    def issue_cert(
+        self,
+        id: str,
+        command: Sequence[str],
+        valid_principals: Iterable[str] = ("root",),
+    ) -> Iterator[Path]:
+        signed_key = self.sign(id, command, valid_principals)
+        with _certificate_file(signed_key) as certificate:
+            yield certificate
+
+    @contextlib.contextmanager
+    def issue_certs(
+        self,
+        certificate_requests: Iterable[CertificateRequest],
+        max_workers: int = 4,
+    ) -> Iterator[dict[str, Path]]:
+        """Sign several certificates concurrently, yield them by id.
+
+        This re-uses the same token and connection pool for all the
+        certificates, a single login is done if needed, and only when a
+        certificate isn't in the cache.
+        """
+
+        with (
+            concurrent.futures.ThreadPoolExecutor(max_workers) as executor,
+            contextlib.ExitStack() as certificates,
+        ):
+            # Jobs using the sshd agent all share the same certificate:
+            unique_requests = {request.id: request for request in certificate_requests}
+            signed_keys = {
+                id: executor.submit(self.sign, *request)
+                for id, request in unique_requests.items()
+            }
+            yield {
+                id: certificates.enter_context(_certificate_file(signed_key.result()))
+                for id, signed_key in signed_keys.items()
+            }
+
+
+class CertificateCache:
+    """Keep signed certificates on disk to re-use them until they expire.
+
+    This saves a round-trip to OpenBao, and an entry in its audit log, each
+    time a job is retried. It also lets backups run through short OpenBao
+    outages. Certificates are only readable by the user running the backups.
+    """
+
+    def __init__(self, directory: Path, min_validity: int) -> None:
+        self._directory: Path = directory
+        self._min_validity: int = min_validity
+
+    @classmethod
+    def key(
+        cls,
+        public_key: str,
+        signer_role: str,
+        valid_principals: str,
+        command: Sequence[str],
+    ) -> str:
+        match public_key.split():
+            case (_, encoded_key, *_):
+                fingerprint = hashlib.sha256(base64.b64decode(encoded_key))
+            case _:
+                raise Error("Invalid public key for the certificate cache")
+        key = hashlib.sha256(fingerprint.digest())
+        for field in (signer_role, valid_principals, shlex.join(command)):
+            encoded_field = field.encode()
+            key.update(struct.pack(">I", len(encoded_field)) + encoded_field)
+        return key.hexdigest()
+
+    def _open(self) -> None:
+        if not utils.private_dir(self._directory):
+            msg = (
+                f"The certificate cache at {self._directory} must be owned "
+                f"by uid {os.geteuid()} and not be accessible to anyone else"
+            )
+            raise Error(msg)
+
+    def get(self, key: str) -> str | None:
+        """Return the certificate for ``key`` if it is valid for long enough.
+
+        Expired certificates are evicted from the cache.
+        """
+
+        self._open()
+        now = time.time()
+        found = None
+        for entry in self._directory.glob("*-cert.pub"):
+            try:
+                signed_key = entry.read_text()
+                valid_before = auth_info.Certificate.decode(signed_key).valid_before
+            except (OSError, auth_info.InvalidAuthInfo) as ex:
+                logger.warning(f"Evicting invalid certificate {entry}: {ex}")
+                valid_before = 0
+            if valid_before <= now:
+                entry.unlink(missing_ok=True)
+            elif entry.name == f"{key}-cert.pub":
+                if valid_before - now >= self._min_validity:
+                    found = signed_key
+        return found
+
+    def put(self, key: str, signed_key: str) -> None:
+        self._open()
+        path = self._directory / f"{key}-cert.pub"
+        utils.replace_file(path, signed_key.encode("utf-8"), mode=0o600)
+
+
+@functools.cache
+def shared_client(cfg: config.SSH) -> Client:
+    """Return the client for ``cfg`` shared within the process."""
+
+    return Client(cfg)
+
+
+@contextlib.contextmanager
+def _certificate_file(signed_key: str) -> Iterator[Path]:
+    with tempfile.NamedTemporaryFile(
+        "w",
+        encoding="utf-8",
+        prefix="clan-destiny-backups",
+    ) as certificate:
+        assert certificate.write(signed_key) == len(signed_key)
+        certificate.flush()
+        yield Path(certificate.name)
 
 
 class Error(Exception):
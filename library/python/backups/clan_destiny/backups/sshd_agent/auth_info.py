@@ -1,78 +1,232 @@
+"""Parse the OpenSSH certificates sshd exposes in `SSH_USER_AUTH`.
+
+The certificate format is defined in draft-miller-ssh-cert-06 section 2.1.
+Fields are read from the decoded certificate through a `memoryview`, only the
+text fields are copied out of it.
+"""
+
 import base64
+import binascii
+import enum
+import hashlib
 import struct
 
 from pathlib import Path
+from typing import NamedTuple, Self
 
 
 class InvalidAuthInfo(Exception):
     pass
 
 
-def parse(file: Path) -> str:
-    """Extract the EDDSA public key from an SSH certificate in auth info.
+class CertificateType(enum.IntEnum):
+    USER = 1
+    HOST = 2
 
-    The certificate format is defined in draft-miller-ssh-cert-06 section 2.1.4.
-    """
-    match file.read_text().strip().split(" "):
-        case ("publickey", "ssh-ed25519-cert-v01@openssh.com", certificate):
-            pass
-        case parts:
+
+# The type of the certified key and the number of strings or mpints in it,
+# for each type of certificate:
+_KEY_TYPES: dict[bytes, tuple[bytes, int]] = {
+    b"ssh-rsa-cert-v01@openssh.com": (b"ssh-rsa", 2),
+    b"ssh-dss-cert-v01@openssh.com": (b"ssh-dss", 4),
+    b"ecdsa-sha2-nistp256-cert-v01@openssh.com": (b"ecdsa-sha2-nistp256", 2),
+    b"ecdsa-sha2-nistp384-cert-v01@openssh.com": (b"ecdsa-sha2-nistp384", 2),
+    b"ecdsa-sha2-nistp521-cert-v01@openssh.com": (b"ecdsa-sha2-nistp521", 2),
+    b"sk-ecdsa-sha2-nistp256-cert-v01@openssh.com": (
+        b"sk-ecdsa-sha2-nistp256@openssh.com",
+        3,
+    ),
+    b"ssh-ed25519-cert-v01@openssh.com": (b"ssh-ed25519", 1),
+    b"sk-ssh-ed25519-cert-v01@openssh.com": (b"sk-ssh-ed25519@openssh.com", 2),
+}
+
+
+class Certificate(NamedTuple):
+    # The type of the certified key, e.g. ssh-ed25519:
+    key_type: str
+    # SHA-256 of the certified key in the SSH wire format, like in OpenSSH
+    # fingerprints, see `public_key_digest`:
+    key_digest: bytes
+    serial: int
+    type: CertificateType
+    key_id: str
+    valid_principals: tuple[str, ...]
+    # In seconds since the epoch:
+    valid_after: int
+    valid_before: int
+    # The value of options that are flags is empty:
+    critical_options: dict[str, str]
+    extensions: dict[str, str]
+    # SHA-256 of the key of the CA in the SSH wire format:
+    signature_key_digest: bytes
+
+    @classmethod
+    def decode(cls, certificate: str) -> Self:
+        """Parse a certificate in the format of OpenSSH ``-cert.pub`` files."""
+
+        match certificate.split():
+            case (_, encoded, *_):
+                pass
+            case _:
+                raise InvalidAuthInfo("Expected an OpenSSH certificate")
+        try:
+            data = base64.b64decode(encoded, validate=True)
+        except binascii.Error as ex:
+            raise InvalidAuthInfo(f"Certificate is not valid base64: {ex}") from ex
+        return cls.from_bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Self:
+        view = memoryview(data)
+
+        cert_type, offset = read_string(view, 0)
+        try:
+            key_type, key_fields = _KEY_TYPES[bytes(cert_type)]
+        except KeyError:
             raise InvalidAuthInfo(
-                f"Expected an Ed25519 certificate in "
-                f"`SSH_USER_AUTH` got: {parts[:2]}"
-            )
+                f"Unsupported certificate type {bytes(cert_type)!r}"
+            ) from None
+        _, offset = read_string(view, offset)  # nonce
 
-    try:
-        data = base64.b64decode(certificate)
-    except Exception as e:
-        reason = f"`SSH_USER_AUTH` is not valid base64: {e}"
-        raise InvalidAuthInfo(reason) from e
+        key_start = offset
+        for _ in range(key_fields):
+            _, offset = read_string(view, offset)
+        # The certified key in wire format is its type followed by the fields
+        # we just skipped, hash it without copying them:
+        digest = hashlib.sha256(struct.pack(">I", len(key_type)) + key_type)
+        digest.update(view[key_start:offset])
 
-    offset = 0
+        serial, type, offset = _read_uint64_uint32(view, offset)
+        try:
+            type = CertificateType(type)
+        except ValueError:
+            raise InvalidAuthInfo(f"Unknown certificate type {type}") from None
+        key_id, offset = read_string(view, offset)
+        principals, offset = read_string(view, offset)
+        valid_after, valid_before, offset = _read_validity(view, offset)
+        critical_options, offset = read_string(view, offset)
+        extensions, offset = read_string(view, offset)
+        _, offset = read_string(view, offset)  # reserved
+        signature_key, offset = read_string(view, offset)
+        _, offset = read_string(view, offset)  # signature
+        if offset != len(view):
+            raise InvalidAuthInfo(
+                f"Invalid certificate: {len(view) - offset} trailing bytes"
+            )
 
-    # Field 1: certificate type
-    cert_type, offset = read_string(data, offset)
-    expected_type = b"ssh-ed25519-cert-v01@openssh.com"
-    if cert_type != expected_type:
-        raise InvalidAuthInfo(
-            f"Expected {expected_type!r} certificate in "
-            f"`SSH_USER_AUTH`, got {cert_type!r}"
+        return cls(
+            key_type=key_type.decode("ascii"),
+            key_digest=digest.digest(),
+            serial=serial,
+            type=type,
+            key_id=_text(key_id),
+            valid_principals=tuple(_text(each) for each in _strings(principals)),
+            valid_after=valid_after,
+            valid_before=valid_before,
+            critical_options=_options(critical_options),
+            extensions=_options(extensions),
+            signature_key_digest=hashlib.sha256(signature_key).digest(),
         )
 
-    # Field 2: nonce (skip it)
-    _, offset = read_string(data, offset)
 
-    # Field 3: pk (the public key we want)
-    pk, _ = read_string(data, offset)
-    if len(pk) != 32:
-        raise InvalidAuthInfo(
-            f"Expected 32-byte Ed25519 public key in "
-            f"`SSH_USER_AUTH`, got {len(pk)} bytes"
-        )
+def parse(file: Path) -> list[Certificate]:
+    """Parse the certificates the client authenticated with.
+
+    There is one for each public key authentication when sshd requires more
+    than one, the other authentication methods are ignored.
+    """
 
-    # Wrap pk in SSH wire format (RFC 4253 section 6.6) for easy comparison
-    # with .pub files: string "ssh-ed25519" + string pk
-    key_type = b"ssh-ed25519"
-    wire_format = struct.pack(">I", len(key_type)) + key_type
-    wire_format += struct.pack(">I", len(pk)) + pk
-    return base64.b64encode(wire_format).decode("ascii")
+    certificates = []
+    for line in file.read_text().splitlines():
+        match line.split(" "):
+            case ("publickey", cert_type, _, *_) if cert_type.endswith(
+                "-cert-v01@openssh.com"
+            ):
+                prefix = "publickey "
+                certificates.append(Certificate.decode(line.removeprefix(prefix)))
+    if not certificates:
+        raise InvalidAuthInfo("No certificate in `SSH_USER_AUTH`")
+    return certificates
 
 
-def read_string(data: bytes, offset: int) -> tuple[bytes, int]:
+def public_key_digest(public_key: str) -> bytes:
+    """Return the `Certificate.key_digest` of a key in ``.pub`` format."""
+
+    match public_key.split():
+        case (_, encoded, *_):
+            pass
+        case _:
+            raise InvalidAuthInfo(f"Invalid SSH public key: {public_key!r}")
+    try:
+        blob = base64.b64decode(encoded, validate=True)
+    except binascii.Error as ex:
+        raise InvalidAuthInfo(f"Public key is not valid base64: {ex}") from ex
+    return hashlib.sha256(blob).digest()
+
+
+def read_string(data: memoryview, offset: int) -> tuple[memoryview, int]:
     """Read an SSH string (RFC 4251 section 5) from data at offset.
 
     Returns the string value and the new offset after the string.
     """
     if offset + 4 > len(data):
         raise InvalidAuthInfo(
-            f"Invalid `SSH_USER_AUTH`: expected 4 bytes for string length "
+            f"Invalid certificate: expected 4 bytes for string length "
             f"at offset {offset}, got {len(data) - offset}"
         )
     (length,) = struct.unpack_from(">I", data, offset)
     offset += 4
     if offset + length > len(data):
         raise InvalidAuthInfo(
-            f"`Invalid `SSH_USER_AUTH`: expected {length} bytes for string "
+            f"Invalid certificate: expected {length} bytes for string "
             f"at offset {offset}, got {len(data) - offset}"
         )
     return data[offset : offset + length], offset + length
+
+
+def _read_uint64_uint32(data: memoryview, offset: int) -> tuple[int, int, int]:
+    if offset + 12 > len(data):
+        raise InvalidAuthInfo("Invalid certificate: truncated serial or type")
+    serial, type = struct.unpack_from(">QI", data, offset)
+    return serial, type, offset + 12
+
+
+def _read_validity(data: memoryview, offset: int) -> tuple[int, int, int]:
+    if offset + 16 > len(data):
+        raise InvalidAuthInfo("Invalid certificate: truncated validity")
+    valid_after, valid_before = struct.unpack_from(">QQ", data, offset)
+    return valid_after, valid_before, offset + 16
+
+
+def _strings(data: memoryview) -> list[memoryview]:
+    strings = []
+    offset = 0
+    while offset < len(data):
+        value, offset = read_string(data, offset)
+        strings.append(value)
+    return strings
+
+
+def _options(data: memoryview) -> dict[str, str]:
+    """Parse critical options or extensions.
+
+    They are pairs of strings, the value of an option with data is itself a
+    string.
+    """
+
+    options = {}
+    names_and_values = _strings(data)
+    if len(names_and_values) % 2:
+        raise InvalidAuthInfo("Invalid certificate: truncated options")
+    for name, value in zip(names_and_values[::2], names_and_values[1::2]):
+        if len(value) > 0:
+            value, _ = read_string(value, 0)
+        options[_text(name)] = _text(value)
+    return options
+
+
+def _text(data: memoryview) -> str:
+    try:
+        return str(data, "utf-8")
+    except UnicodeDecodeError as ex:
+        raise InvalidAuthInfo(f"Invalid certificate: {ex}") from ex
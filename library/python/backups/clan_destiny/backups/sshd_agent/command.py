@@ -1,34 +1,114 @@
 """This command is run by sshd when it accepts a connection for a backup job.
 
+It authenticates the client and runs the rsync server for the job it asked
+for, see `dispatch`.
 """
 
 import click
+import contextlib
 import logging
+import os
 
+from collections.abc import Mapping
 from pathlib import Path
 
-from . import auth_info
+from . import auth_info, dispatch, index
 
 logger = logging.getLogger("backups.sshd_agent")
 
+# Where `build-index` writes the index of the jobs served by this host:
+INDEX_PATH = Path("/var/lib/clan-destiny-backups/sshd-agent.index")
 
-@click.command(help=__doc__)
-@click.option("--ssh-client", envvar="SSH_CLIENT", required=True)
-@click.option("--ssh-connection", envvar="SSH_CONNECTION", required=True)
+
+def _open_index(
+    ctx: click.Context,
+    stack: contextlib.ExitStack,
+    path: Path,
+) -> Mapping[str, dispatch.Grant]:
+    try:
+        grants = stack.enter_context(index.Index.open(path))
+    except FileNotFoundError:
+        logger.warning(f"{path} is missing, using the config")
+    except index.InvalidIndex as ex:
+        logger.error(f"Invalid index {path}, using the config: {ex}")
+    else:
+        logger.debug(f"Using generation {grants.generation} of {path}")
+        return grants
+
+    from clan_destiny.backups import utils
+    from clan_destiny.backups.cli import get_config
+
+    return dispatch.build_index(get_config(ctx), utils.fqdn())
+
+
+@click.group(help=__doc__, invoke_without_command=True)
+@click.option(
+    "--index-path",
+    envvar="CLAN_DESTINY_BACKUPS_SSHD_AGENT_INDEX",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=INDEX_PATH,
+    show_default=True,
+    help="The index written by `build-index`, the config is used without it.",
+)
+@click.option("--ssh-connection", envvar="SSH_CONNECTION")
 @click.option(
     "--ssh-user-auth",
     envvar="SSH_USER_AUTH",
-    required=True,
     type=click.Path(exists=True, readable=True, path_type=Path),
 )
+@click.option(
+    "--ssh-original-command",
+    envvar="SSH_ORIGINAL_COMMAND",
+    help="The request of the client.",
+)
 @click.pass_context
 def sshd_agent(
     ctx: click.Context,
-    ssh_client: str,
-    ssh_connection: str,
-    ssh_user_auth: Path,
+    index_path: Path,
+    ssh_connection: str | None,
+    ssh_user_auth: Path | None,
+    ssh_original_command: str | None,
 ) -> None:
-    print(f"SSH_CLIENT={ssh_client}")
-    print(f"SSH_CONNECTION={ssh_connection}")
-    print(f"SSH_USER_AUTH={ssh_user_auth}")
-    print(f"Client public key = {auth_info.parse(ssh_user_auth)}")
+    if ctx.invoked_subcommand is not None:
+        return
+    # These are only required when sshd runs us:
+    if ssh_connection is None:
+        ctx.fail("Missing option '--ssh-connection' (or `SSH_CONNECTION`)")
+    if ssh_user_auth is None:
+        ctx.fail("Missing option '--ssh-user-auth' (or `SSH_USER_AUTH`)")
+    if ssh_original_command is None:
+        ctx.fail(
+            "Missing option '--ssh-original-command' (or `SSH_ORIGINAL_COMMAND`)"
+        )
+
+    try:
+        request = dispatch.Request.parse(ssh_original_command)
+        certificates = auth_info.parse(ssh_user_auth)
+        key_digests = {certificate.key_digest for certificate in certificates}
+        address = dispatch.client_address(ssh_connection)
+        with contextlib.ExitStack() as stack:
+            grants = _open_index(ctx, stack, index_path)
+            argv = dispatch.authorize(grants, request, key_digests, address)
+    except (dispatch.Denied, auth_info.InvalidAuthInfo, index.InvalidIndex) as ex:
+        logger.error(f"Denied backup request from {ssh_connection}: {ex}")
+        ctx.exit(1)
+
+    logger.info(f"Running {request.direction} job {request.job_name!r}")
+    os.execvp(argv[0], argv)
+
+
+@sshd_agent.command(
+    name="build-index",
+    help="Index the jobs this host serves, run it when the config changes.",
+)
+@click.pass_context
+def build_index_command(ctx: click.Context) -> None:
+    from clan_destiny.backups import utils
+    from clan_destiny.backups.cli import get_config
+
+    assert ctx.parent is not None
+    index_path: Path = ctx.parent.params["index_path"]
+    grants = dispatch.build_index(get_config(ctx), utils.fqdn())
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    generation = index.write(index_path, grants)
+    click.echo(f"Indexed {len(grants)} jobs in {index_path}, generation {generation}")
@@ -0,0 +1,122 @@
+"""Decide which rsync server to run for an incoming backup connection.
+
+Clients are signed a certificate whose forced command is the sshd agent,
+the same for every job. They say which job they want to run in the command
+they ask sshd to run, which sshd gives to the agent in
+`SSH_ORIGINAL_COMMAND`. The agent then checks that the client is allowed to
+run that job and runs the rsync server for it. The command the client asked
+for is never run.
+
+rsync lets us set that command with ``--rsync-path``, the rsync server
+options it appends to it are ignored.
+"""
+
+import shlex
+
+from collections.abc import Mapping, Set
+from typing import TYPE_CHECKING, NamedTuple, Self
+
+from . import auth_info
+
+if TYPE_CHECKING:
+    from clan_destiny.backups import config
+
+PROTOCOL = "clan-destiny-backups-rpc/1"
+
+
+class Denied(Exception):
+    pass
+
+
+class Request(NamedTuple):
+    job_name: str
+    # A `config.BackupDirection` value:
+    direction: str
+
+    @classmethod
+    def parse(cls, original_command: str) -> Self:
+        try:
+            args = shlex.split(original_command)
+        except ValueError as ex:
+            raise Denied(f"Invalid request: {ex}") from ex
+        match args:
+            case (protocol, job_name, direction, *_) if protocol == PROTOCOL:
+                return cls(job_name, direction)
+            case _:
+                msg = f"Expected a {PROTOCOL} request, got: {original_command!r}"
+                raise Denied(msg)
+
+    def encode(self) -> str:
+        """Encode the request for ``rsync --rsync-path``."""
+
+        return shlex.join((PROTOCOL, self.job_name, self.direction))
+
+
+class Grant(NamedTuple):
+    """Who can run a job, and the rsync server command it runs."""
+
+    # See `auth_info.Certificate.key_digest`:
+    key_digest: bytes
+    # Where the client can connect from, anywhere if empty:
+    addresses: frozenset[str]
+    direction: str
+    argv: tuple[str, ...]
+
+
+def build_index(cfg: "config.Config", fqdn: str) -> dict[str, Grant]:
+    """Index the rsync jobs for which ``fqdn`` is the remote host by name."""
+
+    from clan_destiny.backups import config
+    from clan_destiny.backups.dump.rsync import RsyncCommands
+
+    index = {}
+    for job_name, job in cfg.jobs_by_name.items():
+        if job.type != config.BackupType.RSYNC or job.remote_host != fqdn:
+            continue
+        client = cfg.hosts_by_fqdn.get(job.local_host)
+        if client is None:
+            continue
+        assert job.remote_path is not None
+        rsync_commander = RsyncCommands(fqdn, job.local_path, job.remote_path)
+        index[job_name] = Grant(
+            key_digest=auth_info.public_key_digest(client.ssh_public_key),
+            addresses=frozenset(client.addresses),
+            direction=job.direction.value,
+            argv=rsync_commander.server_mirror_copy(job.direction, job.resumable),
+        )
+    return index
+
+
+def authorize(
+    index: Mapping[str, Grant],
+    request: Request,
+    key_digests: Set[bytes],
+    client_address: str,
+) -> tuple[str, ...]:
+    """Return the command to run for ``request`` or raise `Denied`.
+
+    ``key_digests`` are the keys of the certificates the client authenticated
+    with, any of them can grant the request.
+    """
+
+    grant = index.get(request.job_name)
+    if grant is None:
+        raise Denied(f"Unknown job {request.job_name!r}")
+    if grant.key_digest not in key_digests:
+        raise Denied(f"These keys cannot run {request.job_name!r}")
+    if grant.addresses and client_address not in grant.addresses:
+        raise Denied(f"{client_address} cannot run {request.job_name!r}")
+    if request.direction != grant.direction:
+        msg = f"{request.job_name!r} is a {grant.direction} job"
+        raise Denied(msg)
+    return grant.argv
+
+
+def client_address(ssh_connection: str) -> str:
+    """Extract the address of the client from `SSH_CONNECTION`."""
+
+    match ssh_connection.split():
+        case (address, *_):
+            return address
+        case _:
+            raise Denied("`SSH_CONNECTION` is empty")
@@ -0,0 +1,210 @@
+"""A file indexing the `dispatch.Grant` of each job by name.
+
+It is built ahead of time with ``sshd-agent build-index`` so that the sshd
+agent does not have to load and validate the config for every connection,
+and is read through `mmap` so that a lookup only touches the pages it needs.
+
+The index is a hash table with open addressing::
+
+    header:  magic, generation, bucket count, record count
+    buckets: offset and size of the record of each bucket, 0 when empty
+    records: job name, key digest, direction, addresses, argv
+
+Records are made of SSH strings (RFC 4251 section 5), lists are a count
+followed by that many strings. The index is replaced atomically when it is
+rebuilt, connections that opened the previous one keep using it, and each
+rebuild gets the next generation number.
+"""
+
+import contextlib
+import hashlib
+import mmap
+import os
+import struct
+
+from collections.abc import Iterator, Mapping
+from pathlib import Path
+from typing import Self, override
+
+from clan_destiny.backups import utils
+
+from .dispatch import Grant
+
+MAGIC = b"CDBIDX01"
+
+_HEADER = struct.Struct(">8sQII")
+_BUCKET = struct.Struct(">II")
+_UINT32 = struct.Struct(">I")
+
+
+class InvalidIndex(Exception):
+    pass
+
+
+def _hash(job_name: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(job_name, digest_size=8).digest())
+
+
+def _encode_strings(strings: list[bytes]) -> bytes:
+    return b"".join(_UINT32.pack(len(each)) + each for each in strings)
+
+
+def _encode_record(job_name: str, grant: Grant) -> bytes:
+    addresses = [address.encode() for address in sorted(grant.addresses)]
+    argv = [arg.encode() for arg in grant.argv]
+    return (
+        _encode_strings(
+            [job_name.encode(), grant.key_digest, grant.direction.encode()]
+        )
+        + _UINT32.pack(len(addresses))
+        + _encode_strings(addresses)
+        + _UINT32.pack(len(argv))
+        + _encode_strings(argv)
+    )
+
+
+def generation(path: Path) -> int:
+    """Return the generation of the index at ``path``, 0 if there is none."""
+
+    try:
+        with path.open("rb") as fp:
+            header = fp.read(_HEADER.size)
+    except FileNotFoundError:
+        return 0
+    if len(header) != _HEADER.size:
+        return 0
+    magic, current, _, _ = _HEADER.unpack(header)
+    return current if magic == MAGIC else 0
+
+
+def write(path: Path, grants: Mapping[str, Grant]) -> int:
+    """Replace the index at ``path`` with ``grants``, return its generation."""
+
+    next_generation = generation(path) + 1
+    bucket_count = 1
+    while bucket_count < 2 * len(grants):
+        bucket_count *= 2
+    buckets = [(0, 0)] * bucket_count
+    records = []
+    offset = _HEADER.size + bucket_count * _BUCKET.size
+    for job_name, grant in grants.items():
+        record = _encode_record(job_name, grant)
+        bucket = _hash(job_name.encode()) % bucket_count
+        while buckets[bucket][0] != 0:
+            bucket = (bucket + 1) % bucket_count
+        buckets[bucket] = (offset, len(record))
+        records.append(record)
+        offset += len(record)
+
+    contents = b"".join(
+        [
+            _HEADER.pack(MAGIC, next_generation, bucket_count, len(grants)),
+            *(_BUCKET.pack(*bucket) for bucket in buckets),
+            *records,
+        ]
+    )
+    # The sshd agent may run as another user than root, in the same group:
+    utils.replace_file(path, contents, mode=0o640)
+    return next_generation
+
+
+class Index(Mapping[str, Grant]):
+    def __init__(self, data: mmap.mmap) -> None:
+        self._data: mmap.mmap = data
+        if len(data) < _HEADER.size:
+            raise InvalidIndex("Truncated header")
+        magic, generation, bucket_count, record_count = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise InvalidIndex(f"Expected magic {MAGIC!r}, got {magic!r}")
+        if bucket_count == 0 or bucket_count & (bucket_count - 1):
+            raise InvalidIndex(f"Invalid bucket count {bucket_count}")
+        if len(data) < _HEADER.size + bucket_count * _BUCKET.size:
+            raise InvalidIndex("Truncated buckets")
+        self.generation: int = generation
+        self._bucket_count: int = bucket_count
+        self._record_count: int = record_count
+
+    @classmethod
+    @contextlib.contextmanager
+    def open(cls, path: Path) -> Iterator[Self]:
+        with path.open("rb") as fp:
+            info = os.fstat(fp.fileno())
+            # The index decides which key runs what, make sure only we (or
+            # root) could have written it:
+            if info.st_uid not in (0, os.geteuid()) or info.st_mode & 0o022:
+                raise InvalidIndex(f"{path} could have been written by others")
+            if info.st_size == 0:
+                raise InvalidIndex(f"{path} is empty")
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield cls(data)
+
+    def _bucket(self, index: int) -> tuple[int, int]:
+        offset, size = _BUCKET.unpack_from(
+            self._data,
+            _HEADER.size + index * _BUCKET.size,
+        )
+        if offset + size > len(self._data):
+            raise InvalidIndex(f"Bucket {index} points past the end of the index")
+        return offset, size
+
+    def _read_string(self, offset: int, end: int) -> tuple[bytes, int]:
+        if offset + _UINT32.size > end:
+            raise InvalidIndex(f"Truncated record at offset {offset}")
+        (length,) = _UINT32.unpack_from(self._data, offset)
+        offset += _UINT32.size
+        if offset + length > end:
+            raise InvalidIndex(f"Truncated record at offset {offset}")
+        return self._data[offset : offset + length], offset + length
+
+    def _read_strings(self, offset: int, end: int) -> tuple[list[str], int]:
+        if offset + _UINT32.size > end:
+            raise InvalidIndex(f"Truncated record at offset {offset}")
+        (count,) = _UINT32.unpack_from(self._data, offset)
+        offset += _UINT32.size
+        strings = []
+        for _ in range(count):
+            value, offset = self._read_string(offset, end)
+            strings.append(value.decode())
+        return strings, offset
+
+    def _job_name(self, offset: int, size: int) -> bytes:
+        job_name, _ = self._read_string(offset, offset + size)
+        return job_name
+
+    def _grant(self, offset: int, size: int) -> Grant:
+        end = offset + size
+        _, offset = self._read_string(offset, end)  # job name
+        key_digest, offset = self._read_string(offset, end)
+        direction, offset = self._read_string(offset, end)
+        addresses, offset = self._read_strings(offset, end)
+        argv, offset = self._read_strings(offset, end)
+        return Grant(
+            key_digest=key_digest,
+            addresses=frozenset(addresses),
+            direction=direction.decode(),
+            argv=tuple(argv),
+        )
+
+    @override
+    def __getitem__(self, job_name: str) -> Grant:
+        key = job_name.encode()
+        bucket = _hash(key) % self._bucket_count
+        for _ in range(self._bucket_count):
+            offset, size = self._bucket(bucket)
+            if offset == 0:
+                break
+            if self._job_name(offset, size) == key:
+                return self._grant(offset, size)
+            bucket = (bucket + 1) % self._bucket_count
+        raise KeyError(job_name)
+
+    @override
+    def __iter__(self) -> Iterator[str]:
+        for bucket in range(self._bucket_count):
+            offset, size = self._bucket(bucket)
+            if offset != 0:
+                yield self._job_name(offset, size).decode()
+
+    @override
+    def __len__(self) -> int:
+        return self._record_count
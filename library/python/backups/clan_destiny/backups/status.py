@@ -0,0 +1,52 @@
+import click
+import sqlite3
+import sys
+import time
+
+from clan_destiny.backups import ledger
+from clan_destiny.backups.cli import get_config
+
+
+def _format_time(timestamp: float | None) -> str:
+    if timestamp is None:
+        return "never"
+    return time.strftime("%F %T", time.localtime(timestamp))
+
+
+@click.command(help="Show the status of the backup jobs from past runs.")
+@click.option(
+    "--slow",
+    is_flag=True,
+    help="List the jobs whose last run was slower than 90% of their runs.",
+)
+@click.option(
+    "--failing-for",
+    type=click.IntRange(min=1),
+    metavar="DAYS",
+    help="List the jobs that did not succeed in that many days, and exit 1 "
+    "if there are any.",
+)
+@click.pass_context
+def status(ctx: click.Context, slow: bool, failing_for: int | None) -> None:
+    cfg = get_config(ctx)
+    path = cfg.state_dir / ledger.FILENAME
+    try:
+        with ledger.Ledger.open(path, readonly=True) as runs:
+            if slow:
+                for run in runs.slower_than_p90():
+                    click.echo(
+                        f"{run.job}: {run.duration:.0f}s on "
+                        f"{_format_time(run.started_at)}, p90 {run.p90:.0f}s"
+                    )
+            elif failing_for is not None:
+                cutoff = time.time() - failing_for * 24 * 3600
+                failing = runs.not_successful_since(cutoff)
+                for job_name, last_success in failing.items():
+                    click.echo(f"{job_name}: last success {_format_time(last_success)}")
+                ctx.exit(1 if failing else 0)
+            else:
+                for job_name, last_success in runs.last_successes().items():
+                    click.echo(f"{job_name}: last success {_format_time(last_success)}")
+    except (FileNotFoundError, sqlite3.Error) as ex:
+        click.echo(f"Could not read the ledger: {ex}", err=True)
+        sys.exit(1)
@@ -1,59 +1,97 @@
 import atexit
-import asyncio
 import contextlib
-import json
+import functools
 import os
+import re
 import shutil
-import subprocess
+import socket
 import tempfile
 
-from collections.abc import Generator
+from collections.abc import Generator, Iterable
 from pathlib import Path
+from typing import Self
 
 
-async def is_mounted(filepath: Path) -> bool:
-    """Returns True if the filesystem where ``filepath`` resides is mounted."""
-
-    # XXX: this only works on Linux for now:
-
-    filepath = Path(os.path.realpath(str(filepath)))
-    if not filepath.is_dir():
-        filepath = filepath.parent
-
-    fstab_cmd = ["findmnt", "--json", "--fstab"]
-    fstab_proc_f = asyncio.create_subprocess_exec(
-        *fstab_cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    mtab_cmd = ["findmnt", "--json", "--target", str(filepath)]
-    mtab_proc_f = asyncio.create_subprocess_exec(
-        *mtab_cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    fstab_proc = await fstab_proc_f
-    mtab_proc = await mtab_proc_f
-    fstab_out, fstab_err = (buf.decode() for buf in await fstab_proc.communicate())
-    mtab_out, mtab_err = (buf.decode() for buf in await mtab_proc.communicate())
-    fstab_rc = await fstab_proc.wait()
-    mtab_rc = await mtab_proc.wait()
-    if fstab_rc != 0 or len(fstab_err):
-        raise subprocess.CalledProcessError(fstab_rc, fstab_cmd, fstab_out, fstab_err)
-    if mtab_rc or len(mtab_err):
-        raise subprocess.CalledProcessError(mtab_rc, mtab_cmd, mtab_out, mtab_err)
-
-    fstab_entries = json.loads(fstab_out)["filesystems"]
-    mtab_entries = json.loads(mtab_out)["filesystems"]
-
-    file_fs = ""
-    for mntent in fstab_entries:
-        target = mntent["target"]
-        if str(filepath).startswith(target):
-            if len(target) > len(file_fs):
-                file_fs = target
-
-    return file_fs in (mntent["target"] for mntent in mtab_entries)
+class _MountPoints:
+    """A trie of mount points keyed by path components."""
+
+    __slots__ = ("children", "target")
+
+    def __init__(self, targets: Iterable[str] = ()) -> None:
+        self.children: dict[str, _MountPoints] = {}
+        self.target: str | None = None
+        for target in targets:
+            self.add(target)
+
+    def add(self, target: str) -> None:
+        node = self
+        for part in Path(target).parts[1:]:
+            node = node.children.setdefault(part, _MountPoints())
+        node.target = target
+
+    def find(self, path: Path) -> str | None:
+        """Return the deepest mount point that contains ``path``."""
+
+        node, found = self, self.target
+        for part in path.parts[1:]:
+            if (child := node.children.get(part)) is None:
+                break
+            node = child
+            found = node.target if node.target is not None else found
+        return found
+
+
+def _unescape_mount_point(field: str) -> str:
+    # Both fstab and mountinfo escape whitespace & backslashes in octal:
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountTable:
+    """A snapshot of the filesystems listed in fstab and of the ones mounted.
+
+    It reads fstab and ``/proc/self/mountinfo`` once, then answers as many
+    `is_mounted` calls as needed without spawning any process.
+    """
+
+    # XXX: this only works on Linux for now.
+
+    def __init__(self, configured: Iterable[str], mounted: Iterable[str]) -> None:
+        self._configured: _MountPoints = _MountPoints(configured)
+        self._mounted: _MountPoints = _MountPoints(mounted)
+
+    @classmethod
+    def read(
+        cls,
+        fstab: Path = Path("/etc/fstab"),
+        mountinfo: Path = Path("/proc/self/mountinfo"),
+    ) -> Self:
+        configured = []
+        for line in fstab.read_text().splitlines():
+            fields = line.split()
+            if len(fields) < 2 or fields[0].startswith("#"):
+                continue
+            if fields[1].startswith("/"):  # skip swap & co.
+                configured.append(_unescape_mount_point(fields[1]))
+        # See proc_pid_mountinfo(5), the mount point is the 5th field:
+        mounted = (
+            _unescape_mount_point(line.split(" ", 5)[4])
+            for line in mountinfo.read_text().splitlines()
+        )
+        return cls(configured, mounted)
+
+    def is_mounted(self, filepath: Path) -> bool:
+        """Returns True if the filesystem where ``filepath`` resides is mounted.
+
+        That is, the deepest mount point for ``filepath`` in fstab is also the
+        deepest mount point actually mounted for it.
+        """
+
+        filepath = Path(os.path.realpath(str(filepath)))
+        if not filepath.is_dir():
+            filepath = filepath.parent
+
+        file_fs = self._configured.find(filepath)
+        return file_fs is not None and file_fs == self._mounted.find(filepath)
 
 
 @contextlib.contextmanager
@@ -63,6 +101,42 @@ def make_tmp_dir(
     dir: str | None = None,
 ) -> Generator[Path, None, None]:
     tmpdir = tempfile.mkdtemp(suffix, prefix, dir)
-    _ = atexit.register(lambda: shutil.rmtree(tmpdir, ignore_errors=True))
-    yield Path(tmpdir)
-    shutil.rmtree(tmpdir, ignore_errors=True)
+    cleanup = functools.partial(shutil.rmtree, tmpdir, ignore_errors=True)
+    _ = atexit.register(cleanup)
+    try:
+        yield Path(tmpdir)
+    finally:
+        cleanup()
+        atexit.unregister(cleanup)
+
+
+@functools.cache
+def fqdn() -> str:
+    """The FQDN of this host, resolved once.
+
+    Resolving it can block on DNS, so it can be set from the environment.
+    """
+
+    return os.environ.get("CLAN_DESTINY_BACKUPS_FQDN") or socket.getfqdn()
+
+
+def private_dir(path: Path) -> bool:
+    """Create ``path`` if needed, return whether only we can access it."""
+
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    info = path.stat()
+    return info.st_uid == os.geteuid() and info.st_mode & 0o077 == 0
+
+
+def replace_file(path: Path, contents: bytes, mode: int = 0o644) -> None:
+    """Atomically replace ``path`` with a new file holding ``contents``."""
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            os.fchmod(fp.fileno(), mode)
+            assert fp.write(contents) == len(contents)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -18,6 +18,7 @@
             hvac
             pydantic
             requests
+            zstandard
           ];
 
           nativeCheckInputs = [
@@ -29,10 +30,8 @@
           ];
 
           propagatedBuildInputs = with pkgs; [
-            gzip
             restic
             rsync
-            util-linux # findmnt
           ];
         };
       pythonPkgs = pkgs.python3Packages;
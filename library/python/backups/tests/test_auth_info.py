@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import pytest
+import subprocess
+
+from pathlib import Path
+
+from clan_destiny.backups.sshd_agent import auth_info
+
+from .conftest import SSHKeyPair
+
+
+def _sign(ca: SSHKeyPair, key: SSHKeyPair) -> str:
+    _ = subprocess.run(
+        [
+            "ssh-keygen",
+            "-q",
+            "-s",
+            str(ca.priv_path),
+            "-I",
+            "test-certificate-id",
+            "-n",
+            "root,backups",
+            "-z",
+            "42",
+            "-V",
+            "20300101:20300102",
+            "-O",
+            "clear",
+            "-O",
+            "force-command=rsync --server --sender . /data",
+            "-O",
+            "source-address=192.0.2.0/24",
+            "-O",
+            "permit-pty",
+            str(key.pub_path),
+        ],
+        check=True,
+    )
+    return key.pub_path.with_name(f"{key.priv_path.name}-cert.pub").read_text()
+
+
+def test_certificate(tmp_path: Path, ssh_ca_keys: SSHKeyPair) -> None:
+    key = SSHKeyPair.generate(tmp_path, name="client")
+    certificate = auth_info.Certificate.decode(_sign(ssh_ca_keys, key))
+
+    assert certificate.key_type == "ssh-ed25519"
+    assert certificate.key_digest == auth_info.public_key_digest(key.pub)
+    assert certificate.serial == 42
+    assert certificate.type == auth_info.CertificateType.USER
+    assert certificate.key_id == "test-certificate-id"
+    assert certificate.valid_principals == ("root", "backups")
+    assert certificate.valid_before - certificate.valid_after == 24 * 3600
+    assert certificate.critical_options == {
+        "force-command": "rsync --server --sender . /data",
+        "source-address": "192.0.2.0/24",
+    }
+    assert certificate.extensions == {"permit-pty": ""}
+    ca_key = base64.b64decode(ssh_ca_keys.pub.split()[1])
+    assert certificate.signature_key_digest == hashlib.sha256(ca_key).digest()
+
+
+def test_parse(tmp_path: Path, ssh_ca_keys: SSHKeyPair) -> None:
+    keys = [SSHKeyPair.generate(tmp_path, name=f"client-{i}") for i in range(2)]
+    lines = ["password"]
+    for key in keys:
+        lines.append(f"publickey {_sign(ssh_ca_keys, key).strip()}")
+    # A plain key is not a certificate:
+    lines.append(f"publickey {keys[0].pub.strip()}")
+    ssh_user_auth = tmp_path / "ssh_user_auth"
+    _ = ssh_user_auth.write_text("\n".join(lines) + "\n")
+
+    certificates = auth_info.parse(ssh_user_auth)
+    assert [each.key_digest for each in certificates] == [
+        auth_info.public_key_digest(key.pub) for key in keys
+    ]
+
+
+def test_truncated_certificate(tmp_path: Path, ssh_ca_keys: SSHKeyPair) -> None:
+    key = SSHKeyPair.generate(tmp_path, name="client")
+    cert_type, encoded, *_ = _sign(ssh_ca_keys, key).split()
+    data = base64.b64decode(encoded)
+    for size in (0, 10, len(data) // 2, len(data) - 1):
+        truncated = base64.b64encode(data[:size]).decode()
+        with pytest.raises(auth_info.InvalidAuthInfo):
+            auth_info.Certificate.decode(f"{cert_type} {truncated}")
+
+    ssh_user_auth = tmp_path / "ssh_user_auth"
+    _ = ssh_user_auth.write_text(f"publickey {key.pub}")
+    with pytest.raises(auth_info.InvalidAuthInfo):
+        auth_info.parse(ssh_user_auth)
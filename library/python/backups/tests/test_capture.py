@@ -0,0 +1,33 @@
+import gzip
+
+from pathlib import Path
+
+from clan_destiny.backups import config
+from clan_destiny.backups.dump.capture import StreamCapture
+
+
+def test_gzip_capture(tmp_path: Path) -> None:
+    settings = config.Capture(codec=config.CaptureCodec.GZIP, tail_size=1)
+    capture = StreamCapture(tmp_path / "stdout", settings)
+    lines = [f"line {i}\n".encode() for i in range(1000)]
+    for line in lines:
+        capture.write(line)
+    capture.close()
+
+    output = b"".join(lines)
+    assert capture.path == tmp_path / "stdout.gz"
+    assert capture.mime_subtype == "gzip"
+    assert gzip.decompress(capture.path.read_bytes()) == output
+    assert capture.size == len(output)
+    assert capture.tail == output[-1024:]
+    assert capture.truncated
+
+
+def test_capture_tail_not_truncated(tmp_path: Path) -> None:
+    settings = config.Capture(codec=config.CaptureCodec.GZIP)
+    capture = StreamCapture(tmp_path / "stderr", settings)
+    capture.write(b"rsync error: some files could not be transferred\n")
+    capture.close()
+    capture.close()  # closing twice is fine
+    assert capture.tail == b"rsync error: some files could not be transferred\n"
+    assert not capture.truncated
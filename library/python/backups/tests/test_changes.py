@@ -0,0 +1,97 @@
+import contextlib
+import os
+import pytest
+import time
+
+from pathlib import Path
+from typing import Iterator
+
+from clan_destiny.backups.dump.changes import SourceState, TreeSummary
+
+
+def _tree(tmp_path: Path) -> Path:
+    root = tmp_path / "source"
+    (root / "photos" / "2024").mkdir(parents=True)
+    assert (root / "photos" / "2024" / "a.jpg").write_bytes(b"a" * 10) == 10
+    assert (root / "notes.txt").write_text("hello") == 5
+    (root / "link").symlink_to("photos")
+    return root
+
+
+def _scan(root: Path) -> TreeSummary:
+    summary = TreeSummary.scan(str(root))
+    assert summary is not None
+    return summary
+
+
+def test_tree_summary(tmp_path: Path) -> None:
+    root = _tree(tmp_path)
+    summary = _scan(root)
+    assert summary.entries == 6
+    assert _scan(root) == summary
+
+    assert (root / "photos" / "2024" / "b.jpg").write_bytes(b"b") == 1
+    added = _scan(root)
+    assert added.entries == 7
+    (root / "photos" / "2024" / "b.jpg").unlink()
+    assert _scan(root).entries == 6
+
+    assert (root / "notes.txt").write_text("hello world") == 11
+    assert _scan(root).size == summary.size + 6
+
+
+def test_unchanged(tmp_path: Path) -> None:
+    summary = _scan(_tree(tmp_path))
+    assert not SourceState().unchanged(summary, 7)
+
+    state = SourceState(summary=summary, last_run=time.time() - 3600)
+    assert state.unchanged(summary, 7)
+    changed = summary.model_copy(update={"entries": summary.entries + 1})
+    assert not state.unchanged(changed, 7)
+
+    # Time for a full run:
+    state = SourceState(summary=summary, last_run=time.time() - 8 * 24 * 3600)
+    assert not state.unchanged(summary, 7)
+
+
+def test_state_round_trip(tmp_path: Path) -> None:
+    path = tmp_path / "rsync" / "job.json"
+    summary = _scan(_tree(tmp_path))
+    state = SourceState(summary=summary, last_run=time.time())
+    state.save(path)
+    assert SourceState.load(path) == state
+
+
+def test_interrupted_state(tmp_path: Path) -> None:
+    path = tmp_path / "rsync" / "job.json"
+    summary = _scan(_tree(tmp_path))
+    state = SourceState(summary=summary, last_run=time.time() - 3600)
+    checkpoint = state.model_copy(update={"interrupted_at": time.time()})
+    checkpoint.save(path)
+    loaded = SourceState.load(path)
+    assert loaded == checkpoint
+    # What the last successful run saw is kept:
+    assert loaded.unchanged(summary, 7)
+
+
+def test_tree_summary_of_a_changing_tree(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    root = _tree(tmp_path)
+    scandir = os.scandir
+
+    def scandir_then_remove(
+        path: str,
+    ) -> contextlib.nullcontext[Iterator[os.DirEntry[str]]]:
+        # The entry is listed, but gone by the time it gets stat'ed:
+        entries = list(scandir(path))
+        if path == str(root):
+            (root / "notes.txt").unlink()
+        return contextlib.nullcontext(iter(entries))
+
+    monkeypatch.setattr(os, "scandir", scandir_then_remove)
+    assert _scan(root).entries == 5
+
+
+def test_tree_summary_of_a_missing_tree(tmp_path: Path) -> None:
+    assert TreeSummary.scan(str(tmp_path / "missing")) is None
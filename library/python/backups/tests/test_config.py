@@ -64,3 +64,61 @@ def test_invalid_b2_jobs() -> None:
         # The raw config contains paths that don't exist:
         fqdn = "nsrv-sfo-ashpool.kalessin.fr"
         _ = config.load(B2_JOBS_CONFIG, fqdn)
+
+
+def test_skip_unchanged_requires_push_rsync_job() -> None:
+    job = {
+        "type": "rsync",
+        "direction": "pull",
+        "localHost": "nsrv-sfo-ashpool.kalessin.fr",
+        "localPath": "/stash/backups/photos",
+        "remoteHost": "nas.kalessin.fr",
+        "remotePath": "/srv/photos",
+        "skipUnchanged": True,
+    }
+    with pytest.raises(pydantic.ValidationError, match="only supported by push"):
+        _ = config.BackupJob.model_validate_json(json.dumps(job))
+    job["direction"] = "push"
+    assert config.BackupJob.model_validate_json(json.dumps(job)).skip_unchanged
+
+
+def test_load_keeps_jobs_of_the_host(valid_b2_jobs_config: Path) -> None:
+    cfg = config.load(valid_b2_jobs_config, "nas.kalessin.fr")
+    assert cfg.jobs_by_name == {}
+
+
+def test_load_cached(valid_b2_jobs_config: Path, tmp_path: Path) -> None:
+    fqdn = "nsrv-sfo-ashpool.kalessin.fr"
+    cache_dir = tmp_path / "cache"
+    _ = config.load(valid_b2_jobs_config, "nas.kalessin.fr", cache_dir)
+    (other_host_cache_path,) = cache_dir.glob("config-*.pickle")
+
+    cfg = config.load(valid_b2_jobs_config, fqdn, cache_dir)
+    # Each host gets its own entry, which replaces the previous one:
+    (cache_path,) = cache_dir.glob("config-*.pickle")
+    assert cache_path != other_host_cache_path
+    assert cache_path.stat().st_mode & 0o777 == 0o600
+    assert b"test-application-key" not in cache_path.read_bytes()
+
+    # The cached config is not validated again:
+    (tmp_path / "certbot_on_b2-password").unlink()
+    cached = config.load(valid_b2_jobs_config, fqdn, cache_dir)
+    assert cached == cfg
+    assert cached.restic is not None
+    assert cached.restic.b2.application_key == FAKE_RESTIC_B2_APPLICATION_KEY
+
+
+def test_resumable_requires_rsync_job(tmp_path: Path) -> None:
+    password_path = tmp_path / "photos-password"
+    _ = password_path.write_text("secret")
+    job = {
+        "type": "restic-b2",
+        "direction": "push",
+        "localHost": "nsrv-sfo-ashpool.kalessin.fr",
+        "localPath": "/stash/backups/photos",
+        "passwordPath": str(password_path),
+        "retention": "30d",
+        "resumable": True,
+    }
+    with pytest.raises(pydantic.ValidationError, match="only supported by rsync"):
+        _ = config.BackupJob.model_validate_json(json.dumps(job))
@@ -0,0 +1,110 @@
+import json
+import pytest
+
+from clan_destiny.backups import config
+from clan_destiny.backups.sshd_agent import auth_info, dispatch
+
+SERVER = "backups.example.org"
+CLIENT = "client.example.org"
+CLIENT_KEY = "AAAAC3NzaC1lZDI1NTE5AAAAIGNsaWVudCBrZXkgZm9yIHRlc3RzX19fX19fX19fX19f"
+OTHER_KEY = "AAAAC3NzaC1lZDI1NTE5AAAAIG90aGVyIGtleSBmb3IgdGVzdHNfX19fX19fX19fX19f"
+CLIENT_DIGEST = auth_info.public_key_digest(f"ssh-ed25519 {CLIENT_KEY}")
+OTHER_DIGEST = auth_info.public_key_digest(f"ssh-ed25519 {OTHER_KEY}")
+
+
+@pytest.fixture
+def index() -> dict[str, dispatch.Grant]:
+    def rsync_job(direction: str, local_host: str = CLIENT) -> dict[str, object]:
+        return {
+            "type": "rsync",
+            "direction": direction,
+            "localHost": local_host,
+            "localPath": "/srv/data",
+            "remoteHost": SERVER,
+            "remotePath": f"/stash/backups/{direction}",
+            "oneFileSystem": True,
+        }
+
+    contents = {
+        "jobsByName": {
+            "data_push": rsync_job("push"),
+            "data_pull": rsync_job("pull"),
+            "unknown_client": rsync_job("push", local_host="other.example.org"),
+        },
+        "hostsByFqdn": {
+            CLIENT: {
+                "sshPublicKey": f"ssh-ed25519 {CLIENT_KEY} root@client",
+                "addresses": ["192.0.2.1"],
+            },
+        },
+    }
+    cfg = config.Config.model_validate_json(
+        json.dumps(contents),
+        context=config.ValidationContext(SERVER),
+    )
+    return dispatch.build_index(cfg, SERVER)
+
+
+def test_request_roundtrip() -> None:
+    request = dispatch.Request("my job", "push")
+    # rsync appends the options of the rsync server to --rsync-path:
+    original_command = f"{request.encode()} --server -logDtpre.iLsfxC . /x"
+    assert dispatch.Request.parse(original_command) == request
+
+
+@pytest.mark.parametrize(
+    "original_command",
+    [
+        "rsync --server --sender . /etc",
+        "clan-destiny-backups-rpc/1 job_only",
+        "clan-destiny-backups-rpc/1 'unterminated",
+        "",
+    ],
+)
+def test_request_parse_invalid(original_command: str) -> None:
+    with pytest.raises(dispatch.Denied):
+        dispatch.Request.parse(original_command)
+
+
+def test_build_index(index: dict[str, dispatch.Grant]) -> None:
+    # Only the jobs of known clients are served:
+    assert index.keys() == {"data_push", "data_pull"}
+    grant = index["data_pull"]
+    assert grant.key_digest == CLIENT_DIGEST
+    assert grant.addresses == frozenset({"192.0.2.1"})
+    assert grant.argv[:3] == ("rsync", "--server", "--sender")
+    assert grant.argv[-1] == "/stash/backups/pull"
+
+
+def test_authorize(index: dict[str, dispatch.Grant]) -> None:
+    request = dispatch.Request("data_push", "push")
+    argv = dispatch.authorize(index, request, {CLIENT_DIGEST}, "192.0.2.1")
+    assert argv == index["data_push"].argv
+    # Any of the certificates of the client can grant the request:
+    key_digests = {OTHER_DIGEST, CLIENT_DIGEST}
+    assert dispatch.authorize(index, request, key_digests, "192.0.2.1") == argv
+
+
+@pytest.mark.parametrize(
+    "request_, key_digest, address",
+    [
+        (dispatch.Request("nope", "push"), CLIENT_DIGEST, "192.0.2.1"),
+        (dispatch.Request("data_push", "push"), OTHER_DIGEST, "192.0.2.1"),
+        (dispatch.Request("data_push", "push"), CLIENT_DIGEST, "198.51.100.1"),
+        (dispatch.Request("data_push", "pull"), CLIENT_DIGEST, "192.0.2.1"),
+    ],
+)
+def test_authorize_denied(
+    index: dict[str, dispatch.Grant],
+    request_: dispatch.Request,
+    key_digest: bytes,
+    address: str,
+) -> None:
+    with pytest.raises(dispatch.Denied):
+        dispatch.authorize(index, request_, {key_digest}, address)
+
+
+def test_client_address() -> None:
+    assert dispatch.client_address("192.0.2.1 51234 192.0.2.2 22") == "192.0.2.1"
+    with pytest.raises(dispatch.Denied):
+        dispatch.client_address("")
@@ -0,0 +1,65 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+TESTS_DIR = Path(__file__).parent
+
+# Modules that are slow to import and that these commands should not need:
+HEAVY_MODULES = frozenset(
+    {
+        "asyncio",
+        "email.mime.multipart",
+        "hvac",
+        "pydantic",
+        "requests",
+        "smtplib",
+    }
+)
+
+
+def _imported_modules(*args: str) -> dict[str, int]:
+    """Run the CLI under ``-X importtime``, return the cumulative import time
+    in µs of each module it imported.
+    """
+
+    env = os.environ | {"PYTHONPATH": str(TESTS_DIR.parent)}
+    result = subprocess.run(
+        (
+            sys.executable,
+            "-X",
+            "importtime",
+            "-m",
+            "clan_destiny.backups",
+            "-c",
+            str(TESTS_DIR / "b2_jobs_config.json"),
+            *args,
+        ),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if not cumulative.strip().isdigit():  # the header
+            continue
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ("sshd-agent", "--help"),
+        ("dump", "is-mounted", "/"),
+    ],
+)
+def test_no_heavy_imports(args: tuple[str, ...]) -> None:
+    modules = _imported_modules(*args)
+    assert "clan_destiny.backups.cli" in modules
+    assert HEAVY_MODULES.isdisjoint(modules), sorted(HEAVY_MODULES & set(modules))
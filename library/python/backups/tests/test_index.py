@@ -0,0 +1,70 @@
+import hashlib
+import pytest
+
+from pathlib import Path
+
+from clan_destiny.backups.sshd_agent import dispatch, index
+
+
+def _grants(count: int, remote_path: str = "/stash") -> dict[str, dispatch.Grant]:
+    addresses = ("192.0.2.1", "2001:db8::1")
+    return {
+        f"job-{i}": dispatch.Grant(
+            key_digest=hashlib.sha256(f"key-{i}".encode()).digest(),
+            addresses=frozenset(addresses if i % 2 else ()),
+            direction="push" if i % 3 else "pull",
+            argv=("rsync", "--server", ".", f"{remote_path}/{i}"),
+        )
+        for i in range(count)
+    }
+
+
+@pytest.mark.parametrize("count", [0, 1, 50])
+def test_index(tmp_path: Path, count: int) -> None:
+    path = tmp_path / "sshd-agent.index"
+    grants = _grants(count)
+    assert index.write(path, grants) == 1
+
+    with index.Index.open(path) as loaded:
+        assert loaded.generation == 1
+        assert len(loaded) == count
+        assert sorted(loaded) == sorted(grants)
+        for job_name, grant in grants.items():
+            assert loaded[job_name] == grant
+        assert loaded.get("unknown-job") is None
+
+
+def test_rebuild(tmp_path: Path) -> None:
+    path = tmp_path / "sshd-agent.index"
+    _ = index.write(path, _grants(3))
+    with index.Index.open(path) as previous:
+        assert index.write(path, _grants(3, remote_path="/backups")) == 2
+        # Connections in flight keep the index they opened:
+        assert previous.generation == 1
+        assert previous["job-1"].argv[-1] == "/stash/1"
+    with index.Index.open(path) as current:
+        assert current.generation == 2
+        assert current["job-1"].argv[-1] == "/backups/1"
+
+
+def test_invalid_index(tmp_path: Path) -> None:
+    path = tmp_path / "sshd-agent.index"
+    _ = index.write(path, _grants(3))
+    contents = path.read_bytes()
+    for invalid in (b"", contents[:20], b"X" + contents[1:]):
+        _ = path.write_bytes(invalid)
+        with pytest.raises(index.InvalidIndex):
+            with index.Index.open(path):
+                pass
+
+
+def test_index_permissions(tmp_path: Path) -> None:
+    path = tmp_path / "sshd-agent.index"
+    _ = index.write(path, _grants(3))
+    assert path.stat().st_mode & 0o777 == 0o640
+
+    for mode in (0o660, 0o646):
+        path.chmod(mode)
+        with pytest.raises(index.InvalidIndex, match="written by others"):
+            with index.Index.open(path):
+                pass
@@ -0,0 +1,84 @@
+import pytest
+import sqlite3
+import time
+
+from pathlib import Path
+
+from clan_destiny.backups import ledger
+
+DAY = 24 * 3600
+
+
+def _run(
+    job: str,
+    days_ago: float,
+    status: str = "succeeded",
+    duration: float = 60.0,
+) -> ledger.Run:
+    return ledger.Run(
+        job=job,
+        type="rsync",
+        status=status,
+        started_at=time.time() - days_ago * DAY,
+        duration=duration,
+        bytes_moved=1024,
+        stderr_tail="",
+    )
+
+
+def test_ledger(tmp_path: Path) -> None:
+    path = tmp_path / "state" / ledger.FILENAME
+    with ledger.Ledger.open(path) as runs:
+        runs.record(
+            [
+                _run("media", days_ago=3),
+                _run("media", days_ago=2, status="failed"),
+                _run("media", days_ago=1, status="timeout"),
+                _run("photos", days_ago=2),
+                _run("photos", days_ago=1, status="skipped"),
+                _run("broken", days_ago=1, status="failed"),
+                _run("old", days_ago=400),
+            ],
+            retention_days=365,
+        )
+    assert path.parent.stat().st_mode & 0o777 == 0o700
+
+    with ledger.Ledger.open(path, readonly=True) as runs:
+        last_successes = runs.last_successes()
+        assert last_successes.keys() == {"media", "photos", "broken"}
+        assert last_successes["broken"] is None
+        assert last_successes["photos"] == pytest.approx(time.time() - DAY, abs=10)
+        failing = runs.not_successful_since(time.time() - 2 * DAY)
+        assert failing.keys() == {"media", "broken"}
+
+        with pytest.raises(sqlite3.OperationalError):
+            runs.record([_run("media", days_ago=0)])
+
+
+def test_slower_than_p90(tmp_path: Path) -> None:
+    path = tmp_path / ledger.FILENAME
+    with ledger.Ledger.open(path) as runs:
+        history = [
+            _run(job, days_ago=20 - i, duration=60.0 + i)
+            for job in ("media", "photos", "new")
+            for i in range(10 if job != "new" else 3)
+        ]
+        runs.record(history)
+        runs.record(
+            [
+                _run("media", days_ago=0, duration=600.0),
+                _run("photos", days_ago=0, duration=60.0),
+                # Not enough history to tell:
+                _run("new", days_ago=0, duration=600.0),
+            ]
+        )
+        (slow,) = runs.slower_than_p90()
+    assert slow.job == "media"
+    assert slow.duration == 600.0
+    assert slow.p90 == 69.0
+
+
+def test_missing_ledger(tmp_path: Path) -> None:
+    with pytest.raises(FileNotFoundError):
+        with ledger.Ledger.open(tmp_path / ledger.FILENAME, readonly=True):
+            pass
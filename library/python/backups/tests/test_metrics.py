@@ -0,0 +1,118 @@
+import json
+
+from pathlib import Path
+
+from clan_destiny.backups.dump.metrics import (
+    JobMetrics,
+    ResticSummary,
+    RsyncStats,
+    write_textfile,
+)
+
+
+RSYNC_OUTPUT = """\
+
+Number of files: 1234 (reg: 1000, dir: 234)
+Number of created files: 12 (reg: 10, dir: 2)
+Number of deleted files: 3 (reg: 3)
+Number of regular files transferred: 42
+Total file size: 1234567890 bytes
+Total transferred file size: 4567890 bytes
+Literal data: 1234567 bytes
+Matched data: 3333323 bytes
+File list size: 65536
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 1300000
+Total bytes received: 4321
+
+sent 1300000 bytes  received 4321 bytes  86956.07 bytes/sec
+total size is 1234567890  speedup is 946.52
+"""
+
+
+def test_rsync_stats() -> None:
+    stats = RsyncStats.parse(RSYNC_OUTPUT)
+    assert stats == RsyncStats(
+        files_transferred=42,
+        files_created=12,
+        files_deleted=3,
+        total_file_size=1_234_567_890,
+        transferred_file_size=4_567_890,
+        literal_data=1_234_567,
+        matched_data=3_333_323,
+        bytes_sent=1_300_000,
+        bytes_received=4_321,
+    )
+
+
+def test_rsync_stats_missing() -> None:
+    assert RsyncStats.parse("rsync error: some files could not be transferred") is None
+    # Human readable numbers, grouped for a German locale:
+    grouped = RSYNC_OUTPUT.replace("1234567", "1.234.567")
+    assert RsyncStats.parse(grouped) is None
+
+
+def test_restic_summary() -> None:
+    summary = {
+        "message_type": "summary",
+        "files_new": 5,
+        "files_changed": 2,
+        "files_unmodified": 100,
+        "data_added": 4096,
+        "total_bytes_processed": 1 << 20,
+        "snapshot_id": "deadbeef",
+    }
+    output = "\n".join(
+        (
+            "repository 1234 opened (version 2, compression level auto)",
+            json.dumps({"message_type": "status", "percent_done": 1}),
+            json.dumps(summary),
+            "no errors were found",
+        )
+    )
+    assert ResticSummary.parse(output) == ResticSummary(
+        files_new=5,
+        files_changed=2,
+        files_unmodified=100,
+        data_added=4096,
+        total_bytes_processed=1 << 20,
+        snapshot_id="deadbeef",
+    )
+
+
+def test_write_textfile(tmp_path: Path) -> None:
+    path = tmp_path / "backups.prom"
+    jobs = [
+        JobMetrics(
+            name="photos",
+            type="rsync",
+            status="succeeded",
+            started_at=1700000000.0,
+            duration=12.5,
+            cpu_time=3.25,
+            stats=RsyncStats.parse(RSYNC_OUTPUT),
+        ),
+        JobMetrics(
+            name='my "docs"',
+            type="restic-b2",
+            status="timed_out",
+            started_at=1700000000.0,
+            duration=60.0,
+            cpu_time=1.0,
+        ),
+    ]
+    write_textfile(path, jobs)
+    lines = path.read_text().splitlines()
+    assert lines.count("# TYPE clan_destiny_backups_job_success gauge") == 1
+    assert (
+        'clan_destiny_backups_job_success{job="photos",type="rsync"} 1'
+    ) in lines
+    assert (
+        'clan_destiny_backups_job_success{job="my \\"docs\\"",type="restic-b2"} 0'
+    ) in lines
+    assert (
+        'clan_destiny_backups_rsync_literal_data_bytes{job="photos",type="rsync"}'
+        " 1234567"
+    ) in lines
+    assert [p.name for p in tmp_path.iterdir()] == ["backups.prom"]
@@ -0,0 +1,128 @@
+import email
+import os
+import pytest
+import smtplib
+
+from pathlib import Path
+from typing import Self
+
+from clan_destiny.backups import config
+from clan_destiny.backups.dump import report
+from clan_destiny.backups.dump.capture import StreamCapture
+
+
+class FakeSMTP:
+    connections: int = 0
+    sent: list[bytes] = []
+    fail: bool = False
+    refuse: bool = False
+
+    def __init__(self, host: str) -> None:
+        if FakeSMTP.refuse:
+            raise smtplib.SMTPConnectError(421, "busy")
+        FakeSMTP.connections += 1
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        pass
+
+    def sendmail(self, from_addr: str, to_addr: str, message: bytes) -> dict[str, str]:
+        if FakeSMTP.fail:
+            raise smtplib.SMTPServerDisconnected("gone")
+        FakeSMTP.sent.append(message)
+        return {}
+
+
+@pytest.fixture
+def smtp(monkeypatch: pytest.MonkeyPatch) -> type[FakeSMTP]:
+    FakeSMTP.connections = 0
+    FakeSMTP.sent = []
+    FakeSMTP.fail = False
+    FakeSMTP.refuse = False
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    return FakeSMTP
+
+
+def _capture(tmp_path: Path, name: str, data: bytes) -> StreamCapture:
+    settings = config.Capture(codec=config.CaptureCodec.GZIP, tail_size=1)
+    capture = StreamCapture(tmp_path / name, settings)
+    capture.write(data)
+    capture.close()
+    return capture
+
+
+def test_job_report(tmp_path: Path) -> None:
+    stdout = _capture(tmp_path, "stdout", b"sent 10 bytes\n")
+    # Does not compress well:
+    stderr = _capture(tmp_path, "stderr", os.urandom(8192) + b"\nrsync error\n")
+    job_report = report.JobReport.from_job(
+        "media",
+        "rsync backup job #media failed",
+        succeeded=False,
+        exec_log=["INFO: rsync command: rsync"],
+        stdout=stdout,
+        stderr=stderr,
+        max_attachment_size=4096,
+    )
+
+    small, large = job_report.attachments
+    assert small == report.Attachment(
+        "media-stdout.gz",
+        stdout.path.read_bytes(),
+        "gzip",
+    )
+    assert large.filename == "media-stderr-tail.txt"
+    assert large.data == stderr.tail
+    assert len(large.data) == 1024
+    assert job_report.quoted.endswith("rsync error")
+
+
+def test_deliver_digest(tmp_path: Path, smtp: type[FakeSMTP]) -> None:
+    digest = report.Digest(config.Report())
+    for i, succeeded in enumerate((True, False, True)):
+        digest.add(report.JobReport.from_job(f"job-{i}", f"job #{i}", succeeded, ()))
+    spool_dir = tmp_path / "spool"
+
+    report.deliver(digest.cfg, spool_dir, digest.message())
+    assert smtp.connections == 1
+    (sent,) = smtp.sent
+    message = email.message_from_bytes(sent)
+    assert message["Subject"].startswith("1/3 backup jobs FAILED on ")
+    assert not spool_dir.exists()
+
+
+def test_spool(tmp_path: Path, smtp: type[FakeSMTP]) -> None:
+    cfg = config.Report()
+    spool_dir = tmp_path / "spool"
+
+    smtp.fail = True
+    report.deliver(cfg, spool_dir, b"Subject: first\n\n")
+    report.deliver(cfg, spool_dir, b"Subject: second\n\n")
+    assert len(list(spool_dir.glob("*.eml"))) == 2
+    assert spool_dir.stat().st_mode & 0o777 == 0o700
+
+    smtp.fail = False
+    report.deliver(cfg, spool_dir, b"Subject: third\n\n")
+    assert smtp.sent == [
+        b"Subject: first\n\n",
+        b"Subject: second\n\n",
+        b"Subject: third\n\n",
+    ]
+    assert list(spool_dir.glob("*.eml")) == []
+
+    # Nothing to send, no connection:
+    report.deliver(cfg, spool_dir, None)
+    assert smtp.connections == 3
+
+
+def test_undeliverable(tmp_path: Path, smtp: type[FakeSMTP]) -> None:
+    cfg = config.Report()
+    spool_dir = tmp_path / "spool"
+    spool_dir.write_bytes(b"not a directory")
+
+    smtp.refuse = True
+    report.deliver(cfg, spool_dir, b"Subject: lost\n\n")
+    assert smtp.connections == 0
+    assert spool_dir.read_bytes() == b"not a directory"
@@ -0,0 +1,33 @@
+import time
+
+from pathlib import Path
+
+from clan_destiny.backups.dump.restic import RepositoryState
+
+
+def test_state_round_trip(tmp_path: Path) -> None:
+    path = tmp_path / "restic" / "job.json"
+    assert RepositoryState.load(path) == RepositoryState()
+    state = RepositoryState(initialized=True, last_prune=1.5, next_check_subset=3)
+    state.save(path)
+    assert RepositoryState.load(path) == state
+    assert path.stat().st_mode & 0o777 == 0o600
+
+
+def test_invalid_state(tmp_path: Path) -> None:
+    path = tmp_path / "job.json"
+    assert path.write_text('{"initialized": "maybe"}') > 0
+    assert RepositoryState.load(path) == RepositoryState()
+
+
+def test_prune_due() -> None:
+    assert RepositoryState().prune_due(7)
+    state = RepositoryState(last_prune=time.time() - 3 * 24 * 3600)
+    assert not state.prune_due(7)
+    assert state.prune_due(2)
+
+
+def test_check_subset_rotation() -> None:
+    assert RepositoryState(next_check_subset=5).check_subset(30) == 5
+    # The number of subsets went down since the last run:
+    assert RepositoryState(next_check_subset=12).check_subset(10) == 2
@@ -0,0 +1,48 @@
+import os
+
+from pathlib import Path
+
+from clan_destiny.backups import restic_cache
+from clan_destiny.backups.restic_cache import RepositoryCache
+
+
+def _fill(cache: RepositoryCache, name: str, size: int, last_used: float) -> Path:
+    path = cache.path / "data" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    assert path.write_bytes(b"x" * size) == size
+    os.utime(path, (last_used, last_used))
+    return path
+
+
+def test_lock(tmp_path: Path) -> None:
+    cache = RepositoryCache(tmp_path, "photos")
+    with cache.lock() as locked:
+        assert locked
+        assert cache.path.is_dir()
+        with RepositoryCache(tmp_path, "photos").lock(blocking=False) as locked:
+            assert not locked
+        with RepositoryCache(tmp_path, "docs").lock(blocking=False) as locked:
+            assert locked
+
+
+def test_prune_least_recently_used(tmp_path: Path) -> None:
+    photos = RepositoryCache(tmp_path, "photos")
+    docs = RepositoryCache(tmp_path, "docs")
+    oldest = _fill(photos, "a", 100, 1000)
+    old = _fill(docs, "b", 100, 2000)
+    recent = _fill(photos, "c", 100, 3000)
+    assert restic_cache.prune(tmp_path, 150) == 200
+    assert not oldest.exists()
+    assert not old.exists()
+    assert recent.exists()
+
+
+def test_prune_skips_caches_in_use(tmp_path: Path) -> None:
+    photos = RepositoryCache(tmp_path, "photos")
+    docs = RepositoryCache(tmp_path, "docs")
+    busy = _fill(photos, "a", 100, 1000)
+    idle = _fill(docs, "b", 100, 2000)
+    with photos.lock():
+        assert restic_cache.prune(tmp_path, 150) == 100
+    assert busy.exists()
+    assert not idle.exists()
@@ -0,0 +1,81 @@
+import asyncio
+import json
+import pytest
+
+from pathlib import Path
+from types import SimpleNamespace
+from typing import cast
+
+from clan_destiny.backups import config, restore
+from clan_destiny.backups.dump.rsync import filter_options
+from clan_destiny.backups.restore import _lines
+
+
+def test_filter_options() -> None:
+    assert filter_options((), ()) == ()
+    assert filter_options((), ("*.tmp",)) == ("--exclude=*.tmp",)
+    assert filter_options(("/photos/2024/***",), ("*.tmp",)) == (
+        "--exclude=*.tmp",
+        "--include=/photos/2024/***",
+        "--include=*/",
+        "--exclude=*",
+        "--prune-empty-dirs",
+    )
+
+
+def test_lines() -> None:
+    async def read(*chunks: bytes) -> list[str]:
+        stream = asyncio.StreamReader()
+        for chunk in chunks:
+            stream.feed_data(chunk)
+        stream.feed_eof()
+        return [line async for line in _lines(stream)]
+
+    # rsync --info=progress2 rewrites its line with \r:
+    chunks = (b"photos/a.jpg\n  1,024  10%\r  2,0", b"48  20%\rphotos/b.jpg")
+    assert asyncio.run(read(*chunks)) == [
+        "photos/a.jpg",
+        "  1,024  10%",
+        "  2,048  20%",
+        "photos/b.jpg",
+    ]
+
+
+def test_a_failing_restore_does_not_stop_the_others(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    password_path = tmp_path / "password"
+    _ = password_path.write_text("secret")
+    job = config.BackupJob.model_validate_json(
+        json.dumps(
+            {
+                "type": "restic-b2",
+                "direction": "push",
+                "localHost": "nsrv-sfo-ashpool.kalessin.fr",
+                "localPath": "/stash/backups/photos",
+                "passwordPath": str(password_path),
+                "retention": "30d",
+            }
+        )
+    )
+    cfg = cast(config.Config, SimpleNamespace(jobs_by_name={"a": job, "b": job}))
+
+    async def restore_restic(
+        cfg: config.Config, job_name: str, *args: object
+    ) -> None:
+        await asyncio.sleep(0)
+        if job_name == "a":
+            raise RuntimeError("permission denied")
+
+    monkeypatch.setattr(restore, "_restore_restic", restore_restic)
+
+    async def restore_all() -> list[bool]:
+        limit = asyncio.Semaphore(2)
+        return await asyncio.gather(
+            *(
+                restore._restore(cfg, name, "/", restore.Selection(), False, limit)
+                for name in ("a", "b")
+            )
+        )
+
+    assert asyncio.run(restore_all()) == [False, True]
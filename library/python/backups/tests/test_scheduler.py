@@ -0,0 +1,103 @@
+import asyncio
+import collections
+import functools
+
+from collections.abc import Sequence
+from pathlib import Path
+
+from clan_destiny.backups import config
+from clan_destiny.backups.dump.scheduler import Scheduler, filesystem_id
+
+
+class ConcurrencyProbe:
+    def __init__(self) -> None:
+        self.running: collections.Counter[str] = collections.Counter()
+        self.peaks: collections.Counter[str] = collections.Counter()
+
+    async def job(self, *keys: str) -> None:
+        for key in keys:
+            self.running[key] += 1
+            self.peaks[key] = max(self.peaks[key], self.running[key])
+        # Yield a few times to let the other jobs start if they can:
+        for _ in range(3):
+            await asyncio.sleep(0)
+        for key in keys:
+            self.running[key] -= 1
+
+
+def _run_jobs(
+    limits: config.Runner,
+    jobs: Sequence[tuple[str, str | None]],
+    remote_host_limits: dict[str, int] | None = None,
+) -> ConcurrencyProbe:
+    probe = ConcurrencyProbe()
+
+    async def run_all() -> None:
+        scheduler = Scheduler(limits, remote_host_limits)
+        await asyncio.gather(
+            *(
+                scheduler.run(
+                    local_path,
+                    remote_host,
+                    functools.partial(probe.job, "all", f"host:{remote_host}"),
+                )
+                for local_path, remote_host in jobs
+            )
+        )
+
+    asyncio.run(run_all())
+    return probe
+
+
+def test_global_limit(tmp_path: Path) -> None:
+    limits = config.Runner(
+        max_jobs=3,
+        max_jobs_per_remote_host=10,
+        max_jobs_per_filesystem=10,
+    )
+    jobs = [(str(tmp_path), f"host-{i}") for i in range(10)]
+    probe = _run_jobs(limits, jobs)
+    assert probe.peaks["all"] == 3
+
+
+def test_per_remote_host_limit(tmp_path: Path) -> None:
+    limits = config.Runner(
+        max_jobs=10,
+        max_jobs_per_remote_host=2,
+        max_jobs_per_filesystem=10,
+    )
+    jobs: list[tuple[str, str | None]] = [(str(tmp_path), "nas") for _ in range(5)]
+    jobs += [(str(tmp_path), None) for _ in range(3)]
+    probe = _run_jobs(limits, jobs)
+    assert probe.peaks["host:nas"] == 2
+    assert probe.peaks["host:None"] == 3
+    assert probe.peaks["all"] == 5
+
+
+def test_per_filesystem_limit(tmp_path: Path) -> None:
+    limits = config.Runner(
+        max_jobs=10,
+        max_jobs_per_remote_host=10,
+        max_jobs_per_filesystem=1,
+    )
+    jobs = [(str(tmp_path / f"job-{i}"), f"host-{i}") for i in range(4)]
+    probe = _run_jobs(limits, jobs)
+    assert probe.peaks["all"] == 1
+
+
+def test_filesystem_id_of_missing_path(tmp_path: Path) -> None:
+    missing = tmp_path / "does" / "not" / "exist"
+    assert filesystem_id(str(missing)) == filesystem_id(str(tmp_path))
+
+
+def test_remote_host_limit_override(tmp_path: Path) -> None:
+    limits = config.Runner(
+        max_jobs=10,
+        max_jobs_per_remote_host=1,
+        max_jobs_per_filesystem=10,
+    )
+    jobs = [(str(tmp_path), "b2:bucket") for _ in range(5)]
+    jobs += [(str(tmp_path), "nas") for _ in range(5)]
+    probe = _run_jobs(limits, jobs, {"b2:bucket": 3})
+    assert probe.peaks["host:b2:bucket"] == 3
+    assert probe.peaks["host:nas"] == 1
@@ -1,7 +1,12 @@
+import functools
 import subprocess
 
+from pathlib import Path
+
 from clan_destiny.backups import ssh_ca
 
+from .conftest import SSHKeyPair
+
 
 def test_issue_certificate(ssh_ca_client: ssh_ca.Client) -> None:
     key_id = "test-certificate-id"
@@ -20,3 +25,75 @@ def test_issue_certificate(ssh_ca_client: ssh_ca.Client) -> None:
         assert "Type: ssh-ed25519-cert-v01@openssh.com user certificate" in cert_info
         assert "Principals:" in cert_info and "root" in cert_info
         assert "force-command rsync --server --sender /data" in cert_info
+
+
+def test_issue_certificates(ssh_ca_client: ssh_ca.Client) -> None:
+    requests = [
+        ssh_ca.CertificateRequest(f"test-certificate-{i}", ["rsync", str(i)])
+        for i in range(3)
+    ]
+
+    with ssh_ca_client.issue_certs(requests) as certificates:
+        assert sorted(certificates) == sorted(request.id for request in requests)
+        for request in requests:
+            result = subprocess.run(
+                ["ssh-keygen", "-L", "-f", str(certificates[request.id])],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            assert f'Key ID: "{request.id}"' in result.stdout
+            assert f"force-command {' '.join(request.command)}" in result.stdout
+    assert not any(path.exists() for path in certificates.values())
+
+
+def _sign_locally(ca: SSHKeyPair, host: SSHKeyPair, validity: str) -> str:
+    _ = subprocess.run(
+        [
+            "ssh-keygen",
+            "-q",
+            "-s",
+            str(ca.priv_path),
+            "-I",
+            "test-certificate-id",
+            "-n",
+            "root",
+            "-V",
+            validity,
+            str(host.pub_path),
+        ],
+        check=True,
+    )
+    return host.pub_path.with_name(f"{host.priv_path.name}-cert.pub").read_text()
+
+
+def test_certificate_cache(
+    tmp_path: Path,
+    ssh_ca_keys: SSHKeyPair,
+    ssh_host_keys: SSHKeyPair,
+) -> None:
+    sign = functools.partial(_sign_locally, ssh_ca_keys, ssh_host_keys)
+    cache_dir = tmp_path / "cache"
+    cache = ssh_ca.CertificateCache(cache_dir, min_validity=3600)
+    public_key = ssh_host_keys.pub
+    key = cache.key(public_key, "backups-dump", "root", ["rsync", "--server"])
+    other_key = cache.key(public_key, "backups-dump", "root", ["rsync"])
+    assert key != other_key
+    assert cache.get(key) is None
+    assert cache_dir.stat().st_mode & 0o777 == 0o700
+
+    signed_key = sign("-5m:+1d")
+    cache.put(key, signed_key)
+    assert cache.get(key) == signed_key
+    assert cache.get(other_key) is None
+    assert (cache_dir / f"{key}-cert.pub").stat().st_mode & 0o777 == 0o600
+
+    # Not valid for long enough to be re-used, but not evicted:
+    cache.put(other_key, sign("-5m:+30m"))
+    assert cache.get(other_key) is None
+    assert (cache_dir / f"{other_key}-cert.pub").exists()
+
+    # Expired certificates are evicted:
+    cache.put(other_key, sign("20200101:20200102"))
+    assert cache.get(key) == signed_key
+    assert not (cache_dir / f"{other_key}-cert.pub").exists()
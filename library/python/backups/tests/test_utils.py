@@ -0,0 +1,60 @@
+import pytest
+
+from pathlib import Path
+
+from clan_destiny.backups import utils
+
+
+FSTAB = """\
+# <file system> <mount point> <type> <options> <dump> <pass>
+/dev/disk/by-uuid/1234 / ext4 defaults 0 1
+/dev/disk/by-uuid/5678 /data ext4 defaults 0 2
+/dev/disk/by-uuid/9abc /data2 ext4 defaults 0 2
+/dev/disk/by-uuid/def0 /media/my\\040disk ext4 defaults 0 2
+/dev/disk/by-uuid/1111 none swap sw 0 0
+"""
+
+MOUNTINFO_TEMPLATE = (
+    "{id} 1 8:{id} / {target} rw,relatime shared:1 - ext4 /dev/sda{id} rw\n"
+)
+
+
+@pytest.fixture
+def fstab(tmp_path: Path) -> Path:
+    path = tmp_path / "fstab"
+    assert path.write_text(FSTAB) > 0
+    return path
+
+
+def _mountinfo(tmp_path: Path, *targets: str) -> Path:
+    path = tmp_path / "mountinfo"
+    lines = (
+        MOUNTINFO_TEMPLATE.format(id=i, target=target)
+        for i, target in enumerate(targets)
+    )
+    assert path.write_text("".join(lines)) > 0
+    return path
+
+
+def test_is_mounted(tmp_path: Path, fstab: Path) -> None:
+    mountinfo = _mountinfo(tmp_path, "/", "/data", "/media/my\\040disk")
+    mounts = utils.MountTable.read(fstab, mountinfo)
+    assert mounts.is_mounted(Path("/data/backups"))
+    assert mounts.is_mounted(Path("/media/my disk/photos"))
+    # /data2 is not a subdirectory of /data:
+    assert not mounts.is_mounted(Path("/data2/backups"))
+    # but anything not on a more specific mount point is on / which is mounted:
+    assert mounts.is_mounted(Path("/var/lib/backups"))
+
+
+def test_is_mounted_overmounted(tmp_path: Path, fstab: Path) -> None:
+    mountinfo = _mountinfo(tmp_path, "/", "/data", "/data/tmp")
+    mounts = utils.MountTable.read(fstab, mountinfo)
+    assert mounts.is_mounted(Path("/data/backups"))
+    # Something not in fstab is mounted there:
+    assert not mounts.is_mounted(Path("/data/tmp/backups"))
+
+
+def test_is_mounted_not_in_fstab() -> None:
+    mounts = utils.MountTable(configured=[], mounted=["/", "/data"])
+    assert not mounts.is_mounted(Path("/data"))